@@ -1,4 +1,5 @@
 
+from .aio import AsyncCapiClient
 from .bot import BnetBot
 
 from .capi import CapiClient, CapiUser, CapiError, STATUS_CODES
@@ -1,12 +1,16 @@
 
-from . import commands, instance
+from . import commands, instance, transfer
 from .bot import BnetBot
+from .database import UserDatabase
+from .supervisor import Supervisor
 from .util.events import *
+from .util.logs import start_logging
 
 import argparse
 import atexit
 from datetime import datetime
 import logging
+import sys
 
 
 def main():
@@ -14,13 +18,28 @@ def main():
     parser.add_argument("--apikey", help="An API key to create a bot instance with.")
     parser.add_argument("--config", help="The path to a config file to use.")
     parser.add_argument("--debug", help="Prints debugging messages.", action="store_true")
+    parser.add_argument("--workers", type=int, nargs="?", const=0,
+                        help="Runs the profiles in this many worker processes (default: one per CPU core).")
+
+    subparsers = parser.add_subparsers(dest="command")
+    for name, action, stream in [("import", "Adds or replaces users and groups in a profile's database from", "input"),
+                                 ("export", "Writes a profile's users and groups to", "output")]:
+        sub = subparsers.add_parser(name, help="%s a JSONL or CSV file." % action)
+        sub.add_argument("file", help="The file to use, or '-' for standard %s." % stream)
+        sub.add_argument("--profile", help="The profile whose database to use (needed if there's more than one).")
+        sub.add_argument("--format", choices=transfer.FORMATS, help="The file format (default: from the extension).")
+        sub.add_argument("--batch-size", type=int, default=transfer.DEFAULT_BATCH_SIZE,
+                         help="Entries to import between saves, or export between progress updates.")
 
     # Parse program arguments and create the main bot instance.
     p_args = parser.parse_args()
-    logging.basicConfig(
-        level=logging.DEBUG if p_args.debug else logging.INFO,
-        format="%(asctime)s: %(name)s - %(levelname)s: %(message)s"
-    )
+    start_logging(logging.DEBUG if p_args.debug else logging.INFO)
+
+    if p_args.command is not None:
+        return run_transfer(p_args)
+
+    if p_args.workers is not None and p_args.apikey is None:
+        return run_supervisor(p_args.config, p_args.workers)
 
     should_load = p_args.apikey is None         # Only load instances if no API key given.
     bot = BnetBot(p_args.config, should_load)
@@ -40,7 +59,7 @@ def main():
         instances = bot.config.get("instances", {})
         for name, cfg in instances.items():
             if cfg.get("api_key").lower() == p_args.apikey.lower():
-                inst = instance.BotInstance(name, cfg)
+                inst = instance.BotInstance(name, cfg, databases=bot.databases)
                 break
 
         # If no matching instance was found, create a new one.
@@ -48,7 +67,7 @@ def main():
             time_based_number = str(datetime.now().timestamp()).split('.')[1]
             instance_name = ("Temp" + time_based_number) if len(instances) > 0 else "Main"
             print("Creating instance: %s" % instance_name)
-            inst = instance.BotInstance(instance_name, {"api_key": p_args.apikey})
+            inst = instance.BotInstance(instance_name, {"api_key": p_args.apikey}, databases=bot.databases)
 
             def handle_first_login(c, u):
                 # If name has already been changed, ignore.
@@ -131,5 +150,85 @@ def main():
     print("All connections closed.")
 
 
+def run_supervisor(config, workers):
+    """Runs the configured profiles in worker processes, with a console that forwards input to them."""
+    supervisor = Supervisor(config, workers)
+    if len(supervisor.profiles) == 0:
+        print("No profiles found. Run the bot with the '--apikey=<your API key>' switch to create a new one.")
+        return
+
+    def shutdown(s):
+        print("Shutting down...")
+        if s.running:
+            s.stop(True)
+    atexit.register(shutdown, supervisor)
+
+    print("Loaded %i profiles in %i worker processes - running in supervisor mode" %
+          (len(supervisor.profiles), len(supervisor.workers)))
+    print("Use '@<profile> <message>' or '@<profile> /<command>' to send input to a profile.")
+
+    supervisor.start()
+    while supervisor.running:
+        ip = input()
+        if ip == "/quit":
+            supervisor.stop()
+        elif ip == "/workers":
+            for worker in supervisor.workers:
+                state = "running" if worker.process and worker.process.is_alive() else "restarting"
+                print("Worker %i (%s): %s" % (worker.index, state, ", ".join(worker.names)))
+        elif ip.startswith("@") and len(ip) > 1:
+            name, _, text = ip[1:].partition(' ')
+            if not supervisor.console(name, text.strip()):
+                print("Profile '%s' is not running." % name)
+        else:
+            print("Use '@<profile> <message>' to talk to a profile, '/workers' to list workers or '/quit' to exit.")
+
+    print("All connections closed.")
+
+
+def run_transfer(p_args):
+    """Imports or exports the user database of a profile, without connecting it."""
+    bot = BnetBot(p_args.config, False)
+    profiles = bot.config.get("instances", {})
+    if p_args.profile is None and len(profiles) == 1:
+        name = list(profiles)[0]
+    else:
+        name = next((n for n in profiles if n.lower() == (p_args.profile or "").lower()), None)
+    if name is None:
+        print("Choose a profile with '--profile=<name>': %s" % (", ".join(profiles) or "no profiles found"),
+              file=sys.stderr)
+        return 1
+
+    cfg = profiles[name]
+    db = UserDatabase.load(cfg.get("database"), bot.databases)
+    fmt = p_args.format or transfer.guess_format(p_args.file)
+
+    if p_args.command == "export":
+        fh = sys.stdout if p_args.file == "-" else open(p_args.file, "w", newline="", encoding="utf-8")
+        try:
+            count = transfer.export_file(db, fh, fmt, p_args.batch_size,
+                                         lambda n: print("Exported %i entries..." % n, file=sys.stderr))
+        finally:
+            if fh is not sys.stdout:
+                fh.close()
+        print("Exported %i entries from profile '%s'." % (count, name), file=sys.stderr)
+    else:
+        fh = sys.stdin if p_args.file == "-" else open(p_args.file, "r", newline="", encoding="utf-8")
+        try:
+            # An SQLite database is saved with each batch. The JSON database is part of the config file, which is
+            #   only written once at the end rather than rewritten in full for every batch.
+            imported, skipped = transfer.import_file(
+                db, fh, fmt, p_args.batch_size, db.commit,
+                lambda n, s: print("Imported %i entries (%i skipped)..." % (n, s), file=sys.stderr))
+        finally:
+            if fh is not sys.stdin:
+                fh.close()
+
+        cfg["database"] = db.to_config()
+        bot.save_config()
+        print("Imported %i entries into profile '%s' (%i skipped)." % (imported, name, skipped), file=sys.stderr)
+    return 0
+
+
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
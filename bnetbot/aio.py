@@ -0,0 +1,171 @@
+
+from .capi import CapiClient
+from .util.loop import EventLoopThread
+from .util.ws import OPCODE_PING, OPCODE_TEXT, WebSocketError, client_handshake
+
+import asyncio
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from datetime import datetime
+import ssl
+import time
+from urllib.parse import urlparse
+
+
+CONNECT_TIMEOUT = 10
+
+# Errors that mean the connection is unusable.
+TRANSPORT_ERRORS = (WebSocketError, OSError, EOFError, asyncio.TimeoutError, asyncio.LimitOverrunError)
+
+
+class AsyncCapiClient(CapiClient):
+    """Chat API client driven by a shared asyncio event loop instead of a receive thread per connection.
+
+        The events and 'message_handlers' table are inherited unchanged from CapiClient. Public methods can still be
+        called from any thread - socket writes are marshalled onto the loop.
+
+        - loop: the EventLoopThread to run on. Defaults to the process-wide shared loop.
+    """
+    def __init__(self, api_key, loop=None, request_timeout=30, rate_limit=None, codec=None):
+        super().__init__(api_key, request_timeout, rate_limit, codec)
+        self.loop = loop or EventLoopThread.default()
+        self._ws = None
+        self._task = None
+        self._expiry_timer = None
+        self._expiry_at = None
+        self._sender_timer = None
+
+    def connected(self):
+        """Returns TRUE if the client socket is connected."""
+        return self._connected and self._ws is not None and not self._ws.closed
+
+    def connect(self, endpoint=None):
+        """Connects to a CAPI endpoint.
+
+            - endpoint: the URI of the chat API. If not set then the default or most recent will be used.
+            - Returns success of the connect operation.
+
+            When called from the loop thread the connection is only scheduled and FALSE is returned.
+        """
+        self.loop.start()
+        if self.loop.in_loop():
+            self.loop.spawn(self.connect_async(endpoint))
+            return False
+
+        try:
+            return self.loop.run(self.connect_async(endpoint), CONNECT_TIMEOUT * 2)
+        except FutureTimeoutError:
+            return False
+
+    async def connect_async(self, endpoint=None):
+        """Coroutine version of connect(). Must be awaited on the client's loop."""
+        self.endpoint = (endpoint or self.endpoint)
+        url = urlparse(self.endpoint)
+        secure = url.scheme == "wss"
+        path = (url.path or "/") + ("?" + url.query if url.query else "")
+
+        context = None
+        if secure:
+            # Match the threaded client, which doesn't verify the server certificate.
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(url.hostname, url.port or (443 if secure else 80), ssl=context),
+                CONNECT_TIMEOUT)
+            self._ws = await asyncio.wait_for(client_handshake(reader, writer, url.netloc, path), CONNECT_TIMEOUT)
+        except TRANSPORT_ERRORS as ex:
+            self.events['client_error'](self, ex)
+            return False
+
+        self._connected = True
+        self._task = asyncio.ensure_future(self._receive_async(self._ws), loop=self.loop.loop)
+        self._flush_async()
+        return True
+
+    def ping(self, payload=None):
+        """Sends a websocket PING command to the server."""
+        ws = self._ws
+        if ws is None or ws.closed:
+            self.events['client_error'](self, ConnectionError("Unable to ping: not connected."))
+            return False
+
+        self.loop.call(self._send_frame, ws, OPCODE_PING, str(datetime.now() if payload is None else payload))
+        return True
+
+    def _write(self, message):
+        ws = self._ws
+        if ws is None or ws.closed:
+            raise ConnectionError("Unable to send: not connected.")
+        self.loop.call(self._send_frame, ws, OPCODE_TEXT, message)
+
+    def _wake_sender(self):
+        self.loop.call(self._flush_async)
+
+    def _flush_async(self):
+        # Send what the rate limit allows now and set a timer for the rest.
+        if self._sender_timer is not None:
+            self._sender_timer.cancel()
+            self._sender_timer = None
+
+        if self.connected():
+            wait = self.flush_outbound()
+            if wait is not None:
+                self._sender_timer = self.loop.loop.call_later(wait, self._flush_async)
+
+    def _schedule_expiry(self, deadline):
+        self.loop.call(self._arm_expiry_timer)
+
+    def _arm_expiry_timer(self):
+        # Keep a single timer armed for the earliest request deadline.
+        deadline = self._requests.next_deadline()
+        if deadline is None or (self._expiry_timer is not None and self._expiry_at <= deadline):
+            return
+
+        if self._expiry_timer is not None:
+            self._expiry_timer.cancel()
+        self._expiry_at = deadline
+        self._expiry_timer = self.loop.loop.call_at(self._loop_time(deadline), self._on_expiry_timer)
+
+    def _on_expiry_timer(self):
+        # Only the expiry timer's own state is reset here. The sender timer belongs to _flush_async, and clearing it
+        #   here would let a second flush timer be armed alongside the first.
+        self._expiry_timer = None
+        self._expiry_at = None
+        self.expire_requests()
+        self._arm_expiry_timer()
+
+    def _loop_time(self, deadline):
+        # Convert a time.monotonic() deadline to the loop's clock.
+        return self.loop.loop.time() + (deadline - time.monotonic())
+
+    @staticmethod
+    def _send_frame(ws, opcode, data):
+        # The socket may have closed between scheduling and running the write.
+        if not ws.closed:
+            ws.send(opcode, data)
+
+    def _close_transport(self):
+        ws, task = self._ws, self._task
+        self._ws = self._task = None
+        if ws:
+            self.loop.call(ws.close)
+        if task:
+            self.loop.call(task.cancel)
+
+    async def _receive_async(self, ws):
+        self._authenticating = True
+        self.send("Botapiauth.AuthenticateRequest", {"api_key": self._api_key})
+
+        # Receive and process incoming messages
+        while self._ws is ws and self.connected():
+            try:
+                opcode, data = await ws.recv()
+            except TRANSPORT_ERRORS:
+                # Unknown error - force close socket (unless it has already been replaced)
+                if self._ws is ws:
+                    self.disconnect(True)
+                return
+
+            self._process_frame(opcode, data)
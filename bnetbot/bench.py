@@ -0,0 +1,275 @@
+
+from .capi import CapiClient
+from .commands import DEFINED_COMMANDS
+from .instance import BotInstance
+from .util.codec import get_codec
+
+import argparse
+import gzip
+import json
+import sys
+import threading
+import time
+import tracemalloc
+
+
+DIRECTION_RECEIVED = "r"
+DIRECTION_SENT = "s"
+
+# Pipeline stages timed during replay, in processing order.
+STAGES = ["decode", "dispatch", "parse", "execute", "encode"]
+
+
+class CaptureWriter:
+    """Records protocol traffic from a client into a gzip-compressed capture file.
+
+        Each line of the capture is a JSON array of [milliseconds since start, direction, message], where the
+        direction is 'r' for received and 's' for sent messages.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._fh = gzip.open(path, "wt", encoding="utf-8")
+        self._codec = get_codec("json")
+        self._start = time.monotonic()
+        self._lock = threading.Lock()    # Received and sent events can come from different threads
+
+    def attach(self, client):
+        """Starts recording a client's traffic."""
+        client.events['protocol_message_received'].register(self._handle_received)
+        client.events['protocol_message_sent'].register(self._handle_sent)
+
+    def detach(self, client):
+        """Stops recording a client's traffic."""
+        client.events['protocol_message_received'].unregister(self._handle_received)
+        client.events['protocol_message_sent'].unregister(self._handle_sent)
+
+    def write(self, direction, message):
+        elapsed = int((time.monotonic() - self._start) * 1000)
+        line = self._codec.encode([elapsed, direction, message]) + "\n"
+        with self._lock:
+            self._fh.write(line)
+            self.count += 1
+
+    def close(self):
+        self._fh.close()
+
+    def _handle_received(self, client, data):
+        self.write(DIRECTION_RECEIVED, data)
+
+    def _handle_sent(self, client, data):
+        self.write(DIRECTION_SENT, data)
+
+
+def read_capture(path):
+    """Yields (milliseconds, direction, message) tuples from a capture file."""
+    with gzip.open(path, "rt", encoding="utf-8") as fh:
+        for line in fh:
+            if line.strip():
+                elapsed, direction, message = json.loads(line)
+                yield elapsed, direction, message
+
+
+class ReplayClient(CapiClient):
+    """A client with no socket. Outgoing messages are encoded and discarded."""
+    def __init__(self, codec=None):
+        super().__init__(None, rate_limit={"rate": 1e9, "burst": 1e9}, codec=codec)
+        self._connected = True
+
+    def connected(self):
+        return self._connected
+
+    def _write(self, message):
+        pass
+
+    def _wake_sender(self):
+        pass
+
+
+class StageTimer:
+    """Collects per-message latency samples for each pipeline stage."""
+    def __init__(self):
+        self.samples = {stage: [] for stage in STAGES}
+
+    def wrap(self, stage, func):
+        samples = self.samples[stage]
+        clock = time.perf_counter
+
+        def timed(*args, **kwargs):
+            start = clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                samples.append(clock() - start)
+        return timed
+
+    def summary(self):
+        result = {}
+        for stage, samples in self.samples.items():
+            if not samples:
+                continue
+            samples = sorted(samples)
+            result[stage] = {
+                "count": len(samples),
+                "p50_us": percentile(samples, 50) * 1e6,
+                "p90_us": percentile(samples, 90) * 1e6,
+                "p99_us": percentile(samples, 99) * 1e6,
+                "max_us": samples[-1] * 1e6
+            }
+        return result
+
+
+def percentile(ordered, pct):
+    """Returns the nearest-rank percentile of a sorted list."""
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def create_replay_instance(config=None, name="Replay", timer=None):
+    """Creates a bot instance wired to a ReplayClient, optionally instrumented with a StageTimer."""
+    config = dict(config or {})
+    config.setdefault("log_level", "ERROR")     # Don't flood the console with access denied warnings
+    inst = BotInstance(name, config, client=ReplayClient(config.get("json_codec")))
+    for command, permission, callback in DEFINED_COMMANDS:
+        inst.register_command(command, permission, callback)
+
+    if timer:
+        client = inst.client
+        client.codec = type(client.codec)(client.codec.name, timer.wrap("encode", client.codec.encode),
+                                          timer.wrap("decode", client.codec.decode))
+        for command, handler in list(client.message_handlers.items()):
+            client.message_handlers[command] = timer.wrap("dispatch", handler)
+        inst.parse_command = timer.wrap("parse", inst.parse_command)
+        inst.execute_command = timer.wrap("execute", inst.execute_command)
+    return inst
+
+
+def replay(path, config=None, repeat=1, allocations=False):
+    """Replays the received messages in a capture through the bot pipeline and returns the results as a dict.
+
+        - config: optional instance config (database, trigger, etc) for the replay instance
+        - repeat: the number of times to replay the capture
+        - allocations: also measure memory allocations (this slows down the replay)
+    """
+    codec = get_codec((config or {}).get("json_codec"))
+    frames = []
+    for elapsed, direction, message in read_capture(path):
+        if direction == DIRECTION_RECEIVED:
+            encoded = codec.encode(message)
+            frames.append(encoded.encode('utf-8') if isinstance(encoded, str) else encoded)
+
+    timer = StageTimer()
+    elapsed_total = 0.0
+    sent = 0
+    memory = None
+    for i in range(repeat):
+        inst = create_replay_instance(config, timer=timer)
+        client = inst.client
+
+        if allocations:
+            tracemalloc.start()
+        start = time.perf_counter()
+        for frame in frames:
+            client._process_frame(1, frame)
+            client.flush_outbound()
+        elapsed_total += time.perf_counter() - start
+
+        if allocations:
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            memory = {"current_bytes": current, "peak_bytes": peak}
+        sent += client.outbound.sent
+
+    count = len(frames) * repeat
+    return {
+        "messages": count,
+        "sent": sent,
+        "seconds": elapsed_total,
+        "messages_per_second": count / elapsed_total if elapsed_total else 0.0,
+        "stages": timer.summary(),
+        "memory": memory
+    }
+
+
+def record(endpoint, api_key, path, duration):
+    """Connects to an endpoint and records its traffic for 'duration' seconds. Returns the message count."""
+    client = CapiClient(api_key)
+    writer = CaptureWriter(path)
+    writer.attach(client)
+    try:
+        if not client.connect(endpoint):
+            raise ConnectionError("Unable to connect to %s" % endpoint)
+        time.sleep(duration)
+        client.disconnect(True)
+    finally:
+        writer.close()
+    return writer.count
+
+
+def print_results(results, out=sys.stdout):
+    out.write("Replayed %i messages in %.3f seconds: %.0f messages/sec (%i responses sent)\n" %
+              (results["messages"], results["seconds"], results["messages_per_second"], results["sent"]))
+    out.write("%-10s %10s %10s %10s %10s %10s\n" % ("stage", "count", "p50 us", "p90 us", "p99 us", "max us"))
+    for stage in STAGES:
+        s = results["stages"].get(stage)
+        if s:
+            out.write("%-10s %10i %10.1f %10.1f %10.1f %10.1f\n" %
+                      (stage, s["count"], s["p50_us"], s["p90_us"], s["p99_us"], s["max_us"]))
+    if results["memory"]:
+        out.write("Memory: %(current_bytes)i bytes retained, %(peak_bytes)i bytes peak\n" % results["memory"])
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Records and replays chat API traffic to benchmark the bot.")
+    sub = parser.add_subparsers(dest="action")
+
+    rec = sub.add_parser("record", help="Record traffic from an endpoint to a capture file.")
+    rec.add_argument("capture", help="The capture file to write.")
+    rec.add_argument("--apikey", required=True, help="The API key to connect with.")
+    rec.add_argument("--endpoint", default=None, help="The endpoint to connect to (default: Battle.net).")
+    rec.add_argument("--duration", type=float, default=60, help="Seconds to record for.")
+
+    rep = sub.add_parser("replay", help="Replay a capture file and report throughput.")
+    rep.add_argument("capture", help="The capture file to replay.")
+    rep.add_argument("--config", help="A config file to take the instance settings from.")
+    rep.add_argument("--instance", help="The instance in the config file to use (default: the first).")
+    rep.add_argument("--repeat", type=int, default=1, help="The number of times to replay the capture.")
+    rep.add_argument("--allocations", action="store_true", help="Also measure memory allocations.")
+    rep.add_argument("--save", help="Save the results as JSON to this path.")
+    rep.add_argument("--compare", help="Compare against results saved with --save.")
+    rep.add_argument("--threshold", type=float, default=10.0,
+                     help="Fail if throughput is this many percent below the compared results.")
+
+    p_args = parser.parse_args(args)
+    if p_args.action == "record":
+        endpoint = p_args.endpoint or CapiClient(None).endpoint
+        count = record(endpoint, p_args.apikey, p_args.capture, p_args.duration)
+        print("Recorded %i messages to %s" % (count, p_args.capture))
+    elif p_args.action == "replay":
+        config = None
+        if p_args.config:
+            with open(p_args.config, "r") as fh:
+                instances = json.load(fh).get("instances", {})
+            name = p_args.instance or next(iter(instances), None)
+            config = instances.get(name)
+
+        results = replay(p_args.capture, config, p_args.repeat, p_args.allocations)
+        print_results(results)
+
+        if p_args.save:
+            with open(p_args.save, "w") as fh:
+                json.dump(results, fh, sort_keys=True, indent=4)
+        if p_args.compare:
+            with open(p_args.compare, "r") as fh:
+                baseline = json.load(fh)
+            change = (results["messages_per_second"] / baseline["messages_per_second"] - 1) * 100
+            print("Throughput change: %+.1f%%" % change)
+            if change < -p_args.threshold:
+                return 1
+    else:
+        parser.print_help()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,13 +1,18 @@
 
+from .aio import AsyncCapiClient
 from .commands import DEFINED_COMMANDS
 from .instance import BotInstance
-
-from datetime import datetime
+from .monitor import ConnectionMonitor
+from .plugins import PluginManager
+from .shareddb import SharedDatabases
+from .util.logs import configure_logging
+from .util.loop import EventLoopThread
+from .util.persist import DeferredWriter, write_atomic
+
+from concurrent.futures import ThreadPoolExecutor
 import json
 import logging
 from os import path
-import threading
-import time
 
 
 class BnetBot:
@@ -22,24 +27,38 @@ class BnetBot:
         else:
             self.config = {}
 
+        configure_logging(self.config.get("logging"))
         if self.config:
             self.log.debug("Config loaded: %s", self.config_path)
         else:
             self.log.debug("Config not found. Using defaults.")
         self.log.info("Global logging level set to: %s", logging.getLevelName(self.log.getEffectiveLevel()))
 
+        # Changes are saved in the background, shortly after they're made.
+        self.writer = DeferredWriter(self._save_changes, self.config.get("save_delay", 2.0))
+
+        # User databases that instances can share, loaded when an instance first uses them.
+        self.databases = SharedDatabases(self.config.get("databases"))
+
+        # Command plugins are found now, but each is only imported when one of its commands is first run.
+        self.plugins = PluginManager.from_config(self.config.get("plugins"), path.dirname(self.config_path))
+
+        # Commands from chat run on a pool shared by the instances while the bot is running.
+        self.command_workers = self.config.get("command_workers", 4)
+        self.command_pool = None
+
         # Load the configured instances.
         self.instances = {}
         self.running = False
+        self.loop = EventLoopThread.default()
         if auto_load:
             self.log.debug("Loading startup instances...")
             for name, cfg in self.config.get("instances", {}).items():
                 if cfg.get("enabled", True) and name.lower() not in self.instances:
-                    self.load_instance(BotInstance(name, cfg), False)
+                    self.load_instance(BotInstance(name, cfg, databases=self.databases), False)
 
-        # Create a connectivity monitoring thread
-        self.monitor = threading.Thread(target=self._run_monitor)
-        self.monitor.setDaemon(True)
+        # Create the connectivity monitor
+        self.monitor = ConnectionMonitor.from_config(self.config)
 
     def load_instance(self, inst, save=True):
         if save:
@@ -48,75 +67,92 @@ class BnetBot:
             if not cfg:
                 cfg = self.config["instances"] = {}
             cfg[inst.name] = inst.config
+            self.writer.mark_dirty()
 
         key = inst.name.lower()
         if key not in self.instances:
-            self.log.info("Loading instance: %s" % inst.name)
+            self.log.info("Loading instance: %s", inst.name)
             inst.config["enabled"] = True
+            inst.writer = self.writer
+            inst.plugins = self.plugins
+            inst.command_queue.pool = self.command_pool
             self.instances[key] = inst
 
             # Register internally defined commands
             for command, permission, callback in DEFINED_COMMANDS:
                 inst.register_command(command, permission, callback)
+            self.plugins.attach(inst)
         else:
             raise Exception("An instance with that name is already loaded.")
 
         if self.running:
             inst.start()
+            self.monitor.add(inst)
         return inst
 
     def start(self):
         self.log.debug("Starting bot instances...")
         # Start the loaded instances.
         self.running = True
+        self.loop.start()
+
+        self.command_pool = ThreadPoolExecutor(self.command_workers, thread_name_prefix="bnetbot-command")
         for inst in self.instances.values():
-            inst.start()
+            inst.command_queue.pool = self.command_pool
+
+        # Instances on the asyncio transport connect concurrently, threaded ones one at a time.
+        pending = []
+        for inst in self.instances.values():
+            if isinstance(inst.client, AsyncCapiClient):
+                inst.client.loop.start()
+                pending.append(inst.client.loop.spawn(inst.start_async()))
+            else:
+                inst.start()
+
+        for future in pending:
+            future.result()
 
         # Start the connection monitor
+        for inst in self.instances.values():
+            self.monitor.add(inst)
         self.monitor.start()
 
     def stop(self, force=False):
         self.log.debug("Stopping bot instances (force: %s)...", force)
         self.running = False
+        self.monitor.stop()
 
         # Disconnect and stop the loaded instances.
         for inst in self.instances.values():
             inst.stop(force)
 
+        # Let commands that are already running finish, unless forced. Ones that haven't started were dropped.
+        pool, self.command_pool = self.command_pool, None
+        for inst in self.instances.values():
+            inst.command_queue.pool = None
+        if pool:
+            pool.shutdown(not force)
+
+        if force:
+            # Nothing is waiting on a server response, so the shared loop can be shut down as well.
+            self.loop.stop()
+
+        # Everything is written below, so there's no need for the writer to save its pending changes first.
+        self.writer.stop(False)
         self.save_config()
 
-    def save_config(self, save_path=None):
-        """Saves the bot config to disk."""
-        with open(save_path or self.config_path, "w") as fh:
-            json.dump(self.config, fh, sort_keys=True, indent=4)
+    def save_config(self, save_path=None, instances=None):
+        """Saves the bot config to disk, including the current state of the loaded instances.
 
-    def _run_monitor(self):
-        """ Checks each client at the configured interval. If no messages have been received since the last check,
-          send a client ping (which should trigger a response). If still no message is received by the following
-          check, forcibly reconnect the client.
+            - instances: only update the config of these instances before saving (default: all of them)
         """
-
-        connecting_instances = []
-        keep_alive_interval = self.config.get("keep_alive", 10)
-        while self.running:
-            now = datetime.now()
-            for inst in self.instances.values():
-                # Check for inactive or offline clients
-                last = inst.client.last_message
-                diff = (now - last).total_seconds() if last else keep_alive_interval
-
-                if diff >= (keep_alive_interval * 2) or not inst.client.connected():
-                    if inst not in connecting_instances:
-                        self.log.warning("Monitor has detected instance '%s' as down - attempting to reconnect..." % inst.name)
-                        connecting_instances.append(inst)
-                        inst.client.disconnect(True)
-
-                    # Reconnect the client
-                    if inst.client.connect():
-                        self.log.info("Connection successful. Resuming...")
-                        connecting_instances.remove(inst)
-                elif diff >= keep_alive_interval and inst.client.connected():
-                    # Send a ping
-                    inst.client.ping(str(now))
-
-            time.sleep(1)
+        for inst in (self.instances.values() if instances is None else instances):
+            inst.write_config()
+        shared = self.databases.to_config()
+        if shared:
+            self.config.setdefault("databases", {}).update(shared)
+        write_atomic(save_path or self.config_path, json.dumps(self.config, sort_keys=True, indent=4))
+
+    def _save_changes(self, instances):
+        # Called on the writer thread with the instances that have changed.
+        self.save_config(instances=instances)
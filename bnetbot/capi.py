@@ -1,15 +1,21 @@
 
+from .channel import ChannelState
+from .outbound import OutboundQueue
+from .pending import RequestTable
+from .util.codec import get_codec
 from .util.events import EventSource
 
 from datetime import datetime
 
-import json
+import logging
 import ssl
 import threading
-import traceback
 import websocket
 
 
+# The longest chat message, in bytes, that the server will pass on. Longer messages are cut off.
+MAX_MESSAGE_LENGTH = 223
+
 STATUS_CODES = {
     0: {
         0: None
@@ -34,13 +40,17 @@ OPCODES = {
 }
 
 
-class CapiError:
+class CapiError(Exception):
     """CAPI protocol error"""
     def __init__(self, message):
+        super().__init__(message)
         self.message = message
         self.area = None
         self.code = None
 
+    def __str__(self):
+        return str(self.message)
+
     def get_reason(self):
         """Returns the protocol-defined reason text for the error."""
         return STATUS_CODES.get(self.area, {}).get(self.code) or ("Unknown (%i-%i)" % (self.area, self.code))
@@ -55,53 +65,108 @@ class CapiError:
         return ex
 
 
+# Shared by users without attributes. Attributes are copy-on-write, so this is never modified.
+NO_ATTRIBUTES = {}
+
+# Flag tuples and their lower-cased sets are shared between users with the same flags.
+_flag_cache = {}
+_MISSING = object()
+
+
+def _intern_flags(flags):
+    key = tuple(flags or ())
+    cached = _flag_cache.get(key)
+    if cached is None:
+        if len(_flag_cache) > 1024:
+            _flag_cache.clear()     # Flags come from the server, so don't let odd combinations pile up.
+        cached = _flag_cache[key] = (key, frozenset(f.lower() for f in key))
+    return cached
+
+
 class CapiUser:
-    """CAPI user information"""
+    """CAPI user information
+
+        - flags: tuple of the user's flags as sent by the server
+        - attributes: dict of the user's attributes. It's replaced rather than modified when attributes change,
+            so holding on to the old dict is enough to compare against later.
+    """
+    __slots__ = ('id', 'name', 'flags', 'attributes', '_flag_set')
+
     def __init__(self, user_id, name, flags=None, attributes=None):
         self.id = user_id
         self.name = name
-        self.flags = flags or []
-        self.attributes = {}
+        self.flags, self._flag_set = _intern_flags(flags)
+        self.attributes = NO_ATTRIBUTES
         if attributes:
             self.update(attributes)
 
     def update(self, attr):
-        """Updates user attributes with new data."""
+        """Updates user attributes with new data. Returns TRUE if anything changed."""
         if isinstance(attr, list):
+            items = []
             for item in attr:
                 if isinstance(item, dict):
-                    key, value = item.get("key"), item.get("value")
-                    self.attributes[key] = value
+                    items.append((item.get("key"), item.get("value")))
                 else:
                     raise ValueError("Unexpected attribute item format: %s" % type(item).__name__)
         elif isinstance(attr, dict):
-            self.attributes.update(attr)
+            items = attr.items()
         else:
             raise ValueError("Unexpected attribute format: %s" % type(attr).__name__)
 
+        current = self.attributes
+        changed = None
+        for key, value in items:
+            if current.get(key, _MISSING) != value:
+                if changed is None:
+                    changed = dict(current)
+                changed[key] = value
+
+        if changed is None:
+            return False
+        self.attributes = changed
+        return True
+
+    def set_flags(self, flags):
+        """Replaces the user's flags. Returns TRUE if they changed (ignoring order and case)."""
+        flags, flag_set = _intern_flags(flags)
+        self.flags = flags
+        if flag_set == self._flag_set:
+            return False
+        self._flag_set = flag_set
+        return True
+
     def has_flag(self, flag):
         """Returns TRUE if the user has 'flag'."""
-        for f in self.flags:
-            if f.lower() == flag.lower():
-                return True
-        return False
+        return flag.lower() in self._flag_set
 
 
 class CapiClient(EventSource):
-    """Client for interacting with the Battle.net chat API."""
-    def __init__(self, api_key):
+    """Client for interacting with the Battle.net chat API.
+
+        - request_timeout: seconds to wait for a response before a request fails with a 6-5 timeout error
+        - rate_limit: optional dict of outbound rate limit settings (see outbound.DEFAULT_RATE_LIMIT)
+        - codec: the JSON backend to use ('orjson', 'ujson' or 'json'). By default the fastest installed one is used.
+    """
+    def __init__(self, api_key, request_timeout=30, rate_limit=None, codec=None):
         self._api_key = api_key
+        self.codec = get_codec(codec)
+        self.log = logging.getLogger("bnetbot.capi")
         self.channel = None
         self.username = None
         self.last_message = None
-        self.users = {}
+        self.state = ChannelState()
+        self.users = self.state.roster
         self.endpoint = "wss://connect-bot.classic.blizzard.com/v1/rpc/chat"
 
         self._authenticating = False
         self._connected = False
         self._disconnecting = False
-        self._requests = {}
-        self._received_users = False
+        self._requests = RequestTable(request_timeout)
+        self.outbound = OutboundQueue.from_config(rate_limit)
+        self._outbound_ready = threading.Event()
+        self._sender = None
+        self._self_id = None
         self._socket = None
         self._thread = None
 
@@ -118,8 +183,8 @@ class CapiClient(EventSource):
             "Botapichat.SendWhisperResponse": self._handle_whisper_response
         }
 
-        client_events = ['joined_chat', 'user_joined', 'user_update', 'user_left', 'user_talk', 'bot_talk',
-                         'whisper_sent', 'whisper_received', 'user_emote', 'server_info', 'server_error',
+        client_events = ['joined_chat', 'channel_snapshot', 'user_joined', 'user_update', 'user_left', 'user_talk',
+                         'bot_talk', 'whisper_sent', 'whisper_received', 'user_emote', 'server_info', 'server_error',
                          'protocol_message_received', 'protocol_message_sent', 'left_chat', 'client_error']
         super().__init__(client_events)
 
@@ -143,6 +208,10 @@ class CapiClient(EventSource):
             self._thread = threading.Thread(target=self._receive)
             self._thread.setDaemon(True)
             self._thread.start()
+
+            self._sender = threading.Thread(target=self._run_sender, args=(self._socket,))
+            self._sender.setDaemon(True)
+            self._sender.start()
         except (websocket.WebSocketException, TimeoutError, ConnectionError) as ex:
             self.events['client_error'](self, ex)
 
@@ -154,15 +223,20 @@ class CapiClient(EventSource):
             - force will shutdown the socket immediately and reset state variables and should be used after a disconnect.
         """
         if force:
-            self._socket.shutdown()
+            self._close_transport()
             self._authenticating = False
             self._connected = False
             self._disconnecting = False
 
             self.last_message = None
             self.channel = None
-            self.users = {}
-            self._requests = {}
+            self.state.reset()
+            self._self_id = None
+
+            # Nothing sent or queued on this connection can be answered anymore.
+            for request in self._requests.clear() + self.outbound.clear():
+                request.cancel()
+            self._wake_sender()
         else:
             self._disconnecting = True
             self.send("Botapichat.DisconnectRequest")
@@ -171,15 +245,21 @@ class CapiClient(EventSource):
         """Returns an object representing the user identified by the given name or ID."""
         if isinstance(name, int):
             return self.users.get(name)
-        elif isinstance(name, str):
+        elif isinstance(name, str) and name:
             if name[0] == '*':
                 name = name[1:]
-
-            for user in self.users.values():
-                if user.name.lower() == name.lower():
-                    return user
+            return self.users.find(name)
+        elif isinstance(name, CapiUser):
+            return self.users.get(name.id)
         return None
 
+    def find_users(self, pattern):
+        """Returns the users in the channel whose names match a pattern.
+
+            - pattern: a name where '*' matches any characters and '?' matches a single character.
+        """
+        return self.users.match(pattern)
+
     def ping(self, payload=None):
         """Sends a websocket PING command to the server.
 
@@ -192,28 +272,58 @@ class CapiClient(EventSource):
             self.events['client_error'](self, ex)
             return False
 
-    def send(self, command, payload=None):
-        """Sends a command message to the server.
+    def send(self, command, payload=None, priority=None):
+        """Queues a command message to be sent to the server.
 
             - command: the API request name as defined the API docs.
             - payload: optional data sent with the request.
+            - priority: optional outbound lane (see outbound.PRIORITY_*). By default it's chosen from the command.
+            - Returns a PendingRequest future that resolves to the response message, or fails with a CapiError.
+
+            Messages are released by the outbound queue at the configured rate, so this never blocks. The request's
+            'id' is NONE until it leaves the queue, and a request retried after a rate limit error is sent with a new
+            one, so callers that log or match requests should use the PendingRequest itself rather than its ID.
         """
-        # Find the next available request ID.
-        # Values are reused once a response has been received with the same ID.
-        request_id = 1
-        while request_id in self._requests:
-            request_id += 1
-
-        data = {
-            "command": command,
-            "request_id": request_id,
-            "payload": payload or {}
-        }
+        request = self._requests.create(command, payload)
+        self.outbound.push(request, priority)
+        self._wake_sender()
+        return request
+
+    def flush_outbound(self):
+        """Sends every queued request the rate limit currently allows.
 
-        self._socket.send(json.dumps(data), websocket.ABNF.OPCODE_TEXT)
-        self.events['protocol_message_sent'](self, data)
-        self._requests[request_id] = data
-        return request_id
+            - Returns the number of seconds until the next request can be sent, or NONE if the queue is empty.
+        """
+        while True:
+            request, wait = self.outbound.pop()
+            if request is None:
+                return wait
+            self._transmit(request)
+
+    def _transmit(self, request):
+        self._requests.start(request)
+        try:
+            self._write(self.codec.encode(request.data))
+        except Exception as ex:
+            self._requests.pop(request.id)
+            if not request.cancelled():
+                request.set_exception(ex)
+            self.events['client_error'](self, ex)
+            return
+
+        # Skip the dispatch entirely when nothing is listening (usually because debug logging is off).
+        sent = self.events['protocol_message_sent']
+        if len(sent) > 0:
+            sent(self, request.data)
+        self._schedule_expiry(request.deadline)
+
+    def expire_requests(self):
+        """Fails any sent requests that haven't been answered before their deadline."""
+        for request in self._requests.expire():
+            error = CapiError.from_status({"area": 6, "code": 5}, "Request timed out: %s" % request.command)
+            if not request.cancelled():
+                request.set_exception(error)
+            self.events['client_error'](self, error)
 
     def chat(self, message, target=None):
         """Sends a chat message to the channel.
@@ -222,6 +332,7 @@ class CapiClient(EventSource):
             - target: optional username, ID, or user object to send a direct message or emote
 
             If target is the bot user, an /emote will be sent to the channel.
+            Returns the PendingRequest for the message, or FALSE if the target wasn't found.
         """
         command = "Botapichat.SendMessageRequest"
         payload = {"message": message}
@@ -252,6 +363,7 @@ class CapiClient(EventSource):
             - kick: optionally kicks the user instead of banning them
 
             Note: The API does not support banning users not in the channel.
+            Returns the PendingRequest for the kick/ban, or NONE if the user wasn't found.
         """
         user = self.get_user(target)
         if user:
@@ -277,9 +389,32 @@ class CapiClient(EventSource):
         if user:
             return self.send("Botapichat.SendSetModeratorRequest", {"user_id": user.id})
 
-    def _receive(self):
-        global STATUS_CODES, OPCODES
+    def _write(self, message):
+        """Writes a text frame to the socket."""
+        self._socket.send(message, websocket.ABNF.OPCODE_TEXT)
+
+    def _wake_sender(self):
+        """Called when a request is queued."""
+        self._outbound_ready.set()
+
+    def _run_sender(self, socket):
+        # Releases queued requests for the threaded client, until this socket is closed or replaced.
+        while self._socket is socket and self.connected():
+            self._outbound_ready.clear()
+            wait = self.flush_outbound()
+            self._outbound_ready.wait(wait)
+
+    def _schedule_expiry(self, deadline):
+        """Called after a request is sent. The threaded client expires requests as frames arrive, and when the
+            bot's connection monitor calls expire_requests()."""
+        pass
+
+    def _close_transport(self):
+        """Shuts down the socket without any protocol-level goodbye."""
+        if self._socket:
+            self._socket.shutdown()
 
+    def _receive(self):
         if not self.connected():
             if not self.connect():
                 return
@@ -287,57 +422,75 @@ class CapiClient(EventSource):
         self._authenticating = True
         self.send("Botapiauth.AuthenticateRequest", {"api_key": self._api_key})
 
-        # Receive and process incoming messages
-        while self.connected():
+        # Receive and process incoming messages, until this socket is closed or replaced.
+        socket = self._socket
+        while self._socket is socket and self.connected():
             try:
-                opcode, data = self._socket.recv_data(True)
-            except (websocket.WebSocketException, TimeoutError, ConnectionError) as ex:
+                opcode, data = socket.recv_data(True)
+            except (websocket.WebSocketException, OSError) as ex:
                 if isinstance(ex, websocket.WebSocketPayloadException):
                     # The API sometimes sends messages with invalid UTF-8. Ignore them.
                     continue
-                else:
+                elif self._socket is socket:
                     # Unknown error - force close socket
                     return self.disconnect(True)
+                return
 
-            # Record the message received time for keep-alive tracking
-            self.last_message = datetime.now()
+            self._process_frame(opcode, data)
 
-            if opcode != websocket.ABNF.OPCODE_TEXT:
-                # These are just control messages and can be ignored.
-                continue
+    def _process_frame(self, opcode, data):
+        """Handles a single frame received from the server, regardless of the transport that read it."""
+        # Record the message received time for keep-alive tracking
+        self.last_message = datetime.now()
+        self.expire_requests()
 
-            try:
-                message = data.decode('utf-8')
-                data = json.loads(message)
-                self.events['protocol_message_received'](self, data)
-            except json.JSONDecodeError:
-                # Corrupt message but just ignore it (the API is in alpha after all!)
-                continue
-
-            if isinstance(data, dict):
-                request_id = data.get("request_id")
-                command = data.get("command")
-                status = data.get("status")
-                payload = data.get("payload")
-
-                # Parse the optionally returned error status
-                error = None
-                if status and isinstance(status, dict):
-                    error = CapiError.from_status(status)
-
-                # Match this response to a sent request
-                request = None
-                if "Event" not in command:
-                    if request_id in self._requests:
-                        request = self._requests.get(request_id)
-                        del self._requests[request_id]
-
-                if command in self.message_handlers:
-                    try:
-                        self.message_handlers.get(command)(request, payload, error)
-                    except Exception as ex:
-                        print("ERROR! Something happened while processing received command '%s': %s" % (command, ex))
-                        print(traceback.format_exc())
+        if opcode != websocket.ABNF.OPCODE_TEXT:
+            # These are just control messages and can be ignored.
+            return
+
+        try:
+            data = self.codec.decode(data)
+        except self.codec.errors:
+            # Corrupt message but just ignore it (the API is in alpha after all!)
+            return
+
+        received = self.events['protocol_message_received']
+        if len(received) > 0:
+            received(self, data)
+
+        if isinstance(data, dict):
+            request_id = data.get("request_id")
+            command = data.get("command")
+            status = data.get("status")
+            payload = data.get("payload")
+
+            # Parse the optionally returned error status
+            error = None
+            if status and isinstance(status, dict):
+                error = CapiError.from_status(status)
+
+            # Match this response to a sent request
+            request = None
+            if "Event" not in command:
+                request = self._requests.pop(request_id)
+
+            # Re-send requests rejected by the server's flood protection, after backing off.
+            if request and error and error.area == 6 and error.code == 8 and self.outbound.retry(request):
+                self._wake_sender()
+                return
+
+            if command in self.message_handlers:
+                try:
+                    self.message_handlers.get(command)(request.data if request else None, payload, error)
+                except Exception:
+                    self.log.exception("Something happened while processing received command '%s'", command)
+
+            # Wake up anything waiting on the request.
+            if request and not request.cancelled():
+                if error:
+                    request.set_exception(error)
+                else:
+                    request.set_result(data)
 
     def _handle_auth_response(self, request, response, error):
         self._authenticating = False
@@ -354,6 +507,7 @@ class CapiClient(EventSource):
 
     def _handle_connect_event(self, request, response, error):
         self.channel = response.get("channel")
+        self.state.enter(self.channel)
         self.events['joined_chat'](self, self.channel, self.get_user(self.username))
 
     def _handle_disconnect_event(self, request, response, error):
@@ -366,52 +520,63 @@ class CapiClient(EventSource):
         attributes = response.get("attribute")  # [{"key":1,"value":2}, etc]
         flags = response.get("flag")
 
-        # Find or create the user described by this event.
-        user = self.get_user(user_id) or CapiUser(user_id, toon_name, flags, attributes)
+        existing = self.users.get(user_id)
+        if existing is None:
+            user = CapiUser(user_id, toon_name, flags, attributes)
+            self.state.join(user)
+            if not self.channel:
+                # We aren't yet in channel, so this should be our own info.
+                self.username = user.name
+                self._self_id = user.id
+            elif not self.state.loading:
+                self.events['user_joined'](self, user)
+            self._check_attributes(user, NO_ATTRIBUTES)
+            return
+
+        user = existing
+        if not (flags or attributes):
+            # The server repeats our own info with nothing in it once the initial user list has been sent.
+            if self.channel and user.id == self._self_id:
+                self._finish_user_list()
+            return
+
+        old_attributes = user.attributes
+        changes = False     # Make sure something has actually changed
+        if flags and user.set_flags(flags):
+            changes = True
+        if attributes and user.update(attributes):
+            changes = True
+
+        if changes:
+            self.state.update(user)
+            if self.channel and not self.state.loading:
+                self.events['user_update'](self, user, flags, attributes)
+        self._check_attributes(user, old_attributes)
 
-        if not self.channel:
-            # We aren't yet in channel, so this should be our own info.
-            self.username = user.name
-        else:
-            if user.id in self.users:
-                changes = False     # Make sure something has actually changed
-
-                if flags or attributes:
-                    if flags and user.flags != flags:
-                        changes = True
-                    elif attributes:
-                        old = user.attributes
-                        user.update(attributes)
-                        if user.attributes != old:
-                            changes = True
-                elif user.id == 1 and not self._received_users:
-                    self._received_users = True
-                    changes = True
-
-                if changes:
-                    self.events['user_update'](self, user, flags, attributes)
-            else:
-                if self._received_users:
-                    self.events['user_joined'](self, user)
-                else:
-                    self.events['user_update'](self, user, flags, attributes)
+    def _handle_user_leave_event(self, request, response, error):
+        self._finish_user_list()
+        user = self.state.leave(response.get("user_id"))
+        if user:
+            self.events['user_left'](self, user)
 
-        self.users[user.id] = user
+    def _finish_user_list(self):
+        # Individual events aren't fired for the initial user list - consumers get the whole roster at once.
+        if self.state.finish_loading():
+            version, users = self.state.snapshot()
+            self.events['channel_snapshot'](self, users, version)
 
+    def _check_attributes(self, user, old_attributes):
         # The attributes system isn't complete yet so alert the user to any abnormalities.
-        if user.attributes and len(user.attributes) > 0:
+        # Attributes are copy-on-write, so an unchanged object means there's nothing new to check.
+        if user.attributes is not old_attributes and len(user.attributes) > 0:
             pgm = user.attributes.get("ProgramId")
             if pgm and pgm not in ["W2BN", "SEXP"]:
-                print("NOTICE! Detected new ProgramID: %s" % pgm)
+                self.log.info("NOTICE! Detected new ProgramID: %s", pgm)
             if len(user.attributes) > 1 or pgm is None:
-                print("NOTICE! Detected new attributes: %s" % user.attributes)
-
-    def _handle_user_leave_event(self, request, response, error):
-        user = self.get_user(response.get("user_id"))
-        del self.users[user.id]
-        self.events['user_left'](self, user)
+                self.log.info("NOTICE! Detected new attributes: %s", user.attributes)
 
     def _handle_message_event(self, request, response, error):
+        self._finish_user_list()
         user = self.get_user(response.get("user_id"))
         mtype = response.get("type")
         message = response.get("message")
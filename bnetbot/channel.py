@@ -0,0 +1,216 @@
+
+from bisect import bisect_left, insort
+from collections import deque
+from collections.abc import MutableMapping
+import itertools
+import re
+
+
+def name_key(name):
+    """Returns the lookup key for a user name. Names are compared case-insensitively."""
+    return name.lower()
+
+
+def compile_wildcard(pattern):
+    """Compiles a name pattern where '*' matches any run of characters and '?' matches one character.
+
+        Every other character is literal, including the '[' and ']' common in clan tags.
+    """
+    parts = []
+    for ch in name_key(pattern):
+        if ch == '*':
+            parts.append(".*")
+        elif ch == '?':
+            parts.append(".")
+        else:
+            parts.append(re.escape(ch))
+    return re.compile(''.join(parts), re.DOTALL)
+
+
+class ChannelRoster(MutableMapping):
+    """The users in a channel, indexed by both user ID and name.
+
+        It behaves like a dict of user ID -> CapiUser, and also keeps a case-insensitive name index and a sorted
+        list of names so that name, prefix and wildcard lookups don't have to walk every user.
+    """
+    def __init__(self):
+        self._by_id = {}
+        self._by_name = {}
+        self._sorted_names = []
+
+    def __getitem__(self, user_id):
+        return self._by_id[user_id]
+
+    def __setitem__(self, user_id, user):
+        old = self._by_id.get(user_id)
+        if old is not None:
+            self._unindex(old)
+
+        self._by_id[user_id] = user
+        key = name_key(user.name)
+        self._by_name[key] = user
+        insort(self._sorted_names, key)
+
+    def __delitem__(self, user_id):
+        self._unindex(self._by_id.pop(user_id))
+
+    def __iter__(self):
+        return iter(self._by_id)
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __contains__(self, user_id):
+        return user_id in self._by_id
+
+    def clear(self):
+        self._by_id.clear()
+        self._by_name.clear()
+        self._sorted_names = []
+
+    def add(self, user):
+        """Adds or replaces a user, keyed on its ID."""
+        self[user.id] = user
+        return user
+
+    def find(self, name):
+        """Returns the user with the given name (case-insensitive), or NONE."""
+        return self._by_name.get(name_key(name))
+
+    def find_prefix(self, prefix):
+        """Returns the users whose name starts with 'prefix' (case-insensitive), in name order."""
+        prefix = name_key(prefix)
+        names = self._sorted_names
+        result = []
+        for i in range(bisect_left(names, prefix), len(names)):
+            if not names[i].startswith(prefix):
+                break
+            result.append(self._by_name[names[i]])
+        return result
+
+    def match(self, pattern):
+        """Returns the users whose name matches a wildcard pattern ('*' and '?'), in name order.
+
+            The literal part of the pattern before the first wildcard is used to narrow the search.
+        """
+        cut = min([i for i in (pattern.find('*'), pattern.find('?')) if i >= 0], default=-1)
+        if cut < 0:
+            user = self.find(pattern)
+            return [user] if user else []
+
+        regex = compile_wildcard(pattern)
+        return [user for user in self.find_prefix(pattern[:cut]) if regex.fullmatch(name_key(user.name))]
+
+    def _unindex(self, user):
+        key = name_key(user.name)
+        if self._by_name.get(key) is user:
+            del self._by_name[key]
+            names = self._sorted_names
+            i = bisect_left(names, key)
+            if i < len(names) and names[i] == key:
+                del names[i]
+
+
+# Kinds of channel change
+CHANGE_JOIN = "join"
+CHANGE_UPDATE = "update"
+CHANGE_LEAVE = "leave"
+
+
+class ChannelChange:
+    """A single change to the channel roster.
+
+        - version: the state version this change produced
+        - kind: CHANGE_JOIN, CHANGE_UPDATE or CHANGE_LEAVE
+        - user: the CapiUser that joined, changed or left
+    """
+    __slots__ = ('version', 'kind', 'user')
+
+    def __init__(self, version, kind, user):
+        self.version = version
+        self.kind = kind
+        self.user = user
+
+    def __repr__(self):
+        return "<ChannelChange %i %s %s>" % (self.version, self.kind, self.user.name)
+
+
+class ChannelState:
+    """The versioned state of the current channel.
+
+        Every join, update and leave is applied as a change that bumps the version and is kept in a bounded log,
+        so consumers can remember a version and later ask for only the changes made since then.
+
+        - history: the number of changes to keep. Older versions need a full snapshot to catch up.
+    """
+    def __init__(self, history=1024):
+        self.roster = ChannelRoster()
+        self.channel = None
+        self.version = 0
+        self.loading = False        # TRUE while the initial user list is being received
+        self._changes = deque(maxlen=history)
+
+    def reset(self):
+        """Forgets the channel and every user in it."""
+        self.roster.clear()
+        self.channel = None
+        self.loading = False
+        self._changes.clear()
+        self.version += 1
+
+    def enter(self, channel):
+        """Starts a new channel. Users received until finish_loading() is called are part of the initial list."""
+        self.channel = channel
+        self.loading = True
+        self.version += 1
+        self._changes.clear()   # Changes from before the channel was entered can't be caught up on
+
+    def finish_loading(self):
+        """Ends the initial user list. Returns TRUE if it was still loading."""
+        if not self.loading:
+            return False
+        self.loading = False
+        return True
+
+    def join(self, user):
+        """Adds a user to the roster."""
+        self.roster.add(user)
+        return self._record(CHANGE_JOIN, user)
+
+    def update(self, user):
+        """Records that a user already in the roster has changed."""
+        return self._record(CHANGE_UPDATE, user)
+
+    def leave(self, user_id):
+        """Removes a user from the roster. Returns the user, or NONE if they weren't in it."""
+        user = self.roster.pop(user_id, None)
+        if user is not None:
+            self._record(CHANGE_LEAVE, user)
+        return user
+
+    def snapshot(self):
+        """Returns (version, list of users) for the current roster."""
+        return self.version, list(self.roster.values())
+
+    def changes_since(self, version):
+        """Returns the changes made after 'version', oldest first.
+
+            Returns NONE if some of those changes are no longer kept (or the channel was reset since then), in which
+            case the caller should take a new snapshot().
+        """
+        if version >= self.version:
+            return []
+
+        changes = self._changes
+        if not changes or changes[0].version > version + 1:
+            return None
+
+        # Versions in the log are consecutive, so the first change we need is at a known offset.
+        start = version + 1 - changes[0].version
+        return list(itertools.islice(changes, start, None))
+
+    def _record(self, kind, user):
+        self.version += 1
+        change = ChannelChange(self.version, kind, user)
+        self._changes.append(change)
+        return change
@@ -1,7 +1,10 @@
 
 from .database import DatabaseItem
+from .router import split_args
+from . import transfer
 
 from datetime import datetime
+import sys
 
 
 # Command instance sources
@@ -11,6 +14,23 @@ SOURCE_LOCAL = 3        # In bot console
 SOURCE_INTERNAL = 4     # Automatic execution
 
 
+def cacheable(ttl, per_user=False):
+    """Marks a command's function as safe to answer from the instance's result cache for 'ttl' seconds.
+
+        Responses are cached by command, arguments and source, and are dropped early when a user named in the
+        arguments (or the user who ran it) changes in the channel, or when anything in the user database changes.
+
+        Cacheable commands also run without holding the database lock, so they must only read the database.
+
+        - per_user: TRUE if the response depends on who ran the command
+    """
+    def decorate(callback):
+        callback.cache_ttl = ttl
+        callback.cache_per_user = per_user
+        return callback
+    return decorate
+
+
 class CommandDefinition:
     """Object linking a command name with its required permissions and function."""
     def __init__(self, command, permission, callback):
@@ -18,6 +38,15 @@ class CommandDefinition:
         self.permission = permission
         self.callback = callback
 
+    # Read from the callback each time, since a plugin's function isn't known until the plugin is imported.
+    @property
+    def cache_ttl(self):
+        return getattr(self.callback, "cache_ttl", None)
+
+    @property
+    def cache_per_user(self):
+        return getattr(self.callback, "cache_per_user", False)
+
 
 class CommandInstance:
     """A request to execute a command.
@@ -27,18 +56,35 @@ class CommandInstance:
         source: the context from where the command was executed
         trigger: the trigger character or phrase used
         bot: the bot instance where the command was triggered
+        text: the rest of the message after the command name, split into args when they're first used
     """
-    def __init__(self, command, bot, args=None, source=None, trigger=None):
+    def __init__(self, command, bot, args=None, source=None, trigger=None, text=None):
         self.command = command
-        self.args = args or []
+        self.text = text
+        self._args = args
         self.source = source or SOURCE_INTERNAL
         self.trigger = trigger
         self.response = []
+        self.sent = []          # Lines of the response that have been sent
         self.bot = bot
         self.user = None
 
+    @property
+    def args(self):
+        if self._args is None:
+            self._args = split_args(self.text) if self.text else []
+        return self._args
+
+    @args.setter
+    def args(self, value):
+        self._args = value
+
     def respond(self, text=None):
-        """Sends the response text to the command source."""
+        """Sends the response text to the command source.
+
+            Lines added to 'response' since the last call are sent together, packed into as few chat messages as
+            possible. Console responses are written out in one go.
+        """
         if text:
             self.response.append(text)
 
@@ -46,11 +92,13 @@ class CommandInstance:
             raise Exception("Attempted to send empty command response. Command: %s, User: %s" %
                             (self.command, self.user.name))
 
+        lines, self.response = self.response, []
+        self.sent.extend(lines)
         if self.source == SOURCE_LOCAL:
-            for msg in self.response:
-                print(msg)
+            sys.stdout.write("\n".join(lines) + "\n")
+            sys.stdout.flush()
         else:
-            self.bot.send(self.response, self.user.name if self.source == SOURCE_PRIVATE else None)
+            self.bot.send(lines, self.user.name if self.source == SOURCE_PRIVATE else None)
 
     def is_console(self):
         """Returns if the command was executed from the bot console or internally."""
@@ -60,9 +108,49 @@ class CommandInstance:
 class AdminCommands:
     def __init__(self):
         self.commands = [
-            ("perms", "commands.admin.perms", AdminCommands.perms)
+            ("export", "commands.admin.export", AdminCommands.export_database),
+            ("import", "commands.admin.import", AdminCommands.import_database),
+            ("perms", "commands.admin.perms", AdminCommands.perms),
+            ("plugins", "commands.admin.plugins", AdminCommands.plugins)
         ]
 
+    @staticmethod
+    def export_database(c):
+        """Writes the bot instance's users and groups to a JSONL or CSV file."""
+        if not c.is_console():
+            return c.respond("That command can only be used from the bot console.")
+        elif len(c.args) not in [1, 2] or (len(c.args) == 2 and c.args[1].lower() not in transfer.FORMATS):
+            return c.respond("Invalid syntax: %s%s <file> [%s]" % (c.trigger, c.command, "|".join(transfer.FORMATS)))
+
+        path = c.args[0]
+        fmt = c.args[1].lower() if len(c.args) > 1 else transfer.guess_format(path)
+        try:
+            with open(path, "w", newline="", encoding="utf-8") as fh:
+                count = transfer.export_file(c.bot.database, fh, fmt,
+                                             progress=lambda n: c.bot.log.info("Exported %i entries...", n))
+        except OSError as ex:
+            return c.respond("Unable to write '%s': %s" % (path, ex.strerror))
+        c.respond("Exported %i entries to '%s'." % (count, path))
+
+    @staticmethod
+    def import_database(c):
+        """Adds or replaces users and groups from a JSONL or CSV file, in batches."""
+        if not c.is_console():
+            return c.respond("That command can only be used from the bot console.")
+        elif len(c.args) not in [1, 2] or (len(c.args) == 2 and c.args[1].lower() not in transfer.FORMATS):
+            return c.respond("Invalid syntax: %s%s <file> [%s]" % (c.trigger, c.command, "|".join(transfer.FORMATS)))
+
+        path = c.args[0]
+        fmt = c.args[1].lower() if len(c.args) > 1 else transfer.guess_format(path)
+        try:
+            with open(path, "r", newline="", encoding="utf-8") as fh:
+                imported, skipped = transfer.import_file(c.bot.database, fh, fmt, flush=c.bot.save,
+                                                         progress=lambda n, s: c.bot.log.info(
+                                                             "Imported %i entries (%i skipped)...", n, s))
+        except OSError as ex:
+            return c.respond("Unable to read '%s': %s" % (path, ex.strerror))
+        c.respond("Imported %i entries from '%s' (%i skipped)." % (imported, path, skipped))
+
     @staticmethod
     def perms(c):
         """Manages database permissions for the bot instance."""
@@ -161,6 +249,29 @@ class AdminCommands:
         # Save changes to the config
         c.bot.save()
 
+    @staticmethod
+    def plugins(c):
+        """Lists the command plugins, or reloads one or all of them."""
+        manager = c.bot.plugins
+        if manager is None:
+            return c.respond("Plugins are not available.")
+        elif not c.args:
+            if not manager.plugins:
+                return c.respond("No plugins found.")
+            return c.respond("Plugins: %s" % ", ".join("%s (%s)" % (p.name, "loaded" if p.loaded else "not loaded")
+                                                        for p in manager.plugins.values()))
+        elif c.args[0].lower() != "reload" or len(c.args) > 2:
+            return c.respond("Invalid syntax: %s%s [reload [plugin]]" % (c.trigger, c.command))
+
+        reloaded = manager.reload(c.args[1] if len(c.args) > 1 else None)
+        if reloaded is None:
+            c.respond("Plugin '%s' not found." % c.args[1])
+        elif len(c.args) > 1 and not reloaded:
+            c.respond("Plugin '%s' could not be reloaded, so the old version is still in use - see the log for "
+                      "details." % c.args[1])
+        else:
+            c.respond("Reloaded %i plugin(s)." % len(reloaded))
+
 
 class InternalCommands:
     def __init__(self):
@@ -194,6 +305,7 @@ class InternalCommands:
                   (days, hours, minutes, seconds, c.bot.client.uptime .strftime("%a, %b %w %Y at %I:%M %p")))
 
     @staticmethod
+    @cacheable(30, per_user=True)
     def whoami(c):
         """Identifies the user issuing the command."""
         if c.is_console():
@@ -206,6 +318,7 @@ class InternalCommands:
             InternalCommands.whois(c)
 
     @staticmethod
+    @cacheable(30)
     def whois(c):
         """Identifies a user."""
         if len(c.args) != 1:
@@ -223,7 +336,7 @@ class InternalCommands:
             elif db_user is None:
                 # User in the channel but not in the database.
                 c.respond("Found '%s' in the channel with flags %s and attributes %s." %
-                          (ch_user.name, ch_user.flags, ch_user.attributes))
+                          (ch_user.name, list(ch_user.flags), ch_user.attributes))
             else:
                 # User is in the database.
                 perms = len(db_user.get_permissions())
@@ -236,7 +349,7 @@ class InternalCommands:
                 else:
                     # User both in the channel and database.
                     c.response.append("Found '%s' in the channel with flags %s, attributes %s, and in the database " %
-                                      (ch_user.name, ch_user.flags, ch_user.attributes))
+                                      (ch_user.name, list(ch_user.flags), ch_user.attributes))
                     c.response[0] += "with groups %s and %i permission(s)." % (groups, perms)
                     c.respond()
 
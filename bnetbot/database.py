@@ -1,6 +1,12 @@
 
+from .permissions import PermissionMap
+
+from contextlib import contextmanager
 from datetime import datetime
-import re
+import gc
+import logging
+import threading
+import weakref
 
 
 def get_default_groups():
@@ -19,14 +25,79 @@ def get_default_users():
     }
 
 
+# Counts changes to users and groups in any database, so results worked out from them can tell when they're stale.
+_changes = 0
+_changes_lock = threading.Lock()
+
+
+def mark_changed():
+    """Records that a user or group was added, removed or changed."""
+    global _changes
+    with _changes_lock:
+        _changes += 1
+
+
+def change_count():
+    """Returns a number that's different after any change to any user database."""
+    return _changes
+
+
+# Allocations between young collections while a database is loaded (see loading_items)
+LOAD_GC_THRESHOLD = 50000
+
+_loading_lock = threading.Lock()
+_loading = 0                # Loads in progress
+_gc_threshold = None        # The first collector threshold from before they started
+
+
+@contextmanager
+def loading_items():
+    """Makes the garbage collector run less often while lots of long-lived items are created.
+
+        Used while a database is loaded or copied for saving. Every item is kept, so collecting while they're
+        created only costs time - over half of it for large databases. The collector keeps running, just less often, and its setting is put back once the last load
+        that's running at the same time has finished.
+    """
+    global _loading, _gc_threshold
+    with _loading_lock:
+        if _loading == 0:
+            thresholds = gc.get_threshold()
+            _gc_threshold = thresholds[0]
+            gc.set_threshold(max(LOAD_GC_THRESHOLD, _gc_threshold), *thresholds[1:])
+        _loading += 1
+    try:
+        yield
+    finally:
+        with _loading_lock:
+            _loading -= 1
+            if _loading == 0:
+                gc.set_threshold(_gc_threshold, *gc.get_threshold()[1:])
+
+
 def parse_isoformat(s):
-    return datetime.strptime(s, "%Y-%m-%dT%H:%M:%S.%f") if s else None
+    if not s:
+        return None
+    # isoformat() leaves out the microseconds when there are none.
+    return datetime.strptime(s, "%Y-%m-%dT%H:%M:%S.%f" if '.' in s else "%Y-%m-%dT%H:%M:%S")
+
+
+def format_isoformat(value):
+    """Returns a timestamp as an ISO 8601 string. Timestamps that haven't been parsed yet are returned as they are."""
+    if value is None or isinstance(value, str):
+        return value
+    return value.isoformat()
 
 
 class UserDatabase:
+    """The users and groups of an instance, kept in memory and saved as part of the config.
+
+        Commands that change the database hold 'lock' while they run (see BotInstance.execute_command), so changes
+        from different threads are made one at a time. Lookups don't need it.
+    """
     def __init__(self):
         self.groups = get_default_groups()
         self.users = get_default_users()
+        self.lock = threading.RLock()
 
     def __dict__(self):
         return {
@@ -34,6 +105,22 @@ class UserDatabase:
             "users": self.users.items()
         }
 
+    def to_config(self):
+        """Returns the database as a JSON-compatible 'database' element for an instance's configuration.
+
+            The result is a copy, so it can be saved while the database changes. Hold 'lock' while calling this so
+            no command is halfway through a change.
+        """
+        with loading_items():
+            return {
+                "groups": {item.name: item.to_config() for item in list(self.groups.values())},
+                "users": {item.name: item.to_config() for item in list(self.users.values())}
+            }
+
+    def commit(self):
+        """Writes pending changes. The JSON database is saved as part of the config, so there's nothing to do."""
+        return 0
+
     def add(self, item):
         """Adds a user object to the database."""
         if not isinstance(item, DatabaseItem):
@@ -43,6 +130,7 @@ class UserDatabase:
             self.groups[item.name.lower()] = item
         else:
             self.users[item.name.lower()] = item
+        mark_changed()
         return item
 
     def remove(self, item):
@@ -54,22 +142,66 @@ class UserDatabase:
             del self.groups[item.name.lower()]
         else:
             del self.users[item.name.lower()]
+        mark_changed()
         return None
 
     def user(self, username):
         """Returns a user object matching a given name."""
         return self.users.get(username.lower())
 
+    def entries(self):
+        """Yields (is_group, name, entry) for every group and then every user, where entry is its database entry."""
+        for item in list(self.groups.values()):
+            yield True, item.name, item.to_config()
+        for item in list(self.users.values()):
+            yield False, item.name, item.to_config()
+
+    def import_entries(self, entries, groups=None):
+        """Adds or replaces users and groups from database entries. Returns the number imported.
+
+            Groups are imported before users, so users can be linked to groups in the same call. A group that
+            already exists is updated in place to keep its members. Entries that would create a cycle of groups
+            are skipped with a warning.
+
+            - entries: list of (is_group, name, entry) tuples
+            - groups: dict of lower-cased name -> group to link the entries to (default: this database's groups)
+        """
+        count = 0
+        for is_group, name, entry in sorted(entries, key=lambda e: not e[0]):
+            item = DatabaseItem.load(entry, name, is_group, self.groups if groups is None else groups)
+            existing = self.groups.get(name.lower()) if is_group else None
+            try:
+                if existing is None:
+                    self.add(item)
+                else:
+                    existing.assign(item)
+                count += 1
+            except ValueError as ex:
+                logging.getLogger("bnetbot").warning("Skipping imported group '%s': %s", name, ex)
+        return count
+
     def group(self, group_name):
         """Returns a group object matching a given name."""
         return self.groups.get(group_name.lower())
 
     @classmethod
-    def load(cls, config):
-        """Loads a user database from the 'database' element of an instance's configuration."""
+    def load(cls, config, databases=None):
+        """Loads a user database from the 'database' element of an instance's configuration.
+
+            If the element has a 'sqlite' key, the database is kept in that SQLite file instead. If it has a 'shared'
+            key, it's a view of that shared database with the rest of the element on top of it.
+
+            - databases: the SharedDatabases to find shared databases in (default: a new, empty set)
+        """
         db = UserDatabase()
         if config is None:
             return db  # No database found in config - return empty
+        elif "sqlite" in config:
+            from .sqlitedb import SqliteUserDatabase
+            return SqliteUserDatabase.load(config)
+        elif "shared" in config:
+            from .shareddb import OverlayUserDatabase, SharedDatabases
+            return OverlayUserDatabase.load(config, databases or SharedDatabases())
 
         # Load group names and metadata
         group_list = config.get("groups", {})
@@ -81,84 +213,324 @@ class UserDatabase:
             item = db.groups[name.lower()]
 
             for group_name in [gp.lower() for gp in group.get("groups", [])]:
-                item.groups[group_name] = db.groups.get(group_name)
+                try:
+                    item.groups.link(group_name, db.groups.get(group_name))
+                except ValueError as ex:
+                    logging.getLogger("bnetbot").warning("Ignoring database group link: %s", ex)
+
+        # Load users, linking their groups as they're created.
+        users = db.users
+        groups = db.groups
+        links = {}
+        with loading_items():
+            for name, user in config.get("users", {}).items():
+                users[name.lower()] = DatabaseItem.load(user, name, False, groups, links)
 
-        # Load users
-        for name, user in config.get("users", {}).items():
-            item = DatabaseItem.load(user, name, False)
-            db.users[name.lower()] = item
+        return db
 
-            # Link user groups
-            for group_name in [gp.lower() for gp in user.get("groups", [])]:
-                item.groups[group_name] = db.groups.get(group_name)
 
-        return db
+class GroupMap(dict):
+    """The groups an item is a member of: a dict of lower-cased group name -> DatabaseItem (or NONE if missing).
+
+        Changes keep each group's list of members up to date and clear the cached permissions of the item and
+        everything that inherits from it. Adding a group that already inherits from the item raises ValueError.
+    """
+    __slots__ = ('owner',)
+
+    def __init__(self, owner, links=()):
+        super().__init__(links)
+        self.owner = owner
+
+    def __setitem__(self, key, group):
+        self.link(key, group, True)
+
+    def link(self, key, group, changed=False):
+        """Sets a group like 'groups[key] = group' does, but by default without counting it as a database change.
+
+            Used to link the groups of items as they're loaded, which shouldn't drop results cached elsewhere.
+        """
+        owner = self.owner
+        # Only an item with members can end up inheriting from itself.
+        if group is not None and (group is owner or (owner._members and owner in group.closure())):
+            raise ValueError("Adding group '%s' to '%s' would create a cycle." % (group.name, owner.name))
+
+        old = self.get(key)
+        super().__setitem__(key, group)
+        if old is not None and old is not group:
+            old._remove_member(owner)
+        if group is not None:
+            group._add_member(owner)
+        owner.invalidate(changed)
+
+    def __delitem__(self, key):
+        old = self[key]
+        super().__delitem__(key)
+        if old is not None:
+            old._remove_member(self.owner)
+        self.owner.invalidate()
+
+    def clear(self):
+        for key in list(self):
+            del self[key]
+
+    def pop(self, key, *default):
+        if key not in self:
+            return super().pop(key, *default)
+        group = self[key]
+        del self[key]
+        return group
+
+    def popitem(self):
+        key = next(reversed(list(self)))
+        return key, self.pop(key)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, group in dict(*args, **kwargs).items():
+            self[key] = group
+
+
+# Shared by items with no groups or permissions until they're accessed. Changes always go through a GroupMap or
+#   PermissionMap created on access, so these are never modified.
+NO_GROUPS = {}
+NO_PERMISSIONS = {}
 
 
 class DatabaseItem:
+    """A user or group in the user database.
+
+        Most loaded users are never looked at, so loading only does the minimum: timestamps are kept as strings
+        until they're first used, and the permissions and groups dicts are only wrapped in the classes that track
+        changes to them when they're first accessed.
+    """
+    __slots__ = ('name', 'is_group', 'modified_by', '_permissions', '_groups', '_members', '_added', '_modified',
+                 '_closure', '_effective', '_checks', '__weakref__')
+
     def __init__(self, name, is_group, permissions=None):
         self.name = name
         self.is_group = is_group
-        self.permissions = {p: True for p in permissions} if permissions else {}
-        self.groups = {}
-        self.added = datetime.now()
-        self.modified = None
         self.modified_by = None
+        self._members = None        # id(item) -> weak reference, for items that are members of this group
+        self._closure = None        # Cached results, cleared by invalidate()
+        self._effective = None
+        self._checks = None
+        self._permissions = {p: True for p in permissions} if permissions else NO_PERMISSIONS
+        self._groups = NO_GROUPS
+        self._added = datetime.now()
+        self._modified = None
+
+    @property
+    def permissions(self):
+        """Dict of permission pattern -> allowed. Changes to it are picked up by check_permission()."""
+        permissions = self._permissions
+        if type(permissions) is not PermissionMap:
+            permissions = self._permissions = PermissionMap(permissions)
+            permissions.owner = self
+        return permissions
+
+    @permissions.setter
+    def permissions(self, value):
+        self._permissions = value if isinstance(value, PermissionMap) else PermissionMap(value)
+        self._permissions.owner = self
+        self.invalidate()
+
+    @property
+    def groups(self):
+        """Dict of lower-cased group name -> group item that this item inherits permissions from."""
+        groups = self._groups
+        if type(groups) is not GroupMap:
+            groups = self._groups = GroupMap(self, groups)
+        return groups
+
+    @groups.setter
+    def groups(self, value):
+        groups = self.groups
+        groups.clear()
+        groups.update(value)
+
+    @property
+    def members(self):
+        """The items that are direct members of this group."""
+        if not self._members:
+            return []
+        return [item for item in (ref() for ref in self._members.values()) if item is not None]
+
+    @property
+    def added(self):
+        value = self._added
+        if isinstance(value, str):
+            value = self._added = parse_isoformat(value)
+        return value
+
+    @added.setter
+    def added(self, value):
+        self._added = value
+
+    @property
+    def modified(self):
+        value = self._modified
+        if isinstance(value, str):
+            value = self._modified = parse_isoformat(value)
+        return value
+
+    @modified.setter
+    def modified(self, value):
+        self._modified = value
 
     def __dict__(self):
         d = {
-            "permissions": self.permissions or {},
-            "added": self.added.isoformat() if self.added else None,
-            "modified": self.modified.isoformat() if self.modified else None,
+            "permissions": dict(self._permissions),
+            "added": format_isoformat(self._added),
+            "modified": format_isoformat(self._modified),
             "modified_by": self.modified_by
         }
         return {k: v for k, v in d.items() if v}
 
+    def to_config(self):
+        """Returns the item as a JSON-compatible database entry, including its group memberships."""
+        d = self.__dict__()
+        # Read without wrapping the groups in a GroupMap, so saving doesn't set up every user for changes.
+        groups = tuple(self._groups.items())
+        if groups:
+            d["groups"] = [group.name if group else name for name, group in groups]
+        return d
+
     def check_permission(self, permission):
         """Checks that the item has a permission."""
         permission = permission.lower()
-
-        # Check for permission provided by a group assignment
-        group_perm = False
-        for group in filter(None, self.groups.values()):
-            if group.check_permission(permission):
-                # Permission allowed by a group
-                group_perm = True
-                break
-
-        # Check for permission defined directly
-        direct_perm = False
-        for perm, value in self.permissions.items():
-            if re.fullmatch(perm.replace(".", "\\.").replace("*", ".*"), permission):
-                direct_perm = value
-                if not value:
-                    # Permission explicitly denied
-                    return False
-
-        return group_perm or direct_perm
+        checks = self._checks
+        if checks is None:
+            checks = self._checks = {}
+
+        result = checks.get(permission)
+        if result is None:
+            # Check for permission defined directly. An explicit deny overrides anything granted by a group.
+            result = self.permissions.matcher().check(permission)
+            if result is None:
+                # Check for permission provided by a group assignment
+                result = any(group.check_permission(permission) for group in self._linked_groups())
+            checks[permission] = result
+        return result
 
     def get_permissions(self):
         """Returns the effective permission of this item, including permissions of parent groups."""
-        perms = []
-        for group in filter(None, self.groups.values()):
-            perms.extend(group.get_permissions())
-        for perm, value in self.permissions.items():
-            if value:
-                perms.append(perm)
-            elif perm in perms:
-                perms.remove(perm)
-        return list(set(perms))
+        if self._effective is None:
+            perms = set()
+            for group in self._linked_groups():
+                perms.update(group.get_permissions())
+            for perm, value in dict(self._permissions).items():
+                if value:
+                    perms.add(perm)
+                else:
+                    perms.discard(perm)
+            self._effective = frozenset(perms)
+        return list(self._effective)
+
+    def closure(self):
+        """Returns every group this item inherits from, directly or through other groups, nearest first."""
+        if self._closure is None:
+            groups = []
+            seen = set()
+            for group in self._linked_groups():
+                for item in (group,) + group.closure():
+                    if id(item) not in seen:
+                        seen.add(id(item))
+                        groups.append(item)
+            self._closure = tuple(groups)
+        return self._closure
+
+    def _linked_groups(self):
+        # Copied in one step before it's iterated, since permissions can be checked while another thread changes
+        #   the item's groups.
+        return [group for group in tuple(self._groups.values()) if group is not None]
+
+    def invalidate(self, changed=True):
+        """Clears the cached permission results of this item and every item that inherits from it.
+
+            - changed: FALSE if the item is only being set up (e.g. linked to its groups as it's loaded), so results
+                cached from the database elsewhere are still correct
+        """
+        if changed:
+            mark_changed()
+        pending = [self]
+        while pending:
+            item = pending.pop()
+            if item._closure is None and item._effective is None and item._checks is None:
+                # Results are only cached after those of the groups they depend on, so if this item has nothing
+                # cached then neither do its members.
+                continue
+            item._closure = item._effective = item._checks = None
+            if item._members:
+                pending.extend(item.members)
 
     def group_list(self):
         """Returns a list of groups this item is member to."""
         return [g.name for g in self.groups.values()]
 
+    def assign(self, item):
+        """Replaces the permissions, groups and other details of this item with those of another.
+
+            Raises ValueError without changing anything if one of the other item's groups inherits from this one.
+        """
+        groups = dict(item._groups)
+        for group in filter(None, groups.values()):
+            if group is self or self in group.closure():
+                raise ValueError("Adding group '%s' to '%s' would create a cycle." % (group.name, self.name))
+
+        self.groups = groups
+        self.permissions = dict(item._permissions)
+        self.modified_by = item.modified_by
+        self._added = item._added
+        self._modified = item._modified
+
+    def _add_member(self, item):
+        # Plain weak references are much cheaper to create than a WeakSet entry. References to items that no longer
+        # exist are skipped by 'members', and overwritten if their ID is reused.
+        if self._members is None:
+            self._members = {}
+        self._members[id(item)] = weakref.ref(item)
+
+    def _remove_member(self, item):
+        if self._members is not None:
+            self._members.pop(id(item), None)
+
     @classmethod
-    def load(cls, data, name, is_group):
-        """Creates an item from a database entry."""
-        item = DatabaseItem(name, is_group)
-        item.permissions = data.get("permissions", {})
-        item.added = parse_isoformat(data.get("added")) or datetime.now()
-        item.modified = parse_isoformat(data.get("modified"))
+    def load(cls, data, name, is_group, groups=None, shared_links=None):
+        """Creates an item from a database entry.
+
+            - groups: optional dict of lower-cased name -> group to link the item's groups to. A new item can't be
+                part of a cycle, so they're linked directly without the checks made when changing groups later.
+            - shared_links: optional dict that items loaded together keep their group links in. Items in the same
+                groups share one links dict, like NO_GROUPS, until their groups are first accessed.
+        """
+        # Databases can have a lot of users, so the fields are set directly instead of going through __init__().
+        item = cls.__new__(cls)
+        item.name = name
+        item.is_group = is_group
         item.modified_by = data.get("modified_by")
+        item._members = item._closure = item._effective = item._checks = None
+        item._permissions = data.get("permissions") or NO_PERMISSIONS
+        item._groups = NO_GROUPS
+        item._added = data.get("added") or datetime.now()
+        item._modified = data.get("modified")
+
+        group_names = data.get("groups")
+        if groups is not None and group_names:
+            links = None if shared_links is None else shared_links.get(tuple(group_names))
+            if links is None:
+                links = {}
+                for group_name in group_names:
+                    key = group_name.lower()
+                    links[key] = groups.get(key)
+                if shared_links is not None:
+                    shared_links[tuple(group_names)] = links
+
+            item._groups = links
+            for group in links.values():
+                if group is not None:
+                    group._add_member(item)
         return item
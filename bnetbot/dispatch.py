@@ -0,0 +1,188 @@
+
+from .util.ratelimit import RateLimitTable
+
+from collections import deque
+import logging
+import threading
+
+
+# What to do with a command when the queue is full
+OVERLOAD_DROP = "drop"      # Ignore it
+OVERLOAD_BUSY = "busy"      # Tell the user the bot is busy
+
+# Default settings for the 'command_queue' section of an instance's config
+DEFAULT_COMMAND_QUEUE = {
+    "max_pending": 50,      # Commands waiting or running for the instance
+    "max_per_user": 3,      # Commands waiting or running for each user
+    "overload": OVERLOAD_DROP,
+    "busy_interval": 30.0   # Seconds between telling the same user that their commands are being dropped
+}
+
+# Default settings for the 'flood_limit' section of an instance's config
+DEFAULT_FLOOD_LIMIT = {
+    "rate": 0.2,            # Commands per second each user can run, for each command...
+    "burst": 3,             # ... after running this many at once
+    "size": 4096,           # Users and commands to keep track of
+    "commands": {}          # Command name -> {"rate": ..., "burst": ...} for commands with their own limits
+}
+
+# Permission for users that aren't flood limited
+BYPASS_PERMISSION = "bypass.ratelimit"
+
+
+class FloodLimiter:
+    """Limits how often each user can run each command, using a token bucket for every user and command.
+
+        The buckets are kept in a RateLimitTable, so memory use stays bounded however many users there are.
+
+        - rate, burst: the default limit for each user and command
+        - size: the most users and commands to keep track of
+        - commands: dict of command name -> (rate, burst) for commands with their own limits
+    """
+    def __init__(self, rate=0.2, burst=3, size=4096, commands=None):
+        self.table = RateLimitTable(rate, burst, size)
+        self.commands = {name.lower(): limit for name, limit in (commands or {}).items()}
+
+    @classmethod
+    def from_config(cls, config):
+        """Creates a limiter from the 'flood_limit' section of an instance's config, or returns NONE if it's FALSE."""
+        if config is False:
+            return None
+        settings = dict(DEFAULT_FLOOD_LIMIT)
+        settings.update(config or {})
+
+        commands = {}
+        for name, limit in settings["commands"].items():
+            commands[name] = (limit.get("rate", settings["rate"]), limit.get("burst", settings["burst"]))
+        return cls(settings["rate"], settings["burst"], settings["size"], commands)
+
+    def allow(self, user, command, now=None):
+        """Returns TRUE if a user can run a command now, and counts it against their limit.
+
+            - user: the name of the user
+            - command: the lower-cased name of the command
+        """
+        limit = self.commands.get(command)
+        if limit is None:
+            return self.table.consume((user.lower(), command), now=now)
+        return self.table.consume((user.lower(), command), limit[0], limit[1], now)
+
+    def hit_counts(self):
+        """Returns a dict of (lower-cased user name, command) -> times the user was stopped from running it."""
+        return self.table.hit_counts()
+
+
+class CommandQueue:
+    """Runs an instance's commands on a shared thread pool, so slow commands don't hold up the receiving thread.
+
+        Each user's commands run one at a time, in the order they were sent. A user with more commands waiting is
+        put back at the end of the pool's queue after each one, so one user can't keep a worker to themselves.
+        Without a pool, commands run straight away on the calling thread.
+
+        - run: function called with the arguments given to submit()
+        - max_pending: the most commands that can be waiting or running for the instance
+        - max_per_user: the most commands that can be waiting or running for each user
+        - overload: OVERLOAD_DROP or OVERLOAD_BUSY, for commands that arrive when there's no room for them
+        - busy_interval: the fewest seconds between notices to the same user about dropped commands, or 0 to
+            notify about every one
+    """
+    def __init__(self, run, max_pending=50, max_per_user=3, overload=OVERLOAD_DROP, busy_interval=30.0):
+        self.run = run
+        self.max_pending = max_pending
+        self.max_per_user = max_per_user
+        self.overload = overload
+        self.pool = None        # Set by the bot while it's running
+        self.notices = RateLimitTable(1.0 / busy_interval, 1, 1024) if busy_interval else None
+        self.log = logging.getLogger("bnetbot")
+
+        self._lock = threading.Lock()
+        self._users = {}        # User key -> deque of argument tuples, the first of which is running
+        self._pending = 0
+
+    @classmethod
+    def from_config(cls, run, config):
+        """Creates a queue from the 'command_queue' section of an instance's config."""
+        settings = dict(DEFAULT_COMMAND_QUEUE)
+        settings.update(config or {})
+        if settings["overload"] not in [OVERLOAD_DROP, OVERLOAD_BUSY]:
+            raise ValueError("Unknown command queue overload setting '%s'." % settings["overload"])
+        elif not isinstance(settings["busy_interval"], (int, float)) or settings["busy_interval"] < 0:
+            raise ValueError("Invalid command queue busy_interval '%s'." % settings["busy_interval"])
+        return cls(run, settings["max_pending"], settings["max_per_user"], settings["overload"],
+                   settings["busy_interval"])
+
+    def pending(self):
+        """Returns the number of commands waiting or running."""
+        return self._pending
+
+    def submit(self, key, *args):
+        """Queues a call to 'run' behind the user's other commands. Returns FALSE if the queue is full.
+
+            - key: identifies the user whose commands must run in order
+        """
+        pool = self.pool
+        if pool is None:
+            self.run(*args)
+            return True
+
+        with self._lock:
+            queue = self._users.get(key)
+            if self._pending >= self.max_pending or (queue and len(queue) >= self.max_per_user):
+                return False
+
+            self._pending += 1
+            if queue:
+                queue.append(args)
+                return True     # Runs once the user's earlier commands have finished
+            queue = self._users[key] = deque([args])
+        return self._start(pool, key, queue)
+
+    def notify(self, key, now=None):
+        """Returns TRUE if a user whose command was dropped should be told about it.
+
+            Each user is told at most once every 'busy_interval' seconds, so a flood of commands from chat doesn't
+            turn into a flood of replies and log messages.
+        """
+        return self.notices is None or self.notices.consume(key, now=now)
+
+    def clear(self):
+        """Drops the commands that haven't started yet."""
+        with self._lock:
+            self._users = {}
+            self._pending = 0
+
+    def _start(self, pool, key, queue):
+        try:
+            pool.submit(self._next, key, queue)
+            return True
+        except RuntimeError:
+            # The pool has been shut down.
+            self._drop(key, queue)
+            return False
+
+    def _drop(self, key, queue):
+        with self._lock:
+            if self._users.get(key) is queue:
+                del self._users[key]
+                self._pending -= len(queue)
+
+    def _next(self, key, queue):
+        try:
+            self.run(*queue[0])
+        except Exception:
+            self.log.exception("Unhandled error running command.")
+
+        with self._lock:
+            queue.popleft()
+            if self._users.get(key) is not queue:
+                return      # Cleared while the command was running
+            self._pending -= 1
+            if not queue:
+                del self._users[key]
+                return
+
+        pool = self.pool
+        if pool is not None:
+            self._start(pool, key, queue)
+        else:
+            self._drop(key, queue)
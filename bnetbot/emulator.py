@@ -0,0 +1,415 @@
+
+from .util.codec import get_codec
+from .util.loop import EventLoopThread
+from .util.ratelimit import TokenBucket
+from .util.ws import OPCODE_CLOSE, OPCODE_TEXT, WebSocketError, server_handshake
+
+import argparse
+import asyncio
+import itertools
+import random
+import time
+
+
+CHAT_LINES = ["hello", "anyone here?", "gg", "lol", "brb", "how's everyone doing", "ok", "!ping", "!whoami"]
+
+# Commands that count against the per-connection rate limit
+RATE_LIMITED = ["Botapichat.SendMessageRequest", "Botapichat.SendWhisperRequest", "Botapichat.SendEmoteRequest",
+                "Botapichat.BanUserRequest", "Botapichat.KickUserRequest", "Botapichat.UnbanUserRequest",
+                "Botapichat.SendSetModeratorRequest"]
+
+STATUS_RATE_LIMITED = {"area": 6, "code": 8}
+STATUS_NOT_CONNECTED = {"area": 8, "code": 1}
+STATUS_BAD_REQUEST = {"area": 8, "code": 2}
+
+
+class EmulatedUser:
+    """A user in an emulated channel. Users with a connection are bots, the rest are simulated."""
+    def __init__(self, name, flags=None, attributes=None, connection=None):
+        self.name = name
+        self.flags = list(flags or [])
+        self.attributes = dict(attributes or {})
+        self.connection = connection
+
+    def update_payload(self, user_id, full=True):
+        payload = {"user_id": user_id, "toon_name": self.name}
+        if full:
+            payload["flag"] = self.flags
+            payload["attribute"] = [{"key": k, "value": v} for k, v in self.attributes.items()]
+        return payload
+
+
+class EmulatedChannel:
+    """A channel shared by the connections and simulated users in it. Only used from the server's loop thread."""
+    def __init__(self, name):
+        self.name = name
+        self.users = {}         # Lower-cased name -> EmulatedUser
+        self.banned = set()
+        self.connections = []
+
+    def find(self, name):
+        return self.users.get(name.lower())
+
+    def add(self, user):
+        """Adds a user and announces them to every connected bot."""
+        self.users[user.name.lower()] = user
+        for conn in self.connections:
+            if conn.user is not user:
+                conn.event("Botapichat.UserUpdateEventRequest", user.update_payload(conn.local_id(user)))
+        return user
+
+    def remove(self, user):
+        """Removes a user and tells every connected bot they left."""
+        if self.users.pop(user.name.lower(), None) is None:
+            return False
+        for conn in self.connections:
+            if conn.user is not user:
+                conn.event("Botapichat.UserLeaveEventRequest", {"user_id": conn.local_id(user)})
+            conn.forget(user)
+        return True
+
+    def message(self, user, text, mtype="Channel"):
+        """Sends a chat message from 'user' to every other connected bot."""
+        for conn in self.connections:
+            if conn.user is not user:
+                conn.event("Botapichat.MessageEventRequest",
+                           {"user_id": conn.local_id(user), "type": mtype, "message": text})
+
+
+class EmulatedConnection:
+    """Server side of one bot connection.
+
+        User IDs are per connection - the bot always sees itself as user 1.
+    """
+    def __init__(self, server, ws):
+        self.server = server
+        self.ws = ws
+        self.user = None
+        self.channel = None
+        self.bucket = TokenBucket(server.rate, server.burst) if server.rate else None
+        self._ids = {}
+        self._users = {}
+        self._next_id = itertools.count(2)
+        self._event_ids = itertools.count(1)
+
+    def local_id(self, user):
+        user_id = self._ids.get(user)
+        if user_id is None:
+            user_id = 1 if user is self.user else next(self._next_id)
+            self._ids[user] = user_id
+            self._users[user_id] = user
+        return user_id
+
+    def forget(self, user):
+        user_id = self._ids.pop(user, None)
+        self._users.pop(user_id, None)
+
+    def user_by_id(self, user_id):
+        return self._users.get(user_id)
+
+    def send(self, message):
+        if not self.ws.closed:
+            self.ws.send(OPCODE_TEXT, self.server.codec.encode(message))
+
+    def event(self, command, payload):
+        self.send({"command": command, "request_id": next(self._event_ids), "payload": payload})
+
+    def respond(self, request, payload=None, status=None):
+        message = {
+            "command": request.get("command", "").replace("Request", "Response"),
+            "request_id": request.get("request_id"),
+            "payload": payload or {}
+        }
+        if status:
+            message["status"] = status
+        self.send(message)
+
+
+class CapiServer:
+    """A local stand-in for the Battle.net chat API, for offline testing and load generation.
+
+        It implements the Botapiauth/Botapichat requests and events the client understands, and can be scripted
+        from another thread to add simulated users, make them talk, and generate traffic at a fixed rate.
+
+        - host, port: the address to listen on. Port 0 picks a free port.
+        - api_keys: optional dict of API key -> bot name. If not set, any key is accepted.
+        - channel: the name of the channel bots are placed in
+        - rate, burst: the per-connection rate limit. Requests over the limit get a 6-8 error. Set rate to 0 to
+            disable it.
+    """
+    def __init__(self, host="127.0.0.1", port=0, api_keys=None, channel="Emulator", rate=1.0, burst=5,
+                 loop=None):
+        self.host = host
+        self.port = port
+        self.api_keys = api_keys
+        self.rate = rate
+        self.burst = burst
+        self.codec = get_codec()
+        self.channel = EmulatedChannel(channel)
+
+        self.loop = loop or EventLoopThread()
+        self._server = None
+        self._traffic = None
+        self._bot_names = itertools.count(1)
+
+    @property
+    def endpoint(self):
+        """The URI to pass to CapiClient.connect()."""
+        return "ws://%s:%i/v1/rpc/chat" % (self.host, self.port)
+
+    def start(self):
+        """Starts listening. Returns the endpoint URI."""
+        self.loop.start()
+        self._server = self.loop.run(asyncio.start_server(self._handle_connection, self.host, self.port))
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self.endpoint
+
+    def stop(self):
+        """Stops the server and closes every connection."""
+        self.stop_traffic()
+
+        def close():
+            for conn in list(self.channel.connections):
+                conn.ws.close()
+            if self._server:
+                self._server.close()
+        self._call(close)
+        self.loop.stop()
+
+    # Scripting functions. These can be called from any thread.
+
+    def add_user(self, name, flags=None, attributes=None):
+        """Adds a simulated user to the channel."""
+        return self._call(self.channel.add, EmulatedUser(name, flags, attributes))
+
+    def remove_user(self, name):
+        """Removes a user from the channel. Returns FALSE if they weren't there."""
+        return self._call(lambda: self.channel.remove(self.channel.find(name)) if self.channel.find(name) else False)
+
+    def populate(self, count, prefix="User", flags=None, attributes=None):
+        """Adds 'count' simulated users named <prefix><number>."""
+        def add():
+            start = len(self.channel.users)
+            for i in range(count):
+                self.channel.add(EmulatedUser("%s%i" % (prefix, start + i), flags, attributes))
+        self._call(add)
+
+    def say(self, name, message, mtype="Channel"):
+        """Makes a simulated user talk in the channel."""
+        def say():
+            user = self.channel.find(name)
+            if user is None:
+                raise ValueError("User not in channel: %s" % name)
+            self.channel.message(user, message, mtype)
+        self._call(say)
+
+    def whisper(self, name, message, bot=None):
+        """Sends a whisper from a simulated user to a connected bot (the first one if not specified)."""
+        def whisper():
+            user = self.channel.find(name)
+            targets = [c for c in self.channel.connections if bot is None or c.user.name.lower() == bot.lower()]
+            if user is None or not targets:
+                raise ValueError("User or bot not found.")
+            targets[0].event("Botapichat.MessageEventRequest",
+                             {"user_id": targets[0].local_id(user), "type": "Whisper", "message": message})
+        self._call(whisper)
+
+    def server_message(self, message, error=False):
+        """Sends a server info or error message to every bot."""
+        def send():
+            for conn in self.channel.connections:
+                conn.event("Botapichat.MessageEventRequest",
+                           {"user_id": 0, "type": "ServerError" if error else "ServerInfo", "message": message})
+        self._call(send)
+
+    def start_traffic(self, messages_per_second, churn_per_second=0, lines=None):
+        """Starts generating chat from random simulated users, and optionally users joining and leaving.
+
+            - messages_per_second: the rate of channel messages
+            - churn_per_second: the rate of users leaving and being replaced by new ones
+            - lines: the messages to pick from (defaults to CHAT_LINES)
+        """
+        self.stop_traffic()
+        self._traffic = self.loop.spawn(self._generate_traffic(messages_per_second, churn_per_second,
+                                                               lines or CHAT_LINES))
+
+    def stop_traffic(self):
+        """Stops generating traffic."""
+        if self._traffic is not None:
+            self._traffic.cancel()
+            self._traffic = None
+
+    def _call(self, func, *args):
+        async def run():
+            return func(*args)
+        return self.loop.run(run())
+
+    async def _generate_traffic(self, message_rate, churn_rate, lines):
+        rng = random.Random()
+        names = itertools.count(len(self.channel.users))
+        owed_messages = owed_churn = 0.0
+        last = time.monotonic()
+        while True:
+            await asyncio.sleep(0.01)
+            now = time.monotonic()
+            owed_messages += (now - last) * message_rate
+            owed_churn += (now - last) * churn_rate
+            last = now
+
+            simulated = [u for u in self.channel.users.values() if u.connection is None]
+            while owed_churn >= 1:
+                owed_churn -= 1
+                if simulated:
+                    self.channel.remove(simulated.pop(rng.randrange(len(simulated))))
+                simulated.append(self.channel.add(EmulatedUser("Churn%i" % next(names))))
+
+            while owed_messages >= 1:
+                owed_messages -= 1
+                if simulated:
+                    self.channel.message(rng.choice(simulated), rng.choice(lines))
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            ws, path = await server_handshake(reader, writer)
+        except (WebSocketError, OSError, EOFError, asyncio.LimitOverrunError):
+            return
+
+        conn = EmulatedConnection(self, ws)
+        try:
+            while not ws.closed:
+                opcode, data = await ws.recv()
+                if opcode == OPCODE_CLOSE:
+                    break
+                elif opcode == OPCODE_TEXT:
+                    try:
+                        request = self.codec.decode(data)
+                    except self.codec.errors:
+                        continue
+                    if isinstance(request, dict):
+                        self._handle_request(conn, request)
+        except (WebSocketError, OSError, EOFError):
+            pass
+        finally:
+            self._leave(conn)
+            ws.close()
+
+    def _handle_request(self, conn, request):
+        command = request.get("command")
+        payload = request.get("payload") or {}
+
+        if command == "Botapiauth.AuthenticateRequest":
+            return self._authenticate(conn, request, payload.get("api_key"))
+        elif conn.user is None:
+            return conn.respond(request, status=STATUS_NOT_CONNECTED)
+        elif command == "Botapichat.ConnectRequest":
+            return self._join(conn, request)
+        elif command == "Botapichat.DisconnectRequest":
+            conn.respond(request)
+            conn.event("Botapichat.DisconnectEventRequest", {})
+            self._leave(conn)
+            return conn.ws.close()
+        elif conn.channel is None:
+            return conn.respond(request, status=STATUS_NOT_CONNECTED)
+        elif command in RATE_LIMITED and conn.bucket and not conn.bucket.consume():
+            return conn.respond(request, status=STATUS_RATE_LIMITED)
+
+        target = conn.user_by_id(payload.get("user_id"))
+        if command == "Botapichat.SendMessageRequest":
+            conn.respond(request)
+            self.channel.message(conn.user, payload.get("message", ""))
+        elif command == "Botapichat.SendEmoteRequest":
+            conn.respond(request)
+            self.channel.message(conn.user, payload.get("message", ""), "Emote")
+        elif command == "Botapichat.SendWhisperRequest":
+            if target is None:
+                return conn.respond(request, status=STATUS_BAD_REQUEST)
+            conn.respond(request)
+            if target.connection:
+                target.connection.event("Botapichat.MessageEventRequest", {
+                    "user_id": target.connection.local_id(conn.user), "type": "Whisper",
+                    "message": payload.get("message", "")})
+        elif command in ["Botapichat.BanUserRequest", "Botapichat.KickUserRequest"]:
+            if target is None or target is conn.user:
+                return conn.respond(request, status=STATUS_BAD_REQUEST)
+            conn.respond(request)
+            if command == "Botapichat.BanUserRequest":
+                self.channel.banned.add(target.name.lower())
+            if target.connection:
+                target.connection.event("Botapichat.DisconnectEventRequest", {})
+                self._leave(target.connection)
+            else:
+                self.channel.remove(target)
+        elif command == "Botapichat.UnbanUserRequest":
+            self.channel.banned.discard(payload.get("toon_name", "").lower())
+            conn.respond(request)
+        elif command == "Botapichat.SendSetModeratorRequest":
+            if target is None:
+                return conn.respond(request, status=STATUS_BAD_REQUEST)
+            conn.respond(request)
+            for user, flag in [(conn.user, None), (target, "Moderator")]:
+                user.flags = [f for f in user.flags if f != "Moderator"] + ([flag] if flag else [])
+                for other in self.channel.connections:
+                    other.event("Botapichat.UserUpdateEventRequest", user.update_payload(other.local_id(user)))
+        else:
+            conn.respond(request, status=STATUS_BAD_REQUEST)
+
+    def _authenticate(self, conn, request, api_key):
+        if self.api_keys is not None and api_key not in self.api_keys:
+            return conn.respond(request, status=STATUS_BAD_REQUEST)
+
+        name = self.api_keys[api_key] if self.api_keys else "EmulatedBot%i" % next(self._bot_names)
+        conn.user = EmulatedUser(name, ["Moderator"], {"ProgramId": "W2BN"}, conn)
+        conn.respond(request)
+
+    def _join(self, conn, request):
+        if conn.user.name.lower() in self.channel.banned:
+            return conn.respond(request, status=STATUS_BAD_REQUEST)
+
+        conn.respond(request)
+        conn.event("Botapichat.UserUpdateEventRequest", conn.user.update_payload(conn.local_id(conn.user)))
+        conn.event("Botapichat.ConnectEventRequest", {"channel": self.channel.name})
+
+        # Initial user list, terminated by a bare update for the bot itself.
+        for user in list(self.channel.users.values()):
+            conn.event("Botapichat.UserUpdateEventRequest", user.update_payload(conn.local_id(user)))
+        conn.event("Botapichat.UserUpdateEventRequest", conn.user.update_payload(1, False))
+
+        self.channel.add(conn.user)
+        self.channel.connections.append(conn)
+        conn.channel = self.channel
+
+    def _leave(self, conn):
+        if conn.channel is not None:
+            conn.channel.connections.remove(conn)
+            conn.channel.remove(conn.user)
+            conn.channel = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs a local stand-in for the Battle.net chat API.")
+    parser.add_argument("--host", default="127.0.0.1", help="The address to listen on.")
+    parser.add_argument("--port", type=int, default=8080, help="The port to listen on.")
+    parser.add_argument("--channel", default="Emulator", help="The channel name.")
+    parser.add_argument("--users", type=int, default=0, help="The number of simulated users in the channel.")
+    parser.add_argument("--rate", type=float, default=0, help="Simulated channel messages per second.")
+    parser.add_argument("--churn", type=float, default=0, help="Simulated users leaving/joining per second.")
+    parser.add_argument("--limit", type=float, default=1.0, help="Per-bot request rate limit (0 disables).")
+    parser.add_argument("--burst", type=int, default=5, help="Per-bot request burst size.")
+    p_args = parser.parse_args()
+
+    server = CapiServer(p_args.host, p_args.port, channel=p_args.channel, rate=p_args.limit, burst=p_args.burst)
+    print("Listening on: %s" % server.start())
+    if p_args.users:
+        server.populate(p_args.users)
+    if p_args.rate or p_args.churn:
+        server.start_traffic(p_args.rate, p_args.churn)
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
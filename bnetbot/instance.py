@@ -1,73 +1,168 @@
 
-from .capi import CapiClient
+from .aio import AsyncCapiClient
+from .capi import CapiClient, MAX_MESSAGE_LENGTH
+from .channel import name_key
 from .commands import *
-from .database import UserDatabase
+from .database import UserDatabase, change_count
+from .dispatch import BYPASS_PERMISSION, CommandQueue, FloodLimiter, OVERLOAD_BUSY
+from .router import CommandRouter, Triggers
+from .util.cache import ResultCache
+from .util.text import pack_lines
 
 from datetime import datetime
 import logging
 
 
+# Triggers for commands from the bot console, and the command sources that use them
+CONSOLE_TRIGGERS = Triggers("/")
+CONSOLE_SOURCES = frozenset([SOURCE_LOCAL, SOURCE_INTERNAL])
+
+# Sources of commands from chat, which are flood limited
+CHAT_SOURCES = frozenset([SOURCE_PUBLIC, SOURCE_PRIVATE])
+
+# Client classes for each value of the 'transport' config setting
+TRANSPORTS = {
+    "asyncio": AsyncCapiClient,
+    "thread": CapiClient
+}
+
+
 class BotInstance:
-    def __init__(self, name, config=None):
+    def __init__(self, name, config=None, loop=None, databases=None, client=None):
+        """Creates a bot instance from its configuration.
+
+            - databases: the bot's SharedDatabases, for instances that use a shared user database
+            - client: a chat client to use instead of creating one from the config (e.g. for replaying a capture)
+        """
         self.name = name or "Unnamed"
         self.config = config or {}
-        self.commands = {}
-        self.database = UserDatabase.load(self.config.get("database"))
+
+        # Commands can be started with any of the configured triggers, and run by an alias or the start of their name.
+        self.router = CommandRouter(self.config.get("abbreviations", True))
+        self.commands = self.router.commands
+        self.triggers = Triggers(self.config.get("trigger", "!"))
+        for alias, command in self.config.get("aliases", {}).items():
+            self.router.alias(alias, command)
+
+        # Commands from chat run on the bot's command pool, behind the user's earlier commands. execute_command is
+        #   looked up for each command so it can be wrapped (see bench.py).
+        self.command_queue = CommandQueue.from_config(lambda *args: self.execute_command(*args),
+                                                      self.config.get("command_queue"))
+        self.flood_limiter = FloodLimiter.from_config(self.config.get("flood_limit"))
+        self.max_message_length = self.config.get("max_message_length", MAX_MESSAGE_LENGTH)
+        self.result_cache = ResultCache(self.config.get("result_cache_size", 256))   # For commands marked cacheable
+
+        self.database = UserDatabase.load(self.config.get("database"), databases)
+        self.writer = None      # Set by the bot to save changes in the background
+        self.plugins = None     # Set by the bot to its PluginManager
         self._uptime = None
 
         self.log = logging.getLogger("bnetbot." + self.name)
         if "log_level" in self.config and self.log.getEffectiveLevel() != logging.DEBUG:
             # If a custom log level is defined and we aren't in debug mode, use the configured level.
             self.log.setLevel(self.config["log_level"])
+        self.protocol_log = self.log.getChild("protocol")   # High volume - can be sampled in the logging config
 
         # Create chat client and hook events
-        self.client = CapiClient(self.config.get("api_key"))
+        transport = self.config.get("transport", "asyncio")
+        client_options = {
+            "request_timeout": self.config.get("request_timeout", 30),
+            "rate_limit": self.config.get("rate_limit"),
+            "codec": self.config.get("json_codec")
+        }
+        if client is not None:
+            self.client = client
+        elif transport not in TRANSPORTS:
+            raise ValueError("Unknown transport '%s' for instance '%s'." % (transport, self.name))
+        elif transport == "asyncio":
+            self.client = AsyncCapiClient(self.config.get("api_key"), loop, **client_options)
+        else:
+            self.client = CapiClient(self.config.get("api_key"), **client_options)
+        if self.config.get("endpoint"):
+            self.client.endpoint = self.config["endpoint"]
+        self.client.log = self.log.getChild("capi")
         self.client.hook(self)
 
+        if not self.protocol_log.isEnabledFor(logging.DEBUG):
+            # Protocol messages are only logged in debug mode. Without listeners the client skips these events.
+            self.client.events['protocol_message_received'].unregister(self._handle_protocol_message_received)
+            self.client.events['protocol_message_sent'].unregister(self._handle_protocol_message_sent)
+
     @property
     def uptime(self):
         return datetime.utcnow() - self._uptime
 
     def start(self):
         """Connects and starts the bot instance."""
-        self.log.debug("Connecting to CAPI endpoint '%s' ..." % self.client.endpoint)
+        self.log.debug("Connecting to CAPI endpoint '%s' ...", self.client.endpoint)
         if self.client.connect():
             self.log.debug("Connection established!")
 
+    async def start_async(self):
+        """Coroutine version of start() for instances using the asyncio transport."""
+        self.log.debug("Connecting to CAPI endpoint '%s' ...", self.client.endpoint)
+        if await self.client.connect_async():
+            self.log.debug("Connection established!")
+
     def stop(self, force=False):
         """Disconnects and shuts down the bot instance."""
         self.log.debug("Shutting down instance...")
+        self.command_queue.clear()
         self.client.disconnect(force)
         self.save()
 
     def save(self):
-        """Saves the instance's configuration."""
-        self.config["database"] = self.database
+        """Saves the instance's configuration.
+
+            If the bot has a background writer, the save happens shortly afterwards on that thread, along with any
+            other changes made in the meantime.
+        """
+        if self.writer:
+            self.writer.mark_dirty(self)
+        else:
+            self.write_config()
+
+    def write_config(self):
+        """Copies the instance's current state into its configuration.
+
+            The database is copied with its lock held, so the copy can be saved on another thread while commands
+            keep changing the database.
+        """
+        with self.database.lock:
+            self.database.commit()
+            self.config["database"] = self.database.to_config()
 
     def send(self, message, target=None):
         """Sends a chat message to the connected channel.
 
-            If a message contains multiple lines, it will be split into separate messages.
+            - message: the text to send, or a list of lines. Lines are packed into as few messages as the server's
+                maximum message length allows, and lines that are too long are split at word boundaries.
         """
-        lines = message.replace('\r', '').split('\n') if isinstance(message, str) else message
-        for line in lines:
+        lines = [message.replace('\r', '')] if isinstance(message, str) else message
+        for line in pack_lines(lines, self.max_message_length):
             self.client.chat(line, target)
 
-    def register_command(self, command, permission, callback):
-        """Registers a command to make it available."""
-        self.commands[command.lower()] = CommandDefinition(command, permission, callback)
+    def register_command(self, command, permission, callback, aliases=None):
+        """Registers a command to make it available.
+
+            - aliases: other names the command can be run by
+        """
+        self.router.add(CommandDefinition(command, permission, callback), aliases)
+
+    def unregister_command(self, command):
+        """Removes a command, so it can no longer be run."""
+        self.router.remove(command)
 
     def parse_command(self, message, source=None):
-        """Attempts to parse a message for a bot command. Returns the parsed command instance or NONE."""
-        source = source or SOURCE_INTERNAL
-        trigger = "/" if source in [SOURCE_LOCAL, SOURCE_INTERNAL] else self.config.get("trigger", "!")
+        """Attempts to parse a message for a bot command. Returns the parsed command instance or NONE.
 
-        # Check for the correct trigger
-        if message.startswith(trigger) and len(message) > len(trigger):
-            args = message.split()
-            cmd = args[0][len(trigger):]
-            args = args[1:] if len(args) > 1 else []
-            return CommandInstance(cmd, self, args, source, trigger)
+            The arguments aren't parsed until they're used.
+        """
+        source = source or SOURCE_INTERNAL
+        found = (CONSOLE_TRIGGERS if source in CONSOLE_SOURCES else self.triggers).match(message)
+        if found:
+            trigger, cmd, end = found
+            return CommandInstance(cmd, self, None, source, trigger, message[end:])
 
     def execute_command(self, instance, run_as=None):
         """Executes a command.
@@ -85,46 +180,123 @@ class BotInstance:
             user = run_as
 
         instance.user = user
-        command = self.commands.get(instance.command.lower())
+        command = self.router.resolve(instance.command)
 
         if command:
-            self.log.info("Attempting to run command '%s' as user '%s' with arguments: %s." %
-                          (instance.command, user.name if user else run_as, instance.args))
+            self.log.info("Attempting to run command '%s' as user '%s' with arguments: %s.",
+                          instance.command, user.name if user else run_as, instance.args)
 
             if command.permission is None or (user and user.check_permission(command.permission)):
-                command.callback(instance)
+                if command.cache_ttl:
+                    self._run_cached(command, instance)
+                else:
+                    # Commands from chat run on several threads at once. Only cacheable commands are known not to
+                    #   change the database, so the others take turns with the database's other users.
+                    with self.database.lock:
+                        command.callback(instance)
             elif user:
                 instance.respond("You do not have permission to use that command.")
-                self.log.warning("Access denied for user '%s' - missing required permission: %s." %
-                                 (user.name, command.permission))
+                self.log.warning("Access denied for user '%s' - missing required permission: %s.",
+                                 user.name, command.permission)
             else:
-                self.log.warning("Access denied for user '%s' - no permissions" % run_as)
+                self.log.warning("Access denied for user '%s' - no permissions", run_as)
         else:
             instance.respond("Unrecognized command.")
         return instance
 
+    def dispatch_command(self, instance, user):
+        """Queues a command from chat to run as the user who sent it.
+
+            Returns FALSE if the command was ignored because the user reached the flood limit or the queue was full.
+        """
+        if self._flood_limited(instance, user.name):
+            self.log.debug("Flood limit reached - ignoring command '%s' from user '%s'.", instance.command, user.name)
+            return False
+
+        key = user.name.lower()
+        if self.command_queue.submit(key, instance, user.name):
+            return True
+
+        # Only the first of a user's dropped commands in a while is answered and logged as a warning.
+        if not self.command_queue.notify(key):
+            self.log.debug("Command queue full - ignoring command '%s' from user '%s'.", instance.command, user.name)
+            return False
+
+        self.log.warning("Command queue full - ignoring command '%s' from user '%s'.", instance.command, user.name)
+        if self.command_queue.overload == OVERLOAD_BUSY:
+            self.send("I'm busy right now - try again in a moment.",
+                      user.name if instance.source == SOURCE_PRIVATE else None)
+        return False
+
+    def _run_cached(self, command, instance):
+        # Answers from the cache if the same command was run recently, otherwise runs it and caches the response.
+        #   Entries are tagged with the names in the arguments, and the database version catches any edits. Channel
+        #   events can drop entries while the command runs, so the response isn't cached if any were dropped.
+        names = [name_key(arg.lstrip('*')) for arg in instance.args]
+        user_key = name_key(instance.user.name) if command.cache_per_user and instance.user else None
+        key = (command.name.lower(), tuple(names), instance.source, user_key)
+
+        version = change_count()
+        lines = self.result_cache.get(key, version)
+        if lines is not None:
+            instance.response.extend(lines)
+            return instance.respond()
+
+        generation = self.result_cache.generation
+        command.callback(instance)
+        if instance.sent and not instance.response:
+            self.result_cache.put(key, list(instance.sent), command.cache_ttl,
+                                  names + [user_key] if user_key else names, version, generation=generation)
+
+    def _flood_limited(self, instance, name):
+        # Commands from chat are limited for each user and command before they're queued, so commands over the
+        #   limit don't take up the user's place in the queue. Users with the bypass permission aren't limited, and
+        #   unknown commands share a limit, since they're answered as well.
+        if self.flood_limiter is None or instance.source not in CHAT_SOURCES:
+            return False
+
+        user = self.database.user(name)
+        if user and user.check_permission(BYPASS_PERMISSION):
+            return False
+        command = self.router.resolve(instance.command)
+        return not self.flood_limiter.allow(name, command.name.lower() if command else "")
+
     def _handle_joined_chat(self, client, channel, user):
+        self.result_cache.clear()
         self._uptime = datetime.utcnow()
-        self.log.info("Logged on as '%s' in channel '%s'" % (user.name, channel))
+        self.log.info("Logged on as '%s' in channel '%s'", user.name, channel)
 
     def _handle_user_talk(self, client, user, message):
         cmd = self.parse_command(message, SOURCE_PUBLIC)
         if cmd:
-            self.execute_command(cmd, user.name)
+            self.dispatch_command(cmd, user)
 
     def _handle_whisper_received(self, client, user, message):
         cmd = self.parse_command(message, SOURCE_PRIVATE)
         if cmd:
-            self.execute_command(cmd, user.name)
+            self.dispatch_command(cmd, user)
+
+    def _handle_channel_snapshot(self, client, users, version):
+        self.result_cache.clear()
+
+    def _handle_user_joined(self, client, user):
+        self.result_cache.discard(name_key(user.name))
+
+    def _handle_user_update(self, client, user, flags, attributes):
+        self.result_cache.discard(name_key(user.name))
+
+    def _handle_user_left(self, client, user):
+        self.result_cache.discard(name_key(user.name))
 
     def _handle_left_chat(self, client):
+        self.result_cache.clear()
         self.log.warning("Disconnected from chat.")
 
     def _handle_client_error(self, client, error):
-        self.log.error("Client error: %s", error.message)
+        self.log.error("Client error: %s", getattr(error, "message", error))
 
     def _handle_protocol_message_received(self, client, data):
-        self.log.debug("Received message: %s", data)
+        self.protocol_log.debug("Received message: %s", data)
 
     def _handle_protocol_message_sent(self, client, data):
-        self.log.debug("Sent message: %s", data)
+        self.protocol_log.debug("Sent message: %s", data)
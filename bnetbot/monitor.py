@@ -0,0 +1,194 @@
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import heapq
+import itertools
+import random
+import threading
+import time
+
+
+# Default settings for the 'reconnect' section of the config
+DEFAULT_RECONNECT = {
+    "workers": 4,           # Reconnects that can run at the same time
+    "delay": 2.0,           # Seconds to wait after the first failed reconnect, doubled after each failure...
+    "max_delay": 300.0      # ... up to this limit
+}
+
+
+class MonitoredInstance:
+    """Monitor state for one bot instance."""
+    __slots__ = ('instance', 'due', 'attempts', 'down', 'removed')
+
+    def __init__(self, instance):
+        self.instance = instance
+        self.due = None         # When the next check is scheduled, or NONE while reconnecting
+        self.attempts = 0       # Failed reconnects in a row
+        self.down = False
+        self.removed = False
+
+
+class ConnectionMonitor:
+    """Keeps bot instances connected.
+
+        Each instance is checked once its keep-alive deadline comes up. If nothing has been received for
+        'keep_alive' seconds, the client is pinged (which should trigger a response). If there's still nothing
+        after twice that, or the client isn't connected, it's reconnected.
+
+        Checks are kept in a heap ordered by deadline, and the monitor thread sleeps until the earliest one, so
+        an idle bot does no work between deadlines. Reconnects run on a small worker pool so a slow handshake
+        doesn't hold up checks for other instances. Failed reconnects are retried with exponential backoff and
+        random jitter, so instances that went down together don't all retry at the same moment.
+
+        - keep_alive: seconds of silence before a client is pinged
+        - workers: the number of reconnects that can run at the same time
+        - delay: seconds to wait after the first failed reconnect, doubled after each failure up to 'max_delay'
+    """
+    def __init__(self, keep_alive=10, workers=4, delay=2.0, max_delay=300.0):
+        self.keep_alive = keep_alive
+        self.workers = workers
+        self.delay = delay
+        self.max_delay = max_delay
+        self.running = False
+
+        self._entries = {}      # Instance -> MonitoredInstance
+        self._heap = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._pool = None
+
+    @classmethod
+    def from_config(cls, config):
+        """Creates a monitor from the bot config ('keep_alive' and the 'reconnect' section)."""
+        settings = dict(DEFAULT_RECONNECT)
+        settings.update(config.get("reconnect") or {})
+        return cls(config.get("keep_alive", 10), settings["workers"], settings["delay"], settings["max_delay"])
+
+    def start(self):
+        with self._cond:
+            if self.running:
+                return
+            self.running = True
+
+        self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix="bnetbot-reconnect")
+        self._thread = threading.Thread(target=self._run, name="bnetbot-monitor")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops checking instances. Reconnects that are already running are left to finish in the background."""
+        with self._cond:
+            self.running = False
+            self._cond.notify()
+
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+        if self._pool:
+            self._pool.shutdown(wait=False)
+        self._thread = self._pool = None
+
+    def add(self, instance):
+        """Starts monitoring an instance. Its first check is run straight away."""
+        with self._cond:
+            if instance not in self._entries:
+                entry = self._entries[instance] = MonitoredInstance(instance)
+                self._schedule(entry, time.monotonic())
+
+    def remove(self, instance):
+        """Stops monitoring an instance."""
+        with self._cond:
+            entry = self._entries.pop(instance, None)
+            if entry:
+                entry.removed = True
+
+    def backoff(self, attempts):
+        """Returns the number of seconds to wait before the next reconnect, after 'attempts' failures in a row."""
+        limit = min(self.max_delay, self.delay * 2 ** (attempts - 1))
+        return random.uniform(limit / 2, limit)
+
+    def _schedule(self, entry, when):
+        # Must be called while holding the lock. Entries already in the heap with a different time are skipped.
+        entry.due = when
+        heapq.heappush(self._heap, (when, next(self._counter), entry))
+        if self._heap[0][2] is entry:
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            due = []
+            with self._cond:
+                while self.running:
+                    now = time.monotonic()
+                    while self._heap and self._heap[0][0] <= now:
+                        when, _, entry = heapq.heappop(self._heap)
+                        if entry.due == when and not entry.removed:
+                            entry.due = None
+                            due.append(entry)
+                    if due:
+                        break
+                    self._cond.wait(self._heap[0][0] - now if self._heap else None)
+                else:
+                    return
+
+            for entry in due:
+                try:
+                    self._check(entry)
+                except Exception:
+                    entry.instance.log.exception("Keep-alive check failed.")
+                    with self._cond:
+                        self._schedule(entry, time.monotonic() + self.keep_alive)
+
+    def _check(self, entry):
+        client = entry.instance.client
+
+        # Fail requests the server never answered
+        client.expire_requests()
+
+        last = client.last_message
+        idle = (datetime.now() - last).total_seconds() if last else self.keep_alive
+
+        if idle >= (self.keep_alive * 2) or not client.connected():
+            if not entry.down:
+                entry.instance.log.warning("Monitor has detected instance '%s' as down - attempting to reconnect...",
+                                           entry.instance.name)
+                entry.down = True
+            with self._cond:
+                if self.running and not entry.removed:
+                    self._pool.submit(self._reconnect, entry)
+            return
+
+        if idle >= self.keep_alive:
+            # Send a ping. If nothing comes back by the next check, the client is reconnected.
+            client.ping(str(datetime.now()))
+            wait = self.keep_alive
+        else:
+            wait = self.keep_alive - idle
+
+        with self._cond:
+            if self.running and not entry.removed:
+                self._schedule(entry, time.monotonic() + wait)
+
+    def _reconnect(self, entry):
+        inst = entry.instance
+        try:
+            inst.client.disconnect(True)
+            success = inst.client.connect()
+        except Exception:
+            inst.log.exception("Reconnect failed.")
+            success = False
+
+        with self._cond:
+            if not self.running or entry.removed:
+                return
+
+            if success:
+                inst.log.info("Connection successful. Resuming...")
+                entry.attempts = 0
+                entry.down = False
+                self._schedule(entry, time.monotonic() + self.keep_alive)
+            else:
+                entry.attempts += 1
+                wait = self.backoff(entry.attempts)
+                inst.log.info("Reconnect attempt %i failed. Trying again in %.1f seconds.", entry.attempts, wait)
+                self._schedule(entry, time.monotonic() + wait)
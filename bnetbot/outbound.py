@@ -0,0 +1,149 @@
+
+from .util.ratelimit import TokenBucket
+
+from collections import deque
+import threading
+import time
+
+
+# Outbound priority lanes, highest first. Control messages skip the rate limit entirely.
+PRIORITY_CONTROL = 0
+PRIORITY_MODERATION = 1
+PRIORITY_CHAT = 2
+
+COMMAND_PRIORITIES = {
+    "Botapiauth.AuthenticateRequest": PRIORITY_CONTROL,
+    "Botapichat.ConnectRequest": PRIORITY_CONTROL,
+    "Botapichat.DisconnectRequest": PRIORITY_CONTROL,
+    "Botapichat.BanUserRequest": PRIORITY_MODERATION,
+    "Botapichat.KickUserRequest": PRIORITY_MODERATION,
+    "Botapichat.UnbanUserRequest": PRIORITY_MODERATION,
+    "Botapichat.SendSetModeratorRequest": PRIORITY_MODERATION
+}
+
+# Default limits. These are deliberately conservative and can be changed with the instance's 'rate_limit' setting.
+DEFAULT_RATE_LIMIT = {
+    "rate": 1.0,            # Messages per second
+    "burst": 5,             # Messages that can be sent back-to-back after being idle
+    "retries": 3,           # Times a request is re-sent after a 'Rate limit exceeded' error
+    "backoff": 2.0,         # Seconds to pause after the first rate limit error, doubled for each retry
+    "max_backoff": 30.0     # Upper limit for the pause
+}
+
+
+class OutboundQueue:
+    """Orders outgoing requests by priority and releases them at the rate the server allows.
+
+        The queue doesn't send anything itself - the client calls pop() and writes whatever it returns, then waits
+        the returned number of seconds before trying again.
+    """
+    def __init__(self, rate=1.0, burst=5, retries=3, backoff=2.0, max_backoff=30.0):
+        self.bucket = TokenBucket(rate, burst)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lanes = {p: deque() for p in [PRIORITY_CONTROL, PRIORITY_MODERATION, PRIORITY_CHAT]}
+
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+        # Metrics
+        self.sent = 0
+        self.retried = 0
+        self.rate_limited = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    @classmethod
+    def from_config(cls, config):
+        """Creates a queue from an instance's 'rate_limit' setting, filling in defaults for missing values."""
+        settings = dict(DEFAULT_RATE_LIMIT)
+        settings.update(config or {})
+        return cls(settings["rate"], settings["burst"], settings["retries"], settings["backoff"],
+                   settings["max_backoff"])
+
+    def __len__(self):
+        return sum(len(lane) for lane in self.lanes.values())
+
+    def push(self, request, priority=None):
+        """Queues a request. If no priority is given it's chosen from the request's command."""
+        if priority is None:
+            priority = COMMAND_PRIORITIES.get(request.command, PRIORITY_CHAT)
+        request.priority = priority
+        if request.queued_at is None:
+            request.queued_at = time.monotonic()
+
+        with self._lock:
+            self.lanes.setdefault(priority, deque()).append(request)
+
+    def pop(self, now=None):
+        """Returns the next request that may be sent, and the number of seconds to wait before calling again.
+
+            - If a request is returned the wait is 0. If nothing is queued the wait is NONE.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            waiting = False
+            for priority in sorted(self.lanes):
+                lane = self.lanes[priority]
+                if not lane:
+                    continue
+                elif priority == PRIORITY_CONTROL:
+                    return self._release(lane.popleft(), now), 0.0
+
+                waiting = True
+                if now >= self._paused_until and self.bucket.consume(1, now):
+                    return self._release(lane.popleft(), now), 0.0
+                break
+
+            if not waiting:
+                return None, None
+            return None, max(self._paused_until - now, self.bucket.delay(1, now))
+
+    def retry(self, request, now=None):
+        """Puts a request rejected with 'Rate limit exceeded' back at the front of its lane and pauses sending.
+
+            - Returns FALSE if the request has used up its retries and should fail instead.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self.rate_limited += 1
+            if request.attempts > self.retries:
+                return False
+
+            pause = min(self.backoff * (2 ** (request.attempts - 1)), self.max_backoff)
+            self._paused_until = max(self._paused_until, now + pause)
+            self.bucket.drain(now)
+            self.retried += 1
+            self.lanes.setdefault(request.priority, deque()).appendleft(request)
+            return True
+
+    def clear(self):
+        """Empties the queue and returns the requests that were waiting."""
+        with self._lock:
+            requests = []
+            for lane in self.lanes.values():
+                requests.extend(lane)
+                lane.clear()
+            self._paused_until = 0.0
+            return requests
+
+    def stats(self):
+        """Returns the queue depth and latency metrics as a dict."""
+        with self._lock:
+            return {
+                "depth": {priority: len(lane) for priority, lane in self.lanes.items()},
+                "sent": self.sent,
+                "retried": self.retried,
+                "rate_limited": self.rate_limited,
+                "latency_avg": (self.latency_total / self.sent) if self.sent else 0.0,
+                "latency_max": self.latency_max
+            }
+
+    def _release(self, request, now):
+        request.attempts += 1
+        self.sent += 1
+        latency = max(now - request.queued_at, 0.0)
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+        return request
@@ -0,0 +1,130 @@
+
+from concurrent.futures import Future
+import heapq
+import threading
+import time
+
+
+MAX_REQUEST_ID = 2 ** 31 - 1
+
+
+class PendingRequest(Future):
+    """A sent request waiting for its response.
+
+        This is a concurrent.futures.Future, so callers can block on result(), attach callbacks with
+        add_done_callback(), or wrap it with asyncio.wrap_future(). The result is the response message.
+
+        - id: the request ID sent to the server. It's NONE while the request is queued, and changes if the
+            request is sent again after a rate limit error.
+        - data: the full request message (command, request_id, payload)
+        - deadline: the time.monotonic() value after which the request is considered lost
+        - priority, attempts, queued_at: used by the outbound queue
+    """
+    def __init__(self, request_id, data, deadline=None):
+        super().__init__()
+        self.id = request_id
+        self.data = data
+        self.deadline = deadline
+        self.priority = None
+        self.attempts = 0
+        self.queued_at = None
+
+    @property
+    def command(self):
+        return self.data.get("command")
+
+    def __int__(self):
+        return self.id
+
+
+class RequestTable:
+    """Tracks requests that haven't been answered yet.
+
+        IDs are allocated from a wrapping counter so no scan is needed, and an ID isn't handed out again until
+        the counter wraps around, so a late response can't be confused with a newer request. Deadlines are kept
+        in a heap so expiring old requests only looks at the ones that are actually overdue.
+
+        - timeout: the number of seconds to wait for a response before a request expires
+    """
+    def __init__(self, timeout=30):
+        self.timeout = timeout
+        self._pending = {}
+        self._deadlines = []
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __contains__(self, request_id):
+        return request_id in self._pending
+
+    @staticmethod
+    def create(command, payload=None):
+        """Creates a request that isn't tracked yet. It gets an ID when passed to start()."""
+        return PendingRequest(None, {
+            "command": command,
+            "request_id": None,
+            "payload": payload or {}
+        })
+
+    def start(self, request):
+        """Allocates a new ID for a request that is about to be sent and starts its deadline."""
+        with self._lock:
+            request_id = self._next_id
+            while request_id in self._pending:
+                request_id = request_id % MAX_REQUEST_ID + 1
+            self._next_id = request_id % MAX_REQUEST_ID + 1
+
+            request.id = request.data["request_id"] = request_id
+            request.deadline = time.monotonic() + self.timeout
+            self._pending[request_id] = request
+            heapq.heappush(self._deadlines, (request.deadline, request_id))
+            return request
+
+    def add(self, command, payload=None):
+        """Creates a new request and starts tracking it immediately. Returns the PendingRequest."""
+        return self.start(self.create(command, payload))
+
+    def pop(self, request_id):
+        """Stops tracking a request and returns it, or NONE if it isn't pending."""
+        with self._lock:
+            return self._pending.pop(request_id, None)
+
+    def next_deadline(self):
+        """Returns the earliest deadline of any pending request, or NONE."""
+        with self._lock:
+            self._discard_answered()
+            return self._deadlines[0][0] if self._deadlines else None
+
+    def expire(self, now=None):
+        """Removes and returns the requests whose deadline has passed."""
+        now = time.monotonic() if now is None else now
+        expired = []
+        with self._lock:
+            self._discard_answered()
+            while self._deadlines and self._deadlines[0][0] <= now:
+                deadline, request_id = heapq.heappop(self._deadlines)
+                request = self._pending.get(request_id)
+                if request is not None and request.deadline == deadline:
+                    del self._pending[request_id]
+                    expired.append(request)
+                self._discard_answered()
+        return expired
+
+    def clear(self):
+        """Stops tracking every request and returns the ones that were still pending."""
+        with self._lock:
+            pending = list(self._pending.values())
+            self._pending.clear()
+            self._deadlines = []
+            return pending
+
+    def _discard_answered(self):
+        # Heap entries are removed lazily - drop any at the top that no longer match a pending request.
+        while self._deadlines:
+            deadline, request_id = self._deadlines[0]
+            request = self._pending.get(request_id)
+            if request is not None and request.deadline == deadline:
+                break
+            heapq.heappop(self._deadlines)
@@ -0,0 +1,144 @@
+
+import re
+
+
+# Characters that make a permission node segment a regular expression rather than a plain name
+PATTERN_CHARS = set("^$*+?{}[]\\|()")
+
+
+class PermissionNode:
+    """A node in a PermissionMatcher trie. Each node is one segment of a permission."""
+    __slots__ = ('children', 'star', 'value')
+
+    def __init__(self):
+        self.children = {}      # Segment -> PermissionNode
+        self.star = None        # Node for a '*' segment, which matches one or more segments
+        self.value = None       # TRUE/FALSE if a permission ends here, otherwise NONE
+
+
+class PermissionMatcher:
+    """Matches permission nodes against a set of permission patterns.
+
+        A pattern is a dotted node where '*' matches anything, including further segments (so 'commands.*' matches
+        'commands.internal.ping'). Patterns are split into segments and stored in a trie, so a lookup follows only
+        the branches that match the requested node instead of testing every pattern. Patterns that can't be
+        split into whole segments (e.g. 'commands.mod*') are matched as regular expressions instead.
+
+        - permissions: dict of pattern -> allowed
+    """
+    def __init__(self, permissions):
+        self.root = PermissionNode()
+        self.patterns = []      # (compiled regex, allowed) for patterns that aren't in the trie
+
+        for perm, value in permissions.items():
+            segments = perm.split('.')
+            if all(seg == '*' or not PATTERN_CHARS.intersection(seg) for seg in segments):
+                node = self.root
+                for seg in segments:
+                    if seg == '*':
+                        node.star = node = node.star or PermissionNode()
+                    else:
+                        node = node.children.setdefault(seg, PermissionNode())
+                node.value = bool(value)
+            else:
+                self.patterns.append((re.compile(perm.replace(".", "\\.").replace("*", ".*")), bool(value)))
+
+    def check(self, permission):
+        """Returns FALSE if a matching pattern denies the permission, TRUE if one allows it, or NONE if none match.
+
+            - permission: the lower-cased permission node
+        """
+        found = set()
+        self._walk(self.root, permission.split('.'), 0, found)
+        if False not in found:
+            for regex, value in self.patterns:
+                if regex.fullmatch(permission):
+                    found.add(value)
+
+        if False in found:
+            return False    # Permission explicitly denied
+        return True if found else None
+
+    def _walk(self, node, segments, index, found):
+        if index == len(segments):
+            if node.value is not None:
+                found.add(node.value)
+            return
+
+        child = node.children.get(segments[index])
+        if child is not None:
+            self._walk(child, segments, index + 1, found)
+
+        if node.star is not None:
+            # '*' consumes at least one segment, and may consume the rest.
+            for end in range(index + 1, len(segments) + 1):
+                self._walk(node.star, segments, end, found)
+
+
+class PermissionMap(dict):
+    """A dict of permission pattern -> allowed that keeps a compiled PermissionMatcher of its contents.
+
+        The matcher is built on first use and thrown away whenever the dict is changed.
+    """
+    __slots__ = ('_matcher', '_version', 'owner')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._matcher = None
+        self._version = 0
+        self.owner = None       # Item whose cached permission results depend on this map
+
+    def matcher(self):
+        """Returns the compiled matcher for the current permissions."""
+        matcher = self._matcher
+        if matcher is None:
+            version = self._version
+            matcher = PermissionMatcher(dict(self))    # Copied in one step, in case another thread changes it
+            if version == self._version:
+                # Only keep it if nothing was changed while it was being built.
+                self._matcher = matcher
+        return matcher
+
+    def __reduce__(self):
+        return PermissionMap, (dict(self),)
+
+    def _changed(self):
+        self._version += 1
+        self._matcher = None
+        if self.owner is not None:
+            self.owner.invalidate()
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._changed()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._changed()
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def clear(self):
+        super().clear()
+        self._changed()
+
+    def pop(self, *args):
+        result = super().pop(*args)
+        self._changed()
+        return result
+
+    def popitem(self):
+        result = super().popitem()
+        self._changed()
+        return result
+
+    def setdefault(self, key, default=None):
+        result = super().setdefault(key, default)
+        self._changed()
+        return result
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self._changed()
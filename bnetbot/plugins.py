@@ -0,0 +1,324 @@
+
+import ast
+import importlib
+import importlib.util
+import logging
+import os
+import sys
+import threading
+import weakref
+
+
+# Installed packages advertise plugin modules under this entry point group, e.g. in setup.py:
+#   entry_points={"bnetbot.plugins": ["dice = mypackage.dice"]}
+ENTRY_POINT_GROUP = "bnetbot.plugins"
+
+# Plugins loaded from a directory are imported under this name, e.g. 'bnetbot_plugins.dice'
+PLUGIN_PACKAGE = "bnetbot_plugins"
+
+DEFAULT_PLUGINS = {
+    "directories": ["plugins"],     # Relative to the config file
+    "entry_points": True,
+    "disabled": []                  # Names of plugins to skip
+}
+
+
+def read_commands(source_path):
+    """Reads the commands a plugin defines from its source, without importing it.
+
+        The module must assign a literal list to COMMANDS, with an entry for each command:
+            COMMANDS = [("roll", "commands.dice.roll", "roll", ["r"])]
+        The fields are the command's name, its required permission, the name of its function in the module, and an
+        optional list of aliases. Raises ValueError if the list is missing or isn't in this form.
+    """
+    with open(source_path, "rb") as fh:
+        tree = ast.parse(fh.read(), source_path)
+
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(isinstance(t, ast.Name) and t.id == "COMMANDS" for t in node.targets):
+            try:
+                entries = ast.literal_eval(node.value)
+            except ValueError:
+                raise ValueError("COMMANDS must be a literal list")
+            break
+    else:
+        raise ValueError("no COMMANDS list found")
+
+    if not isinstance(entries, (list, tuple)):
+        raise ValueError("COMMANDS must be a list")
+
+    commands = []
+    for entry in entries:
+        if not isinstance(entry, (list, tuple)) or len(entry) not in [3, 4] or \
+                not all(isinstance(field, str) for field in entry[:3]):
+            raise ValueError("invalid command entry: %r" % (entry,))
+        aliases = entry[3] if len(entry) > 3 else []
+        if not isinstance(aliases, (list, tuple)) or not all(isinstance(alias, str) for alias in aliases):
+            raise ValueError("invalid aliases for command '%s': %r" % (entry[0], aliases))
+        commands.append((entry[0], entry[1], entry[2], list(aliases)))
+    return commands
+
+
+def find_entry_points(group=ENTRY_POINT_GROUP):
+    """Returns (name, module name) for each entry point in a group, from the installed packages."""
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        # Python < 3.8
+        try:
+            from pkg_resources import iter_entry_points
+        except ImportError:
+            return []
+        return [(ep.name, ep.module_name) for ep in iter_entry_points(group)]
+
+    found = entry_points()
+    found = found.select(group=group) if hasattr(found, "select") else found.get(group, [])
+    return [(ep.name, ep.value.split(":")[0].strip()) for ep in found]
+
+
+class LazyCallback:
+    """Stands in for a plugin command's function, importing the plugin the first time the command is run."""
+    def __init__(self, plugin, function):
+        self.plugin = plugin
+        self.function = function
+
+    def __call__(self, c):
+        try:
+            callback = self.plugin.function(self.function)
+        except Exception:
+            self.plugin.log.exception("Unable to load plugin '%s'.", self.plugin.name)
+            return c.respond("That command isn't available right now.")
+        return callback(c)
+
+    @property
+    def cache_ttl(self):
+        # Only known once the plugin is imported. Until then the command just isn't cached.
+        return getattr(self.plugin.loaded_function(self.function), "cache_ttl", None)
+
+    @property
+    def cache_per_user(self):
+        return getattr(self.plugin.loaded_function(self.function), "cache_per_user", False)
+
+
+class Plugin:
+    """A module of bot commands, which is imported the first time one of them is run.
+
+        - name: the plugin's name
+        - module_name: the name the module is imported as
+        - origin: the path of the module's source file
+        - from_file: TRUE if the module is loaded straight from 'origin', rather than imported by name
+    """
+    def __init__(self, name, module_name, origin, from_file=False):
+        self.name = name
+        self.module_name = module_name
+        self.origin = origin
+        self.from_file = from_file
+        self.module = None
+        self.log = logging.getLogger("bnetbot.plugins")
+
+        # Reload the module next time instead of using the copy that's already imported (e.g. by an earlier Plugin)
+        self._stale = not from_file and module_name in sys.modules
+        self._lock = threading.Lock()
+
+        # (command, permission, callback, aliases)
+        self.commands = [(command, permission, LazyCallback(self, function), aliases)
+                         for command, permission, function, aliases in read_commands(origin)]
+
+    @property
+    def loaded(self):
+        return self.module is not None
+
+    def load(self):
+        """Imports the plugin's module, if it hasn't been already, and returns it."""
+        with self._lock:
+            if self.module is not None:
+                return self.module
+
+            self.log.info("Loading plugin: %s", self.name)
+            if self.from_file:
+                # Compiled straight from the source, so a reload never picks up stale cached bytecode.
+                spec = importlib.util.spec_from_file_location(self.module_name, self.origin)
+                module = importlib.util.module_from_spec(spec)
+                sys.modules[self.module_name] = module
+                try:
+                    with open(self.origin, "rb") as fh:
+                        exec(compile(fh.read(), self.origin, "exec"), module.__dict__)
+                except BaseException:
+                    del sys.modules[self.module_name]
+                    raise
+            else:
+                module = importlib.import_module(self.module_name)
+                if self._stale:
+                    module = importlib.reload(module)
+                    self._stale = False
+            self.module = module
+            return module
+
+    def unload(self):
+        """Forgets the imported module, so the next command run imports it again."""
+        with self._lock:
+            if self.module is not None:
+                self.log.info("Unloading plugin: %s", self.name)
+                self.module = None
+                if self.from_file:
+                    sys.modules.pop(self.module_name, None)
+                else:
+                    self._stale = True
+
+    def function(self, name):
+        """Returns a function from the plugin's module, importing it if needed."""
+        module = self.module or self.load()
+        return getattr(module, name)
+
+    def loaded_function(self, name):
+        """Returns a function from the plugin's module, or NONE if the module hasn't been imported."""
+        module = self.module
+        return None if module is None else getattr(module, name, None)
+
+
+class PluginManager:
+    """Finds command plugins and registers their commands with bot instances.
+
+        Plugins are modules listed under the 'bnetbot.plugins' entry point group by installed packages, and .py
+        files in the plugin directories. Only their COMMANDS lists are read when they're found (see read_commands);
+        each module is imported the first time one of its commands is run. reload() picks up new, changed and
+        removed plugins without restarting the bot.
+
+        - directories: folders to look for plugin files in
+        - entry_points: FALSE to ignore plugins from installed packages
+        - disabled: names of plugins to skip
+    """
+    def __init__(self, directories=None, entry_points=True, disabled=None):
+        self.directories = directories or []
+        self.entry_points = entry_points
+        self.disabled = set(name.lower() for name in disabled or [])
+        self.plugins = {}                   # Lower-cased name -> Plugin
+        self.log = logging.getLogger("bnetbot.plugins")
+
+        self._instances = weakref.WeakSet()     # Instances the commands are registered with
+        self._lock = threading.RLock()
+
+    @classmethod
+    def from_config(cls, config, base_path=None):
+        """Creates a plugin manager from the bot's 'plugins' config section and finds the available plugins.
+
+            - base_path: the folder relative plugin directories are in
+        """
+        settings = dict(DEFAULT_PLUGINS)
+        settings.update(config or {})
+
+        directories = [os.path.join(base_path or "", d) for d in settings["directories"]]
+        manager = cls(directories, settings["entry_points"], settings["disabled"])
+        manager.discover()
+        return manager
+
+    def discover(self):
+        """Finds the available plugins, replacing any that were found before. Returns the dict of plugins."""
+        found = {}
+        for name, module_name in (find_entry_points() if self.entry_points else []):
+            if name.lower() not in self.disabled and name.lower() not in found:
+                self._add(found, name, module_name)
+
+        for directory in self.directories:
+            if not os.path.isdir(directory):
+                continue
+            for file_name in sorted(os.listdir(directory)):
+                name, ext = os.path.splitext(file_name)
+                if ext == ".py" and not name.startswith("_") and name.lower() not in self.disabled:
+                    if name.lower() in found:
+                        self.log.warning("Skipping plugin file '%s' - a plugin named '%s' was already found.",
+                                         os.path.join(directory, file_name), name)
+                    else:
+                        self._add(found, name, "%s.%s" % (PLUGIN_PACKAGE, name), os.path.join(directory, file_name))
+
+        with self._lock:
+            for plugin in self.plugins.values():
+                plugin.unload()
+            self.plugins = found
+        return found
+
+    def _add(self, found, name, module_name, path=None):
+        try:
+            if path is None:
+                # Locating the module only imports the packages it's in.
+                spec = importlib.util.find_spec(module_name)
+                if spec is None or not spec.origin or not spec.origin.endswith(".py"):
+                    raise ValueError("source file not found")
+                plugin = Plugin(name, module_name, spec.origin)
+            else:
+                plugin = Plugin(name, module_name, path, True)
+        except (ImportError, OSError, SyntaxError, ValueError) as ex:
+            self.log.warning("Skipping plugin '%s': %s", name, ex)
+        else:
+            found[name.lower()] = plugin
+
+    def commands(self):
+        """Yields (command, permission, callback, aliases) for each command the plugins define."""
+        for plugin in list(self.plugins.values()):
+            yield from plugin.commands
+
+    def attach(self, inst):
+        """Registers the plugins' commands with a bot instance, and again whenever they're reloaded.
+
+            Commands the instance already has from elsewhere aren't replaced.
+        """
+        with self._lock:
+            self._instances.add(inst)
+            self._register(inst, self.plugins.values())
+
+    def detach(self, inst):
+        """Removes the plugins' commands from a bot instance."""
+        with self._lock:
+            self._instances.discard(inst)
+            self._unregister(inst, self.plugins.values())
+
+    def reload(self, name=None):
+        """Reloads a plugin, or finds all the plugins again if 'name' is NONE, and updates the instances' commands.
+
+            Returns the names of the plugins that were reloaded, or NONE if there's no plugin with that name. If a
+            single plugin can't be read, its current version is kept and an empty list is returned.
+        """
+        with self._lock:
+            old = list(self.plugins.values())
+            if name is None:
+                self.discover()
+                new = list(self.plugins.values())
+            else:
+                plugin = self.plugins.get(name.lower())
+                if plugin is None:
+                    return None
+
+                replacement = {}
+                self._add(replacement, plugin.name, plugin.module_name, plugin.origin if plugin.from_file else None)
+                if not replacement:
+                    # The old version keeps working until the plugin is fixed.
+                    return []
+
+                plugin.unload()
+                old = [plugin]
+                self.plugins.update(replacement)
+                new = list(replacement.values())
+
+            # The new commands replace the old ones before what's left of the old ones is removed, so a command
+            #   that's in both is never missing.
+            for inst in list(self._instances):
+                self._register(inst, new)
+                self._unregister(inst, old)
+                inst.result_cache.clear()       # Responses from the old code
+            return [plugin.name for plugin in new]
+
+    def _register(self, inst, plugins):
+        for plugin in plugins:
+            for command, permission, callback, aliases in plugin.commands:
+                existing = inst.commands.get(command.lower())
+                if existing is not None and not isinstance(existing.callback, LazyCallback):
+                    inst.log.warning("Plugin '%s' command '%s' is already defined - skipping.", plugin.name, command)
+                else:
+                    inst.register_command(command, permission, callback, aliases)
+
+    def _unregister(self, inst, plugins):
+        for plugin in plugins:
+            for command, permission, callback, aliases in plugin.commands:
+                existing = inst.commands.get(command.lower())
+                if existing is not None and existing.callback is callback:
+                    inst.unregister_command(command)
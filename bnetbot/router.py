@@ -0,0 +1,134 @@
+
+import re
+import threading
+
+
+NAME_PATTERN = re.compile(r"\S+")
+ARG_PATTERN = re.compile(r'"([^"]*)"?|(\S+)')
+
+AMBIGUOUS = object()    # RouteNode.unique for a prefix shared by more than one command
+
+
+def split_args(text):
+    """Splits command arguments on whitespace. Words in double quotes are kept together as one argument, and a quote
+        that isn't closed runs to the end of the text.
+    """
+    return [word if word is not None else quoted for quoted, word in
+            (m.groups() for m in ARG_PATTERN.finditer(text))]
+
+
+class Triggers:
+    """The triggers that start a command, e.g. '!' in '!ping'.
+
+        Every chat message is checked against these, so a message that can't be a command is turned away by
+        looking at its first character before anything else is done with it.
+
+        - triggers: a trigger, or a list of them
+    """
+    def __init__(self, triggers):
+        if isinstance(triggers, str):
+            triggers = [triggers]
+        self.triggers = sorted((t for t in triggers if t), key=len, reverse=True)    # Longest first: '!!' before '!'
+        self.first = frozenset(t[0] for t in self.triggers)
+
+    def match(self, message):
+        """Returns (trigger, command name, end of the name) if a message starts with a trigger and a name, or NONE."""
+        if not message or message[0] not in self.first:
+            return None
+
+        for trigger in self.triggers:
+            if message.startswith(trigger):
+                name = NAME_PATTERN.match(message, len(trigger))
+                if name:
+                    return trigger, name.group(), name.end()
+        return None
+
+
+class RouteNode:
+    """A node in a CommandRouter trie. Each node is one character of a command name or alias."""
+    __slots__ = ('children', 'command', 'unique')
+
+    def __init__(self):
+        self.children = {}      # Character -> RouteNode
+        self.command = None     # CommandDefinition if a name or alias ends here
+        self.unique = None      # The only command with names starting here, or AMBIGUOUS
+
+
+class CommandRouter:
+    """Finds commands by their name, an alias, or the start of their name.
+
+        Names and aliases are kept in a prefix trie, which is rebuilt on the first lookup after a change. A name
+        that isn't a full name or alias matches the command it's the start of, if there's only one. Commands can be
+        added and removed (e.g. by a plugin reload) while other threads are looking them up.
+
+        - abbreviations: FALSE to only match full names and aliases
+    """
+    def __init__(self, abbreviations=True):
+        self.commands = {}      # Lower-cased name -> CommandDefinition
+        self.aliases = {}       # Lower-cased alias -> lower-cased command name
+        self.abbreviations = abbreviations
+        self._root = None
+        self._lock = threading.Lock()
+
+    def add(self, definition, aliases=None):
+        """Adds a command, replacing any with the same name."""
+        with self._lock:
+            self.commands[definition.name.lower()] = definition
+            for alias in aliases or []:
+                self.aliases[alias.lower()] = definition.name.lower()
+            self._root = None
+
+    def remove(self, name):
+        """Removes a command. Its aliases are kept, in case it's added again."""
+        with self._lock:
+            self.commands.pop(name.lower(), None)
+            self._root = None
+
+    def alias(self, alias, command):
+        """Makes an alias for a command. The command doesn't need to be added yet."""
+        with self._lock:
+            self.aliases[alias.lower()] = command.lower()
+            self._root = None
+
+    def resolve(self, name):
+        """Returns the CommandDefinition for a command name, alias or abbreviation, or NONE if there isn't one."""
+        key = name.lower()
+        command = self.commands.get(key)
+        if command is not None:
+            return command
+
+        node = self._root
+        if node is None:
+            with self._lock:
+                node = self._root = self._root or self._build()
+        for char in key:
+            node = node.children.get(char)
+            if node is None:
+                return None
+
+        if node.command is not None:
+            return node.command
+        elif self.abbreviations and node.unique is not AMBIGUOUS:
+            return node.unique
+        return None
+
+    def _build(self):
+        # Called with the lock held, so the dicts can't change while they're read.
+        names = {alias: self.commands[target] for alias, target in self.aliases.items() if target in self.commands}
+        names.update(self.commands)     # Command names win over aliases
+
+        root = RouteNode()
+        for name, definition in names.items():
+            node = root
+            for char in name:
+                child = node.children.get(char)
+                if child is None:
+                    child = node.children[char] = RouteNode()
+                node = child
+
+                if node.unique is None:
+                    node.unique = definition
+                elif node.unique is not definition:
+                    node.unique = AMBIGUOUS
+            node.command = definition
+        return root
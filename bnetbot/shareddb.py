@@ -0,0 +1,149 @@
+
+from .database import DatabaseItem, UserDatabase
+
+import logging
+import threading
+
+
+class SharedDatabases:
+    """The named user databases that instances can share, from the 'databases' element of the bot config.
+
+        Each database is loaded once, on first use, and every instance referring to it uses the same items. So
+        memory grows with the number of users rather than with users times instances, and a change made through
+        one instance is seen by all of them straight away.
+
+        - config: dict of database name -> 'database' config element (JSON, or 'sqlite' to use an SQLite file)
+    """
+    def __init__(self, config=None):
+        self.config = config or {}
+        self._loaded = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        """Returns the named database, loading it if needed. A name that isn't configured gets a new database."""
+        with self._lock:
+            db = self._loaded.get(name)
+            if db is None:
+                db = self._loaded[name] = UserDatabase.load(self.config.get(name))
+            return db
+
+    def to_config(self):
+        """Commits the loaded databases and returns them as a dict of name -> 'database' config element."""
+        with self._lock:
+            loaded = list(self._loaded.items())
+
+        config = {}
+        for name, db in loaded:
+            with db.lock:
+                db.commit()
+                config[name] = db.to_config()
+        return config
+
+
+class OverlayUserDatabase:
+    """An instance's view of a shared user database, with the instance's own users and groups on top of it.
+
+        Items in the overlay replace shared items of the same name for this instance only, and are saved in the
+        instance's config. Everything else, including items added through this view, lives in the shared database.
+        Overlay users can be members of shared groups.
+
+        - name: the name of the shared database
+        - shared: the shared UserDatabase or SqliteUserDatabase
+    """
+    def __init__(self, name, shared):
+        self.name = name
+        self.shared = shared
+        self.local = UserDatabase()
+        self.local.groups = {}
+        self.local.users = {}
+        self.lock = shared.lock     # Changes through any view of the shared database are made one at a time
+
+    def to_config(self):
+        """Returns the 'database' element for an instance's configuration: the shared name and the overlay."""
+        config = {"shared": self.name}
+        config.update({k: v for k, v in self.local.to_config().items() if v})
+        return config
+
+    def commit(self):
+        """Writes pending changes to the overlay. The shared database is saved with the bot config."""
+        return self.local.commit()
+
+    def add(self, item):
+        """Adds a user object to the overlay if it replaces an overlay item, or to the shared database."""
+        if (self.local.group if item.is_group else self.local.user)(item.name) is not None:
+            return self.local.add(item)
+        return self.shared.add(item)
+
+    def remove(self, item):
+        """Removes a user object from the overlay or, if it isn't in the overlay, the shared database."""
+        if (self.local.group if item.is_group else self.local.user)(item.name) is item:
+            return self.local.remove(item)
+        return self.shared.remove(item)
+
+    def user(self, username):
+        """Returns a user object matching a given name."""
+        return self.local.user(username) or self.shared.user(username)
+
+    def group(self, group_name):
+        """Returns a group object matching a given name."""
+        return self.local.group(group_name) or self.shared.group(group_name)
+
+    def entries(self):
+        """Yields (is_group, name, entry) for every group and then every user seen by this instance."""
+        for item in list(self.local.groups.values()):
+            yield True, item.name, item.to_config()
+
+        # Shared entries also come groups first, so the overlay users go between the shared groups and users.
+        users = None
+        for entry in self.shared.entries():
+            if not entry[0] and users is None:
+                users = [(False, item.name, item.to_config()) for item in list(self.local.users.values())]
+                yield from users
+            if entry[1].lower() not in (self.local.groups if entry[0] else self.local.users):
+                yield entry
+        if users is None:
+            for item in list(self.local.users.values()):
+                yield False, item.name, item.to_config()
+
+    def import_entries(self, entries):
+        """Adds or replaces users and groups from database entries. Returns the number imported.
+
+            Entries for overlay items replace them in the overlay, and the rest go to the shared database.
+        """
+        local = []
+        shared = []
+        for entry in entries:
+            items = self.local.groups if entry[0] else self.local.users
+            (local if entry[1].lower() in items else shared).append(entry)
+
+        count = self.shared.import_entries(shared) if shared else 0
+        if local:
+            # Overlay items are linked to groups from both databases.
+            for is_group, name, entry in sorted(local, key=lambda e: not e[0]):
+                links = {gp.lower(): self.group(gp) for gp in entry.get("groups", [])}
+                count += self.local.import_entries([(is_group, name, entry)], links)
+        return count
+
+    @classmethod
+    def load(cls, config, databases):
+        """Creates a view of the shared database named by the 'shared' key of a 'database' config element.
+
+            - databases: the SharedDatabases to find the shared database in
+        """
+        db = cls(config["shared"], databases.get(config["shared"]))
+
+        group_list = config.get("groups", {})
+        for name, group in group_list.items():
+            db.local.groups[name.lower()] = DatabaseItem.load(group, name, True)
+        for name, group in group_list.items():
+            item = db.local.groups[name.lower()]
+            for group_name in [gp.lower() for gp in group.get("groups", [])]:
+                try:
+                    item.groups.link(group_name, db.group(group_name))
+                except ValueError as ex:
+                    logging.getLogger("bnetbot").warning("Ignoring database group link: %s", ex)
+
+        for name, user in config.get("users", {}).items():
+            links = {gp.lower(): db.group(gp) for gp in user.get("groups", [])}
+            db.local.users[name.lower()] = DatabaseItem.load(user, name, False, links)
+        return db
@@ -0,0 +1,204 @@
+
+from .database import DatabaseItem, UserDatabase, mark_changed
+
+import json
+import logging
+import sqlite3
+import threading
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    is_group INTEGER NOT NULL,
+    key TEXT NOT NULL,          -- Lower-cased name
+    name TEXT NOT NULL,
+    data TEXT NOT NULL,         -- The item's JSON database entry
+    PRIMARY KEY (is_group, key)
+)
+"""
+
+
+class SqliteUserDatabase:
+    """A user database stored in an SQLite file, with the same interface as UserDatabase.
+
+        Users and groups are only read from the file when they're looked up, and are then kept in memory so changes
+        made to them can be saved. Adding and removing items is written straight away; changes to loaded items are
+        written by commit(), one transaction for all of them.
+
+        - path: the database file, relative to the working directory
+    """
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(SCHEMA)
+        self._lock = threading.RLock()     # Guards the connection and loaded items
+        self.lock = threading.RLock()      # Held by commands that change the database, like UserDatabase.lock
+        self._groups = {}       # Loaded items: key -> DatabaseItem
+        self._users = {}
+        self._saved = {}        # (is_group, key) -> entry as last written, for finding changed items
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM items WHERE is_group = 0").fetchone()[0]
+
+    def empty(self):
+        """Returns TRUE if the file has no users or groups in it."""
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM items LIMIT 1").fetchone() is None
+
+    def to_config(self):
+        """Returns the 'database' element for an instance's configuration, which points at the file."""
+        return {"sqlite": self.path}
+
+    def add(self, item):
+        """Adds a user object to the database."""
+        if not isinstance(item, DatabaseItem):
+            raise TypeError("Can't add type %s to user database." % type(item).__name__)
+
+        with self._lock, self._conn:
+            self._write(item)
+            (self._groups if item.is_group else self._users)[item.name.lower()] = item
+        mark_changed()
+        return item
+
+    def remove(self, item):
+        """Removes a user object from the database."""
+        if not isinstance(item, DatabaseItem):
+            raise TypeError("Can't remove type %s from the user database." % type(item).__name__)
+
+        key = item.name.lower()
+        with self._lock, self._conn:
+            cursor = self._conn.execute("DELETE FROM items WHERE is_group = ? AND key = ?", (int(item.is_group), key))
+            loaded = (self._groups if item.is_group else self._users).pop(key, None)
+            self._saved.pop((item.is_group, key), None)
+            if cursor.rowcount == 0 and loaded is None:
+                raise KeyError(key)
+        mark_changed()
+        return None
+
+    def user(self, username):
+        """Returns a user object matching a given name."""
+        return self._get(False, username)
+
+    def group(self, group_name):
+        """Returns a group object matching a given name."""
+        return self._get(True, group_name)
+
+    def commit(self):
+        """Writes the loaded items that have changed since they were read or last written."""
+        with self._lock:
+            changed = []
+            for is_group, items in ((True, self._groups), (False, self._users)):
+                for key, item in items.items():
+                    if self._saved.get((is_group, key)) != item.to_config():
+                        changed.append(item)
+
+            if changed:
+                with self._conn:
+                    for item in changed:
+                        self._write(item)
+            return len(changed)
+
+    def close(self):
+        self.commit()
+        self._conn.close()
+
+    def entries(self, page_size=500):
+        """Yields (is_group, name, entry) for every group and then every user, reading the file a page at a time.
+
+            Loaded items are committed first so their changes are included. Other threads can use the database
+            between pages.
+        """
+        self.commit()
+        for is_group in (1, 0):
+            key = ""
+            while True:
+                with self._lock:
+                    rows = self._conn.execute("SELECT key, name, data FROM items WHERE is_group = ? AND key > ? "
+                                              "ORDER BY key LIMIT ?", (is_group, key, page_size)).fetchall()
+                for key, name, data in rows:
+                    yield bool(is_group), name, json.loads(data)
+                if len(rows) < page_size:
+                    break
+
+    def import_entries(self, entries):
+        """Adds or replaces users and groups from database entries in one transaction. Returns the number imported.
+
+            Entries are written without being loaded. A loaded group is updated in place to keep its members, and a
+            loaded user is dropped so its next lookup reads the new entry. Entries that would create a cycle of
+            groups are skipped with a warning.
+
+            - entries: list of (is_group, name, entry) tuples
+        """
+        count = 0
+        with self._lock, self._conn:
+            for is_group, name, entry in sorted(entries, key=lambda e: not e[0]):
+                key = name.lower()
+                if is_group and key in self._groups:
+                    links = {gp.lower(): self.group(gp) for gp in entry.get("groups", [])}
+                    try:
+                        self._groups[key].assign(DatabaseItem.load(entry, name, True, links))
+                    except ValueError as ex:
+                        logging.getLogger("bnetbot").warning("Skipping imported group '%s': %s", name, ex)
+                        continue
+                    entry = self._saved[(True, key)] = self._groups[key].to_config()
+                elif not is_group and self._users.pop(key, None) is not None:
+                    self._saved.pop((False, key), None)
+
+                self._conn.execute("INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?)",
+                                   (int(is_group), key, name, json.dumps(entry)))
+                count += 1
+        mark_changed()
+        return count
+
+    def import_items(self, items):
+        """Writes many items in one transaction, without loading them into memory."""
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?)",
+                                   ((int(item.is_group), item.name.lower(), item.name, json.dumps(item.to_config()))
+                                    for item in items))
+
+    @classmethod
+    def load(cls, config):
+        """Opens the file named by the 'sqlite' key of a 'database' config element.
+
+            If the file is new, it's filled from any 'groups' and 'users' still in the config element (a one-way
+            migration from the JSON database), or with the default groups if there are none.
+        """
+        db = cls(config["sqlite"])
+        if db.empty():
+            source = UserDatabase.load({k: v for k, v in config.items() if k != "sqlite"})
+            db.import_items(list(source.groups.values()) + list(source.users.values()))
+        return db
+
+    def _get(self, is_group, name):
+        key = name.lower()
+        items = self._groups if is_group else self._users
+        with self._lock:
+            item = items.get(key)
+            if item is not None:
+                return item
+
+            row = self._conn.execute("SELECT name, data FROM items WHERE is_group = ? AND key = ?",
+                                     (int(is_group), key)).fetchone()
+            if row is None:
+                return None
+
+            data = json.loads(row[1])
+            item = items[key] = DatabaseItem.load(data, row[0], is_group)
+            self._saved[(is_group, key)] = data
+
+            # Link groups, loading them if needed. The item is cached first so cyclic links can't recurse forever.
+            for group_name in [gp.lower() for gp in data.get("groups", [])]:
+                try:
+                    item.groups.link(group_name, self.group(group_name))
+                except ValueError as ex:
+                    logging.getLogger("bnetbot").warning("Ignoring database group link: %s", ex)
+            return item
+
+    def _write(self, item):
+        # Must be called inside a transaction.
+        entry = item.to_config()
+        self._conn.execute("INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?)",
+                           (int(item.is_group), item.name.lower(), item.name, json.dumps(entry)))
+        self._saved[(item.is_group, item.name.lower())] = entry
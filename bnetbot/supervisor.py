@@ -0,0 +1,310 @@
+
+from .bot import BnetBot
+from .commands import SOURCE_LOCAL
+from .instance import BotInstance
+from .util.logs import start_logging
+
+from multiprocessing.connection import wait
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+
+# Messages sent from the supervisor to a worker
+MSG_CONSOLE = "console"     # (MSG_CONSOLE, profile name, text)
+MSG_STOP = "stop"           # (MSG_STOP, force)
+
+# Messages sent from a worker to the supervisor
+MSG_SAVE = "save"           # (MSG_SAVE, {profile name: profile config}, {shared database name: database config})
+
+
+def assign_instances(names, workers, shared=None):
+    """Spreads profile names over a number of workers. Returns a dict of lower-cased name -> worker index.
+
+        Profiles that share a user database are put on the same worker, so each shared database is only changed
+        and saved by one process.
+
+        - shared: dict of profile name -> the name of the shared database it uses, for profiles that use one
+    """
+    shared = {name.lower(): database for name, database in (shared or {}).items()}
+    assignments = {}
+    owners = {}         # Shared database name -> worker index
+    count = 0
+    for name in sorted(names, key=str.lower):
+        database = shared.get(name.lower())
+        if database in owners:
+            assignments[name.lower()] = owners[database]
+            continue
+
+        assignments[name.lower()] = count % workers
+        if database is not None:
+            owners[database] = count % workers
+        count += 1
+    return assignments
+
+
+class WorkerBot(BnetBot):
+    """A bot running some of the configured profiles in a worker process.
+
+        Config writes are sent to the supervisor, which merges them into the full config and saves it.
+    """
+    def __init__(self, connection, config=None):
+        self.connection = connection
+        super().__init__(config, False)
+
+    def save_config(self, save_path=None, instances=None):
+        instances = list(self.instances.values() if instances is None else instances)
+        for inst in instances:
+            inst.write_config()
+        self.connection.send((MSG_SAVE, {inst.name: inst.config for inst in instances}, self.databases.to_config()))
+
+    def console(self, name, text):
+        """Runs a line of console input on one of this worker's profiles."""
+        inst = self.instances.get(name.lower())
+        if inst is None:
+            return
+
+        if text.startswith('/') and len(text) > 1:
+            obj = inst.parse_command(text, SOURCE_LOCAL)
+            if obj:
+                inst.execute_command(obj, "%root%")     # Run as root
+        elif text:
+            inst.client.chat(text)
+
+
+def run_worker(index, config_path, names, connection, log_level=logging.INFO):
+    """Entry point for a worker process. Runs the named profiles until told to stop by the supervisor."""
+    # Ctrl+C reaches every process on the console - leave it to the supervisor to shut the workers down.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    start_logging(log_level)
+
+    bot = WorkerBot(connection, config_path)
+    bot.log.debug("Worker %i starting with profiles: %s", index, ", ".join(names))
+    instances = bot.config.get("instances", {})
+    for name in names:
+        bot.load_instance(BotInstance(name, instances[name], databases=bot.databases), False)
+    bot.start()
+
+    try:
+        while True:
+            try:
+                message = connection.recv()
+            except (EOFError, OSError):
+                # The supervisor has gone away.
+                bot.running = False
+                for inst in bot.instances.values():
+                    inst.stop(True)
+                break
+
+            if message[0] == MSG_CONSOLE:
+                try:
+                    bot.console(message[1], message[2])
+                except Exception:
+                    bot.log.exception("Console command failed: %s", message[2])
+            elif message[0] == MSG_STOP:
+                bot.stop(message[1])
+                break
+    finally:
+        connection.close()
+
+
+class WorkerProcess:
+    """The supervisor's handle on one worker process."""
+    def __init__(self, index, names):
+        self.index = index
+        self.names = names
+        self.process = None
+        self.connection = None
+        self.started = None
+        self.restart_at = None
+        self.crashes = 0
+
+
+class Supervisor:
+    """Runs the configured profiles spread over several worker processes.
+
+        Each worker runs its share of the profiles with its own bot, so busy profiles don't compete for one
+        interpreter. Workers that exit unexpectedly are restarted, after a delay that grows if they keep crashing.
+        Config changes from the workers are merged back into the supervisor's copy, which is the only one saved.
+
+        - config: the path to the config file
+        - workers: the number of worker processes. Defaults to the number of CPU cores (or profiles, if fewer).
+        - restart_delay: seconds to wait before restarting a crashed worker, doubled for each crash in a row
+    """
+    def __init__(self, config=None, workers=None, restart_delay=1.0, max_restart_delay=60.0):
+        self.log = logging.getLogger("bnetbot")
+        self.bot = BnetBot(config, False)
+        self.config = self.bot.config
+        self.running = False
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+
+        instances = self.config.get("instances", {})
+        names = [name for name, cfg in instances.items() if cfg.get("enabled", True)]
+        shared = {name: instances[name]["database"]["shared"] for name in names
+                  if "shared" in (instances[name].get("database") or {})}
+
+        # Workers are filled in turn, so when there are fewer profiles (or groups sharing a database) than workers
+        #   only the first few are used.
+        self.profiles = {name.lower(): name for name in names}
+        self.assignments = assign_instances(names, workers or os.cpu_count() or 1, shared)
+        count = max(self.assignments.values(), default=0) + 1
+        self.database_owners = {database: self.assignments[name.lower()] for name, database in shared.items()}
+        self.workers = []
+        for i in range(count):
+            self.workers.append(WorkerProcess(i, [name for name in names if self.assignments[name.lower()] == i]))
+
+        self._context = multiprocessing.get_context("spawn")    # Don't fork a process that's running threads
+        self._lock = threading.Lock()
+        self._thread = None
+        self._wake_r, self._wake_w = self._context.Pipe(False)
+
+    def start(self):
+        self.log.info("Starting %i profiles in %i worker processes...", len(self.profiles), len(self.workers))
+        self.running = True
+        for worker in self.workers:
+            self._spawn(worker)
+
+        self._thread = threading.Thread(target=self._run, name="bnetbot-supervisor")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, force=False, timeout=15):
+        """Stops every worker, waits for their final config changes and saves the config."""
+        self.log.debug("Stopping worker processes (force: %s)...", force)
+        with self._lock:
+            self.running = False
+            workers = [w for w in self.workers if w.process and w.process.is_alive()]
+            for worker in workers:
+                if worker.connection is None:
+                    continue
+                try:
+                    worker.connection.send((MSG_STOP, force))
+                except OSError:
+                    pass
+
+        end = time.monotonic() + timeout
+        for worker in workers:
+            worker.process.join(max(0, end - time.monotonic()))
+            if worker.process.is_alive():
+                self.log.warning("Worker %i didn't stop in time - terminating it.", worker.index)
+                worker.process.terminate()
+                worker.process.join()
+
+        self._wake_w.send(None)
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+        self.bot.writer.stop(False)
+        self.bot.save_config()
+
+    def owner(self, name):
+        """Returns the worker running a profile, or NONE if there's no such profile."""
+        index = self.assignments.get(name.lower())
+        return None if index is None else self.workers[index]
+
+    def console(self, name, text):
+        """Sends a line of console input to a profile. Returns FALSE if the profile isn't running."""
+        worker = self.owner(name)
+        with self._lock:
+            if worker is None or worker.connection is None or not worker.process.is_alive():
+                return False
+            try:
+                worker.connection.send((MSG_CONSOLE, self.profiles[name.lower()], text))
+            except OSError:
+                return False
+        return True
+
+    def _spawn(self, worker):
+        parent, child = self._context.Pipe()
+        args = (worker.index, self.bot.config_path, worker.names, child, self.log.getEffectiveLevel())
+        worker.process = self._context.Process(target=run_worker, args=args, name="bnetbot-worker-%i" % worker.index)
+        worker.process.daemon = True
+        worker.process.start()
+        child.close()
+
+        worker.connection = parent
+        worker.started = time.monotonic()
+        worker.restart_at = None
+
+    def _run(self):
+        # Handles messages from workers and restarts the ones that die, until the supervisor is stopped.
+        while True:
+            with self._lock:
+                waiting = [self._wake_r]
+                restart = None
+                for worker in self.workers:
+                    if worker.connection:
+                        waiting.append(worker.connection)
+                    if worker.process and worker.restart_at is None:
+                        waiting.append(worker.process.sentinel)
+                    elif worker.restart_at is not None:
+                        restart = worker.restart_at if restart is None else min(restart, worker.restart_at)
+
+            timeout = None if restart is None else max(0, restart - time.monotonic())
+            ready = wait(waiting, timeout)
+            if self._wake_r in ready:
+                self._wake_r.recv()
+                if not self.running:
+                    self._drain()
+                    return
+
+            for worker in self.workers:
+                if worker.connection in ready:
+                    self._receive(worker)
+
+            with self._lock:
+                now = time.monotonic()
+                for worker in self.workers:
+                    if worker.restart_at is not None:
+                        if self.running and worker.restart_at <= now:
+                            self.log.info("Restarting worker %i...", worker.index)
+                            self._spawn(worker)
+                    elif worker.process and worker.process.sentinel in ready and self.running:
+                        self._crashed(worker, now)
+
+    def _receive(self, worker):
+        try:
+            message = worker.connection.recv()
+        except (EOFError, OSError):
+            # The worker has exited - its sentinel tells us whether it needs restarting.
+            worker.connection.close()
+            worker.connection = None
+            return
+
+        if message[0] == MSG_SAVE:
+            instances = self.config.setdefault("instances", {})
+            for name, cfg in message[1].items():
+                instances[name] = cfg
+            # Only the worker running a shared database's profiles can change it. Copies that other workers may
+            #   have loaded are ignored.
+            databases = {name: cfg for name, cfg in message[2].items()
+                         if self.database_owners.get(name) == worker.index}
+            if databases:
+                self.config.setdefault("databases", {}).update(databases)
+            self.bot.writer.mark_dirty()
+
+    def _drain(self):
+        # Picks up the final config changes sent by workers as they stopped.
+        for worker in self.workers:
+            while worker.connection and worker.connection.poll():
+                self._receive(worker)
+
+    def _crashed(self, worker, now):
+        # Workers that keep crashing soon after starting are restarted less and less often.
+        if now - worker.started < self.max_restart_delay:
+            worker.crashes += 1
+        else:
+            worker.crashes = 1
+        delay = min(self.max_restart_delay, self.restart_delay * 2 ** (worker.crashes - 1))
+
+        self.log.warning("Worker %i (%s) exited with code %s - restarting in %.1f seconds.",
+                         worker.index, ", ".join(worker.names), worker.process.exitcode, delay)
+        while worker.connection and worker.connection.poll():
+            self._receive(worker)
+        if worker.connection:
+            worker.connection.close()
+            worker.connection = None
+        worker.restart_at = now + delay
@@ -0,0 +1,162 @@
+
+from .database import parse_isoformat
+
+import csv
+import json
+import logging
+
+
+# File formats for importing and exporting user databases
+FORMAT_JSONL = "jsonl"      # One JSON object per line: {"type": "user", "name": ..., "permissions": {...}, ...}
+FORMAT_CSV = "csv"          # Columns below. Permissions and groups are space separated, with denied permissions
+                            #   written as '-permission'.
+FORMATS = [FORMAT_JSONL, FORMAT_CSV]
+
+CSV_FIELDS = ["type", "name", "permissions", "groups", "modified_by", "added", "modified"]
+
+DEFAULT_BATCH_SIZE = 500
+
+
+def guess_format(path):
+    """Returns the file format to use for a path, based on its extension."""
+    return FORMAT_CSV if path.lower().endswith(".csv") else FORMAT_JSONL
+
+
+def make_entry(item_type, name, permissions=None, groups=None, modified_by=None, added=None, modified=None):
+    """Checks the fields of an imported user or group and returns it as (is_group, name, entry).
+
+        Raises ValueError if a field isn't valid.
+    """
+    item_type = str(item_type or "").lower()
+    if item_type not in ["user", "group"]:
+        raise ValueError("type must be 'user' or 'group', not '%s'" % item_type)
+    elif not isinstance(name, str) or not name.strip() or len(name.split()) > 1:
+        raise ValueError("'%s' is not a valid name" % name)
+
+    permissions = permissions or {}
+    groups = groups or []
+    if not isinstance(permissions, dict) or not all(isinstance(v, bool) for v in permissions.values()):
+        raise ValueError("permissions must map each permission to true or false")
+    elif not isinstance(groups, list) or not all(isinstance(g, str) and g for g in groups):
+        raise ValueError("groups must be a list of group names")
+
+    for timestamp in [added, modified]:
+        if timestamp and (not isinstance(timestamp, str) or parse_isoformat(timestamp) is None):
+            raise ValueError("'%s' is not an ISO 8601 timestamp" % timestamp)
+
+    entry = {
+        "permissions": {perm.lower(): allow for perm, allow in permissions.items()},
+        "groups": groups,
+        "modified_by": modified_by,
+        "added": added,
+        "modified": modified
+    }
+    return item_type == "group", name.strip(), {k: v for k, v in entry.items() if v}
+
+
+def read_entries(fh, fmt=FORMAT_JSONL):
+    """Reads users and groups from a file one at a time.
+
+        Yields (line number, entry) where entry is an (is_group, name, entry) tuple, or the ValueError raised for a
+        line that couldn't be read.
+    """
+    if fmt == FORMAT_CSV:
+        reader = csv.DictReader(fh)
+        for row in reader:
+            try:
+                permissions = {}
+                for perm in (row.get("permissions") or "").split():
+                    permissions[perm.lstrip("-")] = not perm.startswith("-")
+                yield reader.line_num, make_entry(row.get("type"), row.get("name"), permissions,
+                                                  (row.get("groups") or "").split(), row.get("modified_by") or None,
+                                                  row.get("added") or None, row.get("modified") or None)
+            except ValueError as ex:
+                yield reader.line_num, ex
+    elif fmt == FORMAT_JSONL:
+        for line_num, line in enumerate(fh, 1):
+            if not line.strip():
+                continue
+            try:
+                data = json.loads(line)
+                if not isinstance(data, dict):
+                    raise ValueError("expected a JSON object")
+                yield line_num, make_entry(data.get("type"), data.get("name"), data.get("permissions"),
+                                           data.get("groups"), data.get("modified_by"), data.get("added"),
+                                           data.get("modified"))
+            except ValueError as ex:
+                yield line_num, ex
+    else:
+        raise ValueError("Unknown file format '%s'." % fmt)
+
+
+def import_file(db, fh, fmt=FORMAT_JSONL, batch_size=DEFAULT_BATCH_SIZE, flush=None, progress=None):
+    """Streams users and groups from a file into a user database. Returns (imported, skipped).
+
+        The file is read a line at a time and imported in batches, so it's never held in memory all at once.
+        Groups should come before the users in them (as they do in exported files), or they're only linked once
+        the database is reloaded.
+
+        - db: the UserDatabase or SqliteUserDatabase to import into
+        - fh: a text file opened for reading (with newline='' for CSV files)
+        - flush: optional function called after each batch to save the changes
+        - progress: optional function called after each batch with the number of entries imported and skipped
+    """
+    log = logging.getLogger("bnetbot")
+    imported = skipped = 0
+    batch = []
+
+    def import_batch():
+        nonlocal imported, skipped
+        count = db.import_entries(batch)
+        imported += count
+        skipped += len(batch) - count
+        del batch[:]
+
+        if flush:
+            flush()
+        if progress:
+            progress(imported, skipped)
+
+    for line_num, entry in read_entries(fh, fmt):
+        if isinstance(entry, ValueError):
+            log.warning("Skipping line %i of imported file: %s", line_num, entry)
+            skipped += 1
+            continue
+
+        batch.append(entry)
+        if len(batch) >= batch_size:
+            import_batch()
+
+    if batch:
+        import_batch()
+    return imported, skipped
+
+
+def export_file(db, fh, fmt=FORMAT_JSONL, batch_size=DEFAULT_BATCH_SIZE, progress=None):
+    """Streams every group and then every user from a user database to a file. Returns the number exported.
+
+        - fh: a text file opened for writing (with newline='' for CSV files)
+        - progress: optional function called with the number of entries written every 'batch_size' entries
+    """
+    if fmt == FORMAT_CSV:
+        writer = csv.DictWriter(fh, CSV_FIELDS, extrasaction="ignore")
+        writer.writeheader()
+    elif fmt != FORMAT_JSONL:
+        raise ValueError("Unknown file format '%s'." % fmt)
+
+    count = 0
+    for is_group, name, entry in db.entries():
+        if fmt == FORMAT_CSV:
+            row = dict(entry, type="group" if is_group else "user", name=name)
+            row["permissions"] = " ".join(p if allow else "-" + p for p, allow in entry.get("permissions", {}).items())
+            row["groups"] = " ".join(entry.get("groups", []))
+            writer.writerow(row)
+        else:
+            row = {"type": "group" if is_group else "user", "name": name}
+            row.update(entry)
+            fh.write(json.dumps(row) + "\n")
+
+        count += 1
+        if progress and count % batch_size == 0:
+            progress(count)
+    return count
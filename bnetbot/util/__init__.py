@@ -1,3 +1,4 @@
 
 from .events import PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW
 from .events import PriorityDispatcher, EventSource
+from .loop import EventLoopThread
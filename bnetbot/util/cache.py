@@ -0,0 +1,102 @@
+
+from collections import OrderedDict
+import threading
+import time
+
+
+class CacheEntry:
+    """A value stored in a ResultCache."""
+    __slots__ = ('value', 'expires', 'version', 'tags')
+
+    def __init__(self, value, expires, version, tags):
+        self.value = value
+        self.expires = expires
+        self.version = version
+        self.tags = tags
+
+
+class ResultCache:
+    """Results that are kept for a while, or until something they were worked out from changes.
+
+        Entries can be tagged (e.g. with the names of the users they're about) so a change only drops the entries
+        it affects. Each entry also keeps the version of its source data it was stored with, and is ignored once
+        the current version is different.
+
+        A value worked out on another thread can be made stale by a discard() that happens while it's being worked
+        out. Reading 'generation' before working it out and passing it to put() keeps such a value out of the cache.
+
+        - size: the most entries to keep. The oldest are dropped first.
+    """
+    def __init__(self, size=256):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0     # Counts discard() and clear() calls
+
+        self._entries = OrderedDict()       # Key -> CacheEntry
+        self._tags = {}                     # Tag -> set of keys
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, version=None, now=None):
+        """Returns the value stored for a key, or NONE if there isn't one, it's expired or its version is different."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry.expires <= now or entry.version != version):
+                self._remove(key)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry.value
+
+    def put(self, key, value, ttl, tags=(), version=None, now=None, generation=None):
+        """Stores a value for 'ttl' seconds. Returns FALSE if it wasn't stored because it may be stale.
+
+            - tags: names that discard() can drop the entry by
+            - version: the version of the source data the value was worked out from
+            - generation: the cache's 'generation' from before the value was worked out. If entries have been
+                discarded since then, the value isn't stored.
+        """
+        now = time.monotonic() if now is None else now
+        tags = frozenset(tags)
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return False
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = CacheEntry(value, now + ttl, version, tags)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+
+            while len(self._entries) > self.size:
+                self._remove(next(iter(self._entries)))
+        return True
+
+    def discard(self, tag):
+        """Drops the entries with a tag."""
+        with self._lock:
+            self.generation += 1
+            for key in list(self._tags.get(tag, ())):
+                self._remove(key)
+
+    def clear(self):
+        """Drops every entry."""
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self._tags.clear()
+
+    def _remove(self, key):
+        # Must be called with the lock held.
+        entry = self._entries.pop(key)
+        for tag in entry.tags:
+            keys = self._tags[tag]
+            keys.discard(key)
+            if not keys:
+                del self._tags[tag]
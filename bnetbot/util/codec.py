@@ -0,0 +1,72 @@
+
+import json
+
+
+class JsonCodec:
+    """Encodes and decodes protocol messages with a particular JSON library.
+
+        - name: the backend name
+        - encode: function returning the message as str or UTF-8 bytes (both can be sent as a text frame)
+        - decode: function accepting the raw frame bytes
+    """
+    def __init__(self, name, encode, decode):
+        self.name = name
+        self.encode = encode
+        self.decode = decode
+
+    # Decoding errors from every backend (including invalid UTF-8) are ValueError subclasses.
+    errors = (ValueError,)
+
+    def __repr__(self):
+        return "<JsonCodec %s>" % self.name
+
+
+def _load_orjson():
+    import orjson
+    return JsonCodec("orjson", orjson.dumps, orjson.loads)
+
+
+def _load_ujson():
+    import ujson
+    return JsonCodec("ujson", ujson.dumps, ujson.loads)
+
+
+def _load_json():
+    encoder = json.JSONEncoder(separators=(',', ':'))
+    return JsonCodec("json", encoder.encode, json.loads)
+
+
+# Backends in order of preference when 'auto' is selected.
+BACKENDS = {
+    "orjson": _load_orjson,
+    "ujson": _load_ujson,
+    "json": _load_json
+}
+
+_codecs = {}
+
+
+def get_codec(name=None):
+    """Returns a JSON codec.
+
+        - name: 'orjson', 'ujson' or 'json'. If not set (or 'auto'), the fastest installed backend is used.
+    """
+    name = (name or "auto").lower()
+    if name in _codecs:
+        return _codecs[name]
+
+    if name == "auto":
+        codec = None
+        for backend in BACKENDS:
+            try:
+                codec = get_codec(backend)
+                break
+            except ImportError:
+                continue
+    elif name in BACKENDS:
+        codec = BACKENDS[name]()
+    else:
+        raise ValueError("Unknown JSON codec: %s" % name)
+
+    _codecs[name] = codec
+    return codec
@@ -0,0 +1,172 @@
+
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import atexit
+import logging
+import os
+import queue
+import threading
+
+
+LOG_FORMAT = "%(asctime)s: %(name)s - %(levelname)s: %(message)s"
+
+# Default settings for the 'logging' section of the config
+DEFAULT_LOG_CONFIG = {
+    "directory": None,          # Folder for per-instance log files. File logging is off if not set.
+    "max_bytes": 5242880,       # Size at which a log file is rotated
+    "backups": 5,               # Number of rotated files to keep
+    "sample": {}                # Category -> N, keeps 1 of every N debug records from that category
+}
+
+# Log message arguments of these types can't change before the writer formats them
+IMMUTABLE_ARGS = (str, int, float, type(None))
+
+_pipeline = None
+_pipeline_lock = threading.Lock()
+
+
+class DeferredQueueHandler(QueueHandler):
+    """Puts records on the queue without formatting them.
+
+        The standard QueueHandler merges the message and arguments in the calling thread. Records never leave the
+        process here, so the background writer can do that work instead - unless an argument is something like a
+        list or dict that could change before the writer gets to it, in which case the message is merged now.
+    """
+    def prepare(self, record):
+        args = record.args or ()
+        if not isinstance(record.msg, str) or \
+                not all(isinstance(arg, IMMUTABLE_ARGS) for arg in (args if isinstance(args, tuple) else [args])):
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+
+class SamplingFilter(logging.Filter):
+    """Passes only 1 of every N debug records for each configured category.
+
+        - rates: dict of category -> N. The category is the last part of the logger name (e.g. 'protocol' for
+            'bnetbot.Main.protocol').
+    """
+    def __init__(self, rates=None):
+        super().__init__()
+        self.rates = dict(rates or {})
+        self._counters = {}
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or not self.rates:
+            return True
+
+        category = record.name.rpartition('.')[2]
+        rate = self.rates.get(category)
+        if not rate or rate <= 1:
+            return True
+
+        count = self._counters.get(category, 0)
+        self._counters[category] = count + 1
+        return count % rate == 0
+
+
+class InstanceFileHandler(logging.Handler):
+    """Writes records to one rotating log file per bot instance.
+
+        The file is chosen from the second part of the logger name, so 'bnetbot.Main' and 'bnetbot.Main.protocol'
+        both go to 'Main.log'. Records from 'bnetbot' itself go to 'bnetbot.log'.
+    """
+    def __init__(self, directory, max_bytes=5242880, backups=5):
+        super().__init__()
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._files = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def emit(self, record):
+        parts = record.name.split('.')
+        name = parts[1] if len(parts) > 1 and parts[0] == "bnetbot" else parts[0]
+
+        handler = self._files.get(name)
+        if handler is None:
+            path = os.path.join(self.directory, "%s.log" % name)
+            handler = self._files[name] = RotatingFileHandler(path, maxBytes=self.max_bytes,
+                                                              backupCount=self.backups, encoding="utf-8")
+            handler.setFormatter(self.formatter)
+        handler.emit(record)
+
+    def close(self):
+        for handler in self._files.values():
+            handler.close()
+        self._files.clear()
+        super().close()
+
+
+class LogPipeline:
+    """Routes 'bnetbot' log records through a queue to a background writer thread.
+
+        Threads that log (e.g. socket receive loops) only pay for putting the record on the queue. Formatting and
+        console/file output happen on the writer thread.
+    """
+    def __init__(self, level=logging.INFO):
+        self.queue = queue.Queue()
+        self.sampler = SamplingFilter()
+        self.handler = DeferredQueueHandler(self.queue)
+        self.handler.addFilter(self.sampler)
+
+        formatter = logging.Formatter(LOG_FORMAT)
+        self.console = logging.StreamHandler()
+        self.console.setFormatter(formatter)
+        self.files = None
+        self.listener = QueueListener(self.queue, self.console, respect_handler_level=True)
+        self._running = False
+
+        self.logger = logging.getLogger("bnetbot")
+        self.logger.setLevel(level)
+        self.logger.addHandler(self.handler)
+        self.logger.propagate = False
+
+    def start(self):
+        if not self._running:
+            self.listener.start()
+            self._running = True
+
+    def stop(self):
+        """Writes out any queued records and stops the writer thread."""
+        if self._running:
+            self.listener.stop()
+            self._running = False
+        if self.files:
+            self.files.close()
+
+    def configure(self, config=None):
+        """Applies the 'logging' section of the bot config: file output, rotation and sampling."""
+        settings = dict(DEFAULT_LOG_CONFIG)
+        settings.update(config or {})
+        self.sampler.rates = dict(settings["sample"] or {})
+
+        if settings["directory"] and self.files is None:
+            self.files = InstanceFileHandler(settings["directory"], settings["max_bytes"], settings["backups"])
+            self.files.setFormatter(self.console.formatter)
+
+            # The listener's handler list can't be changed while it's running.
+            if self._running:
+                self.listener.stop()
+            self.listener.handlers = (self.console, self.files)
+            if self._running:
+                self.listener.start()
+
+
+def start_logging(level=logging.INFO):
+    """Starts the logging pipeline for the 'bnetbot' loggers. It's flushed and stopped automatically on exit."""
+    global _pipeline
+    with _pipeline_lock:
+        if _pipeline is None:
+            _pipeline = LogPipeline(level)
+            _pipeline.start()
+            atexit.register(_pipeline.stop)
+        else:
+            _pipeline.logger.setLevel(level)
+        return _pipeline
+
+
+def configure_logging(config=None):
+    """Applies logging settings from the config if the pipeline has been started."""
+    if _pipeline is not None:
+        _pipeline.configure(config)
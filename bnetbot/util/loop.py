@@ -0,0 +1,83 @@
+
+import asyncio
+import threading
+
+
+class EventLoopThread:
+    """An asyncio event loop running on its own daemon thread.
+
+        A single loop is shared by every asyncio-based client in the process, so the number of OS threads stays
+        constant no matter how many instances are loaded.
+    """
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def default(cls):
+        """Returns the process-wide shared loop, creating it if necessary."""
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = cls()
+            return cls._default
+
+    def running(self):
+        """Returns TRUE if the loop thread is alive."""
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """Starts the loop thread if it isn't already running."""
+        with self._lock:
+            if not self.running():
+                self._thread = threading.Thread(target=self._run, name="bnetbot-loop")
+                self._thread.daemon = True
+                self._thread.start()
+
+    def stop(self, timeout=5):
+        """Stops the loop and waits for the thread to exit."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+
+        if thread and thread.is_alive():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            if thread is not threading.current_thread():
+                thread.join(timeout)
+
+    def in_loop(self):
+        """Returns TRUE if called from the loop thread."""
+        thread = self._thread
+        return thread is not None and thread.ident == threading.get_ident()
+
+    def call(self, callback, *args):
+        """Runs a callback on the loop thread. If already on the loop thread it's called immediately."""
+        if self.in_loop():
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def spawn(self, coro):
+        """Schedules a coroutine on the loop without waiting for it.
+
+            - Returns an asyncio task when called from the loop thread, otherwise a concurrent future.
+        """
+        if self.in_loop():
+            return asyncio.ensure_future(coro, loop=self.loop)
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout=None):
+        """Runs a coroutine on the loop and blocks the calling thread until it completes.
+
+            This can't be used from the loop thread itself - use 'spawn' there instead.
+        """
+        if self.in_loop():
+            raise RuntimeError("EventLoopThread.run() would deadlock when called from the loop thread.")
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
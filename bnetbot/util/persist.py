@@ -0,0 +1,128 @@
+
+import logging
+import os
+import stat
+import tempfile
+import threading
+
+
+def write_atomic(path, text):
+    """Writes text to a file so that readers (and a crash) only ever see the old or the new contents.
+
+        The text is written to a temporary file in the same folder, which then replaces the original.
+    """
+    path = os.path.abspath(path)
+    fd, temp = tempfile.mkstemp(prefix=".%s." % os.path.basename(path), suffix=".tmp", dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as fh:
+            fh.write(text)
+            fh.flush()
+            os.fsync(fh.fileno())
+
+        if os.path.exists(path):
+            os.chmod(temp, stat.S_IMODE(os.stat(path).st_mode))
+        os.replace(temp, path)
+    except BaseException:
+        try:
+            os.remove(temp)
+        except OSError:
+            pass
+        raise
+
+
+class DeferredWriter:
+    """Saves changes on a background thread, a short while after they're made.
+
+        Changes made within 'delay' seconds of each other are saved together by a single call to 'write', so a
+        burst of edits doesn't mean a burst of disk writes.
+
+        - write: function called with the set of items marked dirty since the last save
+        - delay: seconds to wait after a change before saving
+    """
+    def __init__(self, write, delay=2.0):
+        self.write = write
+        self.delay = delay
+        self.log = logging.getLogger("bnetbot")
+
+        self._dirty = False
+        self._pending = set()
+        self._stopping = False
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._thread = None
+
+    def dirty(self):
+        """Returns TRUE if there are changes that haven't been saved."""
+        return self._dirty
+
+    def mark_dirty(self, item=None):
+        """Schedules a save.
+
+            - item: an optional object to include in the set passed to 'write'
+        """
+        with self._cond:
+            if item is not None:
+                self._pending.add(item)
+            self._dirty = True
+
+            if self._thread is None and not self._stopping:
+                self._thread = threading.Thread(target=self._run, name="bnetbot-writer")
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+
+    def flush(self):
+        """Saves any pending changes now. Returns TRUE if anything was saved."""
+        with self._write_lock:
+            with self._cond:
+                if not self._dirty:
+                    return False
+                items = self._pending
+                self._pending = set()
+                self._dirty = False
+
+            try:
+                self.write(items)
+            except BaseException:
+                # Keep the changes so the next save picks them up.
+                with self._cond:
+                    self._pending |= items
+                    self._dirty = True
+                raise
+        return True
+
+    def stop(self, flush=True):
+        """Stops the background thread, then saves anything still pending unless 'flush' is FALSE."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+
+        thread = self._thread
+        if thread and thread is not threading.current_thread():
+            thread.join()
+        with self._cond:
+            self._thread = None
+            self._stopping = False
+
+        if flush:
+            return self.flush()
+        with self._cond:
+            self._pending = set()
+            self._dirty = False
+        return False
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._dirty and not self._stopping:
+                    self._cond.wait()
+
+                # Give further changes a chance to arrive so they're saved together.
+                self._cond.wait_for(lambda: self._stopping, self.delay)
+                if self._stopping:
+                    return
+
+            try:
+                self.flush()
+            except Exception:
+                self.log.exception("Failed to save changes - retrying in %.1f seconds.", self.delay)
@@ -0,0 +1,105 @@
+
+from collections import OrderedDict
+import threading
+import time
+
+
+class TokenBucket:
+    """A token bucket rate limiter.
+
+        - rate: tokens added per second
+        - burst: the maximum number of tokens the bucket can hold
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic() if now is None else now
+
+    def refill(self, now=None):
+        """Adds the tokens accumulated since the last update."""
+        now = time.monotonic() if now is None else now
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, count=1, now=None):
+        """Takes 'count' tokens if they are available. Returns TRUE on success."""
+        self.refill(now)
+        if self.tokens >= count:
+            self.tokens -= count
+            return True
+        return False
+
+    def delay(self, count=1, now=None):
+        """Returns the number of seconds until 'count' tokens will be available."""
+        self.refill(now)
+        if self.tokens >= count:
+            return 0.0
+        return (count - self.tokens) / self.rate if self.rate > 0 else float('inf')
+
+    def drain(self, now=None):
+        """Empties the bucket, e.g. after the server reports that the limit was exceeded anyway."""
+        self.refill(now)
+        self.tokens = min(self.tokens, 0.0)
+
+
+class CountingBucket(TokenBucket):
+    """A TokenBucket that counts how many times it turned something away."""
+    __slots__ = ('hits',)
+
+    def __init__(self, rate, burst, now=None):
+        super().__init__(rate, burst, now)
+        self.hits = 0
+
+
+class RateLimitTable:
+    """Token buckets for any number of keys (e.g. a user and a command), kept in a table of bounded size.
+
+        A bucket is created when its key is first used. Once the table is full, the least recently used bucket is
+        dropped to make room. A bucket that hasn't been used for that long has usually refilled anyway, so dropping
+        it rarely lets through anything that it would have stopped.
+
+        - rate: tokens added per second to each bucket
+        - burst: the maximum number of tokens each bucket can hold
+        - size: the most buckets to keep
+    """
+    def __init__(self, rate, burst, size=4096):
+        self.rate = rate
+        self.burst = burst
+        self.size = size
+        self.hits = 0           # Times anything was turned away, including by buckets that have since been dropped
+
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def consume(self, key, rate=None, burst=None, now=None):
+        """Takes a token from a key's bucket. Returns FALSE, and counts a hit, if it's empty.
+
+            - rate, burst: the limit for a new bucket, if not the table's default
+        """
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = CountingBucket(self.rate if rate is None else rate,
+                                                              self.burst if burst is None else burst, now)
+                if len(self._buckets) > self.size:
+                    self._buckets.popitem(False)
+            else:
+                self._buckets.move_to_end(key)
+
+            if bucket.consume(1, now):
+                return True
+            bucket.hits += 1
+            self.hits += 1
+            return False
+
+    def hit_counts(self):
+        """Returns a dict of key -> hits for the buckets in the table that have turned anything away."""
+        with self._lock:
+            return {key: bucket.hits for key, bucket in self._buckets.items() if bucket.hits}
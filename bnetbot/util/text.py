@@ -0,0 +1,63 @@
+
+# Put between lines that are packed into the same chat message
+LINE_SEPARATOR = " | "
+
+
+def byte_length(text):
+    """Returns the length of text in bytes, as sent to the server (UTF-8)."""
+    return len(text.encode("utf-8"))
+
+
+def split_text(text, max_length):
+    """Splits text into pieces of at most 'max_length' bytes, breaking at spaces where possible.
+
+        Words too long to fit are broken wherever they have to be, without splitting a character.
+    """
+    pieces = []
+    encoded = text.encode("utf-8")
+    while len(encoded) > max_length:
+        # The characters that fit, then back up to the last space among them unless a word ends right there.
+        head = encoded[:max_length].decode("utf-8", "ignore") or text[0]     # At least one character
+        cut = len(head) if text[len(head):len(head) + 1] == ' ' else head.rfind(' ')
+        if cut > 0:
+            pieces.append(head[:cut].rstrip())
+            text = text[cut:].lstrip()
+        else:
+            pieces.append(head)
+            text = text[len(head):]
+        encoded = text.encode("utf-8")
+
+    if text:
+        pieces.append(text)
+    return pieces
+
+
+def pack_lines(lines, max_length, separator=LINE_SEPARATOR):
+    """Packs lines of text into as few messages of at most 'max_length' bytes as possible.
+
+        Lines are kept in order and joined with 'separator'. Lines that are too long on their own are split at
+        word boundaries, and blank lines are left out.
+
+        - lines: list of lines, which may themselves contain line breaks
+    """
+    messages = []
+    current = []
+    size = 0
+    sep_size = byte_length(separator)
+
+    for line in lines:
+        for part in line.split('\n'):
+            for piece in split_text(part.strip(), max_length):
+                piece_size = byte_length(piece)
+                if current and size + sep_size + piece_size <= max_length:
+                    current.append(piece)
+                    size += sep_size + piece_size
+                else:
+                    if current:
+                        messages.append(separator.join(current))
+                    current = [piece]
+                    size = piece_size
+
+    if current:
+        messages.append(separator.join(current))
+    return messages
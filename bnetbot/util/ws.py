@@ -0,0 +1,194 @@
+
+from base64 import b64encode
+from hashlib import sha1
+import os
+import struct
+
+
+OPCODE_CONT = 0
+OPCODE_TEXT = 1
+OPCODE_BINARY = 2
+OPCODE_CLOSE = 8
+OPCODE_PING = 9
+OPCODE_PONG = 10
+
+HANDSHAKE_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+class WebSocketError(Exception):
+    """Raised when the remote end violates the websocket protocol."""
+    pass
+
+
+def accept_key(key):
+    """Returns the expected 'Sec-WebSocket-Accept' value for a handshake key."""
+    return b64encode(sha1((key + HANDSHAKE_GUID).encode('ascii')).digest()).decode('ascii')
+
+
+def encode_frame(opcode, data, mask=False):
+    """Encodes a single, final websocket frame.
+
+        - opcode: the frame type
+        - data: the payload as bytes or str (str is encoded as UTF-8)
+        - mask: TRUE if the frame is sent by a client and must be masked
+    """
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+
+    length = len(data)
+    header = bytearray([0x80 | opcode])
+    mask_bit = 0x80 if mask else 0
+    if length < 126:
+        header.append(mask_bit | length)
+    elif length < 65536:
+        header.append(mask_bit | 126)
+        header.extend(struct.pack("!H", length))
+    else:
+        header.append(mask_bit | 127)
+        header.extend(struct.pack("!Q", length))
+
+    if mask:
+        key = os.urandom(4)
+        header.extend(key)
+        data = apply_mask(key, data)
+    return bytes(header) + data
+
+
+def apply_mask(key, data):
+    """Masks or unmasks a frame payload with a 4-byte key."""
+    if not data:
+        return b''
+    # XOR the payload as one big integer rather than byte by byte.
+    length = len(data)
+    repeated = (key * (length // 4 + 1))[:length]
+    value = int.from_bytes(data, 'big') ^ int.from_bytes(repeated, 'big')
+    return value.to_bytes(length, 'big')
+
+
+class WebSocketStream:
+    """Reads and writes websocket messages on an asyncio stream pair.
+
+        - reader, writer: the connected asyncio streams (after the HTTP upgrade)
+        - client: TRUE if this end is the client (outgoing frames are masked)
+    """
+    def __init__(self, reader, writer, client=True):
+        self.reader = reader
+        self.writer = writer
+        self.client = client
+        self.closed = False
+
+    def send(self, opcode, data):
+        """Writes a message frame. This does not wait for the data to be flushed."""
+        if self.closed:
+            raise ConnectionError("Websocket is closed.")
+        self.writer.write(encode_frame(opcode, data, self.client))
+
+    def close(self, code=1000):
+        """Sends a close frame (if still open) and closes the transport."""
+        if not self.closed:
+            self.closed = True
+            try:
+                self.writer.write(encode_frame(OPCODE_CLOSE, struct.pack("!H", code), self.client))
+            except (ConnectionError, RuntimeError):
+                pass
+        self.writer.close()
+
+    async def _read_frame(self):
+        head = await self.reader.readexactly(2)
+        fin, opcode = head[0] & 0x80, head[0] & 0x0F
+        masked, length = head[1] & 0x80, head[1] & 0x7F
+
+        if length == 126:
+            length = struct.unpack("!H", await self.reader.readexactly(2))[0]
+        elif length == 127:
+            length = struct.unpack("!Q", await self.reader.readexactly(8))[0]
+
+        key = (await self.reader.readexactly(4)) if masked else None
+        data = await self.reader.readexactly(length)
+        return bool(fin), opcode, apply_mask(key, data) if key else data
+
+    async def recv(self):
+        """Returns the next (opcode, data) message.
+
+            Fragmented messages are reassembled, pings are answered automatically, and control frames are
+            returned to the caller the same way websocket-client's 'recv_data(True)' does.
+        """
+        fragments = []
+        message_opcode = None
+        while True:
+            fin, opcode, data = await self._read_frame()
+
+            if opcode == OPCODE_PING:
+                if not self.closed:
+                    self.writer.write(encode_frame(OPCODE_PONG, data, self.client))
+                return opcode, data
+            elif opcode == OPCODE_CLOSE:
+                self.close()
+                return opcode, data
+            elif opcode == OPCODE_PONG:
+                return opcode, data
+            elif opcode in [OPCODE_TEXT, OPCODE_BINARY, OPCODE_CONT]:
+                if opcode != OPCODE_CONT:
+                    if message_opcode is not None:
+                        raise WebSocketError("New message started before the previous one finished.")
+                    message_opcode = opcode
+                elif message_opcode is None:
+                    raise WebSocketError("Continuation frame received without a message.")
+
+                fragments.append(data)
+                if fin:
+                    return message_opcode, b''.join(fragments)
+            else:
+                raise WebSocketError("Unknown opcode: %i" % opcode)
+
+
+async def read_http_head(reader):
+    """Reads an HTTP request or response head. Returns the first line and a dict of lower-cased headers."""
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode('latin-1').split("\r\n")
+    headers = {}
+    for line in lines[1:]:
+        if ':' in line:
+            key, value = line.split(':', 1)
+            headers[key.strip().lower()] = value.strip()
+    return lines[0], headers
+
+
+async def client_handshake(reader, writer, host, path):
+    """Performs the client side of the websocket opening handshake."""
+    key = b64encode(os.urandom(16)).decode('ascii')
+    writer.write((
+        "GET %s HTTP/1.1\r\n"
+        "Host: %s\r\n"
+        "Upgrade: websocket\r\n"
+        "Connection: Upgrade\r\n"
+        "Sec-WebSocket-Key: %s\r\n"
+        "Sec-WebSocket-Version: 13\r\n\r\n" % (path, host, key)
+    ).encode('ascii'))
+
+    status, headers = await read_http_head(reader)
+    parts = status.split(' ', 2)
+    if len(parts) < 2 or parts[1] != "101":
+        raise WebSocketError("Handshake rejected: %s" % status)
+    if headers.get("sec-websocket-accept") != accept_key(key):
+        raise WebSocketError("Handshake failed: invalid accept key.")
+    return WebSocketStream(reader, writer, True)
+
+
+async def server_handshake(reader, writer):
+    """Performs the server side of the websocket opening handshake. Returns the stream and request path."""
+    request, headers = await read_http_head(reader)
+    parts = request.split(' ')
+    key = headers.get("sec-websocket-key")
+    if len(parts) < 2 or parts[0] != "GET" or not key or headers.get("upgrade", "").lower() != "websocket":
+        writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n")
+        writer.close()
+        raise WebSocketError("Invalid handshake request: %s" % request)
+
+    writer.write((
+        "HTTP/1.1 101 Switching Protocols\r\n"
+        "Upgrade: websocket\r\n"
+        "Connection: Upgrade\r\n"
+        "Sec-WebSocket-Accept: %s\r\n\r\n" % accept_key(key)
+    ).encode('ascii'))
+    return WebSocketStream(reader, writer, False), parts[1]
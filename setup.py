@@ -10,5 +10,6 @@ setup(name='community-bot',
       license='MIT',
       url='https://bnetdocs.org/',
       install_requires=['websocket-client>=0.53.0'],
+      extras_require={'fast': ['orjson']},
       packages=["bnetbot"]
       )
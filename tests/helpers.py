@@ -0,0 +1,11 @@
+
+import time
+
+
+def wait_for(condition, timeout=5):
+    """Polls until condition() returns a true value. Raises AssertionError if that takes over 'timeout' seconds."""
+    end = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > end:
+            raise AssertionError("Timed out waiting for condition.")
+        time.sleep(0.01)
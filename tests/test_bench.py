@@ -0,0 +1,55 @@
+
+from bnetbot.bench import *
+import os
+import shutil
+import tempfile
+import unittest
+
+
+def event(command, payload):
+    return {"command": command, "request_id": 1, "payload": payload}
+
+
+class TestReplay(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.capture = os.path.join(self.dir, "capture.gz")
+
+        writer = CaptureWriter(self.capture)
+        writer.write(DIRECTION_RECEIVED, event("Botapichat.UserUpdateEventRequest", {"user_id": 1, "toon_name": "Bot"}))
+        writer.write(DIRECTION_RECEIVED, event("Botapichat.ConnectEventRequest", {"channel": "Op Test"}))
+        writer.write(DIRECTION_RECEIVED, event("Botapichat.UserUpdateEventRequest", {"user_id": 2, "toon_name": "Alice"}))
+        writer.write(DIRECTION_SENT, event("Botapichat.SendMessageRequest", {"message": "ignored"}))
+        for message in ["hi", "!ping", "!whoami"]:
+            writer.write(DIRECTION_RECEIVED, event("Botapichat.MessageEventRequest",
+                                                   {"user_id": 2, "type": "Channel", "message": message}))
+        writer.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_read_capture(self):
+        directions = [direction for elapsed, direction, message in read_capture(self.capture)]
+        self.assertEqual(directions.count(DIRECTION_SENT), 1)
+        self.assertEqual(len(directions), 7)
+
+    def test_replay(self):
+        config = {"database": {"users": {"alice": {"permissions": {"commands.internal.*": True}}}}}
+        results = replay(self.capture, config, repeat=2)
+
+        self.assertEqual(results["messages"], 12)
+        self.assertEqual(results["sent"], 4)     # Two responses per replay
+        self.assertEqual(results["stages"]["parse"]["count"], 6)
+        self.assertEqual(results["stages"]["execute"]["count"], 4)
+
+    def test_replay_instance(self):
+        # Wired the same way as a real instance: protocol events are only handled when debug logging is on.
+        inst = create_replay_instance()
+        self.assertIsInstance(inst.client, ReplayClient)
+        self.assertEqual(inst.client.log.name, "bnetbot.Replay.capi")
+        self.assertEqual(len(inst.client.events['protocol_message_received']), 0)
+        self.assertEqual(len(inst.client.events['protocol_message_sent']), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
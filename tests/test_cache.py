@@ -0,0 +1,104 @@
+
+from bnetbot.capi import CapiUser
+from bnetbot.commands import SOURCE_PRIVATE, SOURCE_PUBLIC, AdminCommands, cacheable
+from bnetbot.database import DatabaseItem
+from bnetbot.instance import BotInstance
+from bnetbot.util.cache import ResultCache
+import unittest
+
+
+class TestResultCache(unittest.TestCase):
+    def test_expiry_and_version(self):
+        cache = ResultCache()
+        cache.put("a", 1, 10, now=0, version=1)
+        self.assertEqual(cache.get("a", 1, now=5), 1)
+        self.assertIsNone(cache.get("a", 2, now=5))     # Source data changed
+        self.assertEqual(len(cache), 0)
+
+        cache.put("a", 1, 10, now=0)
+        self.assertIsNone(cache.get("a", now=10))
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_tags_and_size(self):
+        cache = ResultCache(size=2)
+        cache.put("a", 1, 10, ["alice"])
+        cache.put("b", 2, 10, ["alice", "bob"])
+        cache.put("a", 3, 10, ["carol"])
+        cache.discard("alice")
+        self.assertEqual((cache.get("a"), cache.get("b")), (3, None))
+
+        cache.put("c", 4, 10, ["carol"])
+        cache.put("d", 5, 10)
+        self.assertIsNone(cache.get("a"))               # Oldest dropped
+        cache.discard("carol")
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache._tags, {})
+
+    def test_generation(self):
+        # A value worked out before a discard isn't stored, even if the discard didn't match anything.
+        cache = ResultCache()
+        generation = cache.generation
+        cache.discard("alice")
+        self.assertFalse(cache.put("a", 1, 10, ["alice"], generation=generation))
+        self.assertIsNone(cache.get("a"))
+        self.assertTrue(cache.put("a", 1, 10, ["alice"], generation=cache.generation))
+
+
+class TestCommandCache(unittest.TestCase):
+    def setUp(self):
+        self.inst = BotInstance("test", {"flood_limit": False})
+        self.calls = 0
+        self.sent = []
+        self.inst.client.chat = lambda message, target=None: self.sent.append(message)
+
+        @cacheable(60)
+        def lookup(c):
+            self.calls += 1
+            c.respond("%s: %i" % (" ".join(c.args), self.calls))
+        self.inst.register_command("lookup", None, lookup)
+
+    def run_command(self, text, source=SOURCE_PUBLIC):
+        self.inst.execute_command(self.inst.parse_command(text, source), "%root%")
+        return self.sent[-1]
+
+    def test_cached(self):
+        self.assertEqual(self.run_command("!lookup Alice"), "Alice: 1")
+        self.assertEqual(self.run_command("!lookup alice"), "Alice: 1")
+        self.assertEqual(self.run_command("!lookup Bob"), "Bob: 2")
+        self.assertEqual(self.run_command("!lookup Alice", SOURCE_PRIVATE), "Alice: 3")
+
+        # Channel events about a user only drop the entries that name them.
+        alice = CapiUser(1, "ALICE")
+        self.inst.client.events['user_update'](self.inst.client, alice, (), {})
+        self.assertEqual(self.run_command("!lookup Alice"), "Alice: 4")
+        self.assertEqual(self.run_command("!lookup Bob"), "Bob: 2")
+        self.inst.client.events['user_left'](self.inst.client, CapiUser(2, "bob"))
+        self.assertEqual(self.run_command("!lookup Bob"), "Bob: 5")
+
+        # Any database change drops everything.
+        self.inst.database.add(DatabaseItem("Carol", False))
+        self.assertEqual(self.run_command("!lookup Alice"), "Alice: 6")
+        self.inst.database.user("carol").permissions["commands.internal.ping"] = True
+        self.assertEqual(self.run_command("!lookup Alice"), "Alice: 7")
+
+    def test_event_while_running(self):
+        # A channel event about the user while the command is running means its answer may already be stale.
+        @cacheable(60)
+        def racy(c):
+            self.calls += 1
+            self.inst.client.events['user_update'](self.inst.client, CapiUser(1, "Alice"), (), {})
+            c.respond("%s: %i" % (" ".join(c.args), self.calls))
+        self.inst.register_command("racy", None, racy)
+
+        self.assertEqual(self.run_command("!racy Alice"), "Alice: 1")
+        self.assertEqual(self.run_command("!racy Alice"), "Alice: 2")
+
+    def test_perms_invalidates(self):
+        self.run_command("!lookup Alice")
+        self.inst.register_command("perms", None, AdminCommands.perms)
+        self.run_command("!perms user Alice set commands.internal.ping allow")
+        self.assertEqual(self.run_command("!lookup Alice"), "Alice: 2")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,139 @@
+
+from bnetbot.capi import CapiClient, CapiUser
+from bnetbot.channel import *
+import unittest
+
+
+def make_roster(*names):
+    roster = ChannelRoster()
+    for i, name in enumerate(names):
+        roster.add(CapiUser(i + 1, name))
+    return roster
+
+
+class TestChannelRoster(unittest.TestCase):
+    def test_name_lookup(self):
+        roster = make_roster("Alice", "[vL]Bob")
+        self.assertEqual(roster.find("ALICE").id, 1)
+        self.assertEqual(roster.find("[vl]bob").id, 2)
+        self.assertIsNone(roster.find("carol"))
+
+    def test_index_follows_changes(self):
+        roster = make_roster("Alice", "Bob")
+        del roster[1]
+        self.assertIsNone(roster.find("alice"))
+
+        roster[2] = CapiUser(2, "Robert")
+        self.assertIsNone(roster.find("bob"))
+        self.assertEqual(roster.find("robert").id, 2)
+        self.assertEqual(len(roster), 1)
+        self.assertEqual(roster.find_prefix(""), [roster[2]])
+
+    def test_prefix_and_wildcard(self):
+        roster = make_roster("Alice", "alfred", "Bob", "[vL]Al", "Al")
+        self.assertEqual([u.name for u in roster.find_prefix("al")], ["Al", "alfred", "Alice"])
+        self.assertEqual([u.name for u in roster.match("al*e*")], ["alfred", "Alice"])
+        self.assertEqual([u.name for u in roster.match("*al")], ["[vL]Al", "Al"])
+        self.assertEqual([u.name for u in roster.match("b?b")], ["Bob"])
+        self.assertEqual([u.name for u in roster.match("[vl]al")], ["[vL]Al"])
+
+
+class TestCapiUser(unittest.TestCase):
+    def test_flags(self):
+        user = CapiUser(1, "Alice", ["Moderator", "Speaker"])
+        self.assertTrue(user.has_flag("moderator"))
+        self.assertFalse(user.has_flag("admin"))
+        self.assertFalse(user.set_flags(["speaker", "MODERATOR"]))
+        self.assertTrue(user.set_flags(["Speaker"]))
+        self.assertFalse(user.has_flag("moderator"))
+
+    def test_attributes_copy_on_write(self):
+        user = CapiUser(1, "Alice", attributes=[{"key": "ProgramId", "value": "W2BN"}])
+        old = user.attributes
+        self.assertFalse(user.update({"ProgramId": "W2BN"}))
+        self.assertIs(user.attributes, old)
+
+        self.assertTrue(user.update([{"key": "ProgramId", "value": "SEXP"}]))
+        self.assertEqual(old, {"ProgramId": "W2BN"})
+        self.assertEqual(user.attributes, {"ProgramId": "SEXP"})
+
+    def test_slots(self):
+        with self.assertRaises(AttributeError):
+            CapiUser(1, "Alice").extra = True
+
+
+class TestUserUpdateEvents(unittest.TestCase):
+    def test_change_detection(self):
+        client = CapiClient("key")
+        client.channel = "Op Test"
+        client.state.enter(client.channel)
+        client.state.finish_loading()
+        updates = []
+        client.events['user_update'].register(lambda c, u, f, a: updates.append(u.name))
+
+        client._handle_user_update_event(None, {"user_id": 2, "toon_name": "Alice", "flag": ["Speaker"]}, None)
+        client._handle_user_update_event(None, {"user_id": 2, "flag": ["speaker"]}, None)
+        self.assertEqual(updates, [])
+
+        client._handle_user_update_event(None, {"user_id": 2, "flag": ["Moderator"]}, None)
+        client._handle_user_update_event(None, {"user_id": 2, "attribute": [{"key": "ProgramId", "value": "W2BN"}]}, None)
+        self.assertEqual(updates, ["Alice", "Alice"])
+        self.assertTrue(client.get_user("alice").has_flag("moderator"))
+
+    def test_snapshot_after_user_list(self):
+        client = CapiClient("key")
+        events = []
+        client.events['channel_snapshot'].register(lambda c, u, v: events.append(("snapshot", len(u))))
+        client.events['user_joined'].register(lambda c, u: events.append(("joined", u.name)))
+        client.events['user_update'].register(lambda c, u, f, a: events.append(("update", u.name)))
+
+        client._handle_user_update_event(None, {"user_id": 1, "toon_name": "TestBot", "flag": []}, None)
+        client._handle_connect_event(None, {"channel": "Op Test"}, None)
+        for i in range(2, 6):
+            client._handle_user_update_event(None, {"user_id": i, "toon_name": "User%i" % i}, None)
+        client._handle_user_update_event(None, {"user_id": 3, "flag": ["Moderator"]}, None)
+        self.assertEqual(events, [])
+
+        client._handle_user_update_event(None, {"user_id": 1}, None)
+        client._handle_user_update_event(None, {"user_id": 6, "toon_name": "Late"}, None)
+        self.assertEqual(events, [("snapshot", 5), ("joined", "Late")])
+
+
+class TestChannelState(unittest.TestCase):
+    def setUp(self):
+        self.state = ChannelState(history=4)
+        self.state.enter("Op Test")
+
+    def test_changes_since(self):
+        start = self.state.version
+        alice = CapiUser(2, "Alice")
+        self.state.join(alice)
+        self.state.join(CapiUser(3, "Bob"))
+        middle = self.state.version
+        self.state.update(alice)
+        self.state.leave(3)
+        self.assertIsNone(self.state.leave(3))
+
+        self.assertEqual([(c.kind, c.user.name) for c in self.state.changes_since(start)],
+                         [(CHANGE_JOIN, "Alice"), (CHANGE_JOIN, "Bob"), (CHANGE_UPDATE, "Alice"), (CHANGE_LEAVE, "Bob")])
+        self.assertEqual([c.kind for c in self.state.changes_since(middle)], [CHANGE_UPDATE, CHANGE_LEAVE])
+        self.assertEqual(self.state.changes_since(self.state.version), [])
+        self.assertEqual(self.state.snapshot(), (self.state.version, [alice]))
+
+    def test_history_limit(self):
+        start = self.state.version
+        for i in range(5):
+            self.state.join(CapiUser(i, "User%i" % i))
+        self.assertIsNone(self.state.changes_since(start))
+        self.assertEqual(len(self.state.changes_since(start + 1)), 4)
+
+    def test_reset(self):
+        version = self.state.version
+        self.state.join(CapiUser(2, "Alice"))
+        self.state.reset()
+        self.assertIsNone(self.state.changes_since(version))
+        self.assertEqual(len(self.state.roster), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
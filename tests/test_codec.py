@@ -0,0 +1,30 @@
+
+from bnetbot.util.codec import *
+import unittest
+
+
+class TestJsonCodec(unittest.TestCase):
+    def test_backends_round_trip(self):
+        message = {"command": "Botapichat.MessageEventRequest", "payload": {"message": "héllo"}}
+        for name in BACKENDS:
+            try:
+                codec = get_codec(name)
+            except ImportError:
+                continue
+
+            encoded = codec.encode(message)
+            raw = encoded.encode('utf-8') if isinstance(encoded, str) else encoded
+            self.assertEqual(codec.decode(raw), message)
+
+    def test_invalid_utf8(self):
+        codec = get_codec()
+        with self.assertRaises(codec.errors):
+            codec.decode(b'{"message": "\xff"}')
+
+    def test_unknown_codec(self):
+        with self.assertRaises(ValueError):
+            get_codec("yaml")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,7 @@
 
 from bnetbot.instance import *
 from bnetbot.commands import *
+from bnetbot.router import split_args
 import unittest
 
 
@@ -19,6 +20,54 @@ class TestCommandParsing(unittest.TestCase):
         self.assertEqual(cmd.command, "test")
         self.assertEqual(len(cmd.args), 3)
 
+    def test_multiple_triggers(self):
+        bot = BotInstance("test", {"trigger": ["!", "?", "bot: "]})
+        self.assertEqual(bot.parse_command("?ping", SOURCE_PUBLIC).trigger, "?")
+        self.assertEqual(bot.parse_command("bot: ping", SOURCE_PUBLIC).command, "ping")
+        self.assertIsNone(bot.parse_command("bot:ping", SOURCE_PUBLIC))
+        self.assertIsNone(bot.parse_command("! ping", SOURCE_PUBLIC))
+        self.assertIsNone(bot.parse_command("", SOURCE_PUBLIC))
+
+    def test_quoted_args(self):
+        cmd = BotInstance("test").parse_command('/say  "hello there"  world ""')
+        self.assertIsNone(cmd._args)    # Not parsed until used
+        self.assertEqual(cmd.args, ["hello there", "world", ""])
+        self.assertEqual(split_args('a "b c'), ["a", "b c"])
+        self.assertEqual(split_args(""), [])
+
+
+class TestCommandRouting(unittest.TestCase):
+    def setUp(self):
+        self.bot = BotInstance("test", {"aliases": {"w": "whois", "missing": "nothing"}})
+        self.called = []
+        for name in ["whois", "whoami", "ping", "perms"]:
+            self.bot.register_command(name, None, lambda c, name=name: self.called.append((name, c.args)),
+                                      ["pong"] if name == "ping" else None)
+
+    def resolve(self, name):
+        command = self.bot.router.resolve(name)
+        return command.name if command else None
+
+    def test_resolve(self):
+        self.assertEqual(self.resolve("PING"), "ping")
+        self.assertEqual(self.resolve("pong"), "ping")
+        self.assertEqual(self.resolve("w"), "whois")
+        self.assertEqual(self.resolve("whoa"), "whoami")
+        self.assertEqual(self.resolve("per"), "perms")
+        self.assertIsNone(self.resolve("p"))        # Ambiguous
+        self.assertIsNone(self.resolve("who"))
+        self.assertIsNone(self.resolve("missing"))
+        self.assertIsNone(self.resolve("pings"))
+
+        self.bot.router.abbreviations = False
+        self.assertIsNone(self.resolve("per"))
+        self.assertEqual(self.resolve("pong"), "ping")
+
+    def test_execute(self):
+        self.bot.execute_command(self.bot.parse_command('/whoa "a b" c'))
+        self.bot.execute_command(self.bot.parse_command("/po"))
+        self.assertEqual(self.called, [("whoami", ["a b", "c"]), ("ping", [])])
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,72 @@
+
+from bnetbot.database import *
+from datetime import datetime
+import gc
+import time
+import unittest
+
+
+class TestDatabaseItem(unittest.TestCase):
+    def test_slots(self):
+        with self.assertRaises(AttributeError):
+            DatabaseItem("Alice", False).extra = True
+
+    def test_lazy_timestamps(self):
+        item = DatabaseItem.load({"added": "2020-01-02T03:04:05.678900", "modified": "2020-01-03T00:00:00"},
+                                 "Alice", False)
+        self.assertEqual(item.to_config()["added"], "2020-01-02T03:04:05.678900")
+        self.assertEqual(item.added, datetime(2020, 1, 2, 3, 4, 5, 678900))
+        self.assertEqual(item.modified, datetime(2020, 1, 3))
+
+        item.modified = datetime(2021, 1, 1, 12, 0, 0)
+        self.assertEqual(item.to_config()["modified"], "2021-01-01T12:00:00")
+
+    def test_load_links_groups(self):
+        db = UserDatabase.load({
+            "groups": {"Mod": {"permissions": {"commands.moderation.*": True}}},
+            "users": {"Alice": {"groups": ["Mod", "Missing"]}, "Bob": {}}
+        })
+        alice = db.user("alice")
+        mod = db.group("mod")
+        self.assertEqual(dict(alice.groups), {"mod": mod, "missing": None})
+        self.assertEqual(mod.members, [alice])
+        self.assertEqual(alice.to_config()["groups"], ["Mod", "missing"])
+        self.assertTrue(alice.check_permission("commands.moderation.ban"))
+
+        # Items loaded without groups or permissions can still be changed.
+        bob = db.user("bob")
+        bob.groups["mod"] = mod
+        bob.permissions["commands.internal.ping"] = True
+        self.assertTrue(bob.check_permission("commands.moderation.kick"))
+        self.assertEqual(db.user("alice").permissions, {})
+
+    def test_shared_links(self):
+        # Users in the same groups share their links until one of them changes.
+        db = UserDatabase.load({"users": {"Alice": {"groups": ["User"]}, "Bob": {"groups": ["User"]}}})
+        alice, bob = db.user("alice"), db.user("bob")
+        self.assertIs(alice._groups, bob._groups)
+        self.assertEqual(sorted(m.name for m in db.group("user").members), ["Alice", "Bob", "Moderator"])
+
+        alice.groups["admin"] = db.group("admin")
+        self.assertEqual(list(bob.groups), ["user"])
+        self.assertTrue(alice.check_permission("commands.admin.perms"))
+        self.assertFalse(bob.check_permission("commands.admin.perms"))
+
+    def test_load_time(self):
+        # Large databases should load well within a second, and the collector's setting is put back afterwards.
+        config = {"users": {"user%i" % i: {"groups": ["User"], "permissions": {"commands.internal.ping": True}}
+                            for i in range(100000)}}
+        threshold = gc.get_threshold()
+        best = None
+        for i in range(2):
+            start = time.perf_counter()
+            db = UserDatabase.load(config)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+            del db
+        self.assertLess(best, 1.0)
+        self.assertEqual(gc.get_threshold(), threshold)
+
+
+if __name__ == "__main__":
+    unittest.main()
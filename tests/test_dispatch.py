@@ -0,0 +1,189 @@
+
+from bnetbot.capi import CapiUser
+from bnetbot.commands import SOURCE_LOCAL, SOURCE_PRIVATE, SOURCE_PUBLIC, cacheable
+from bnetbot.database import DatabaseItem
+from bnetbot.dispatch import *
+from bnetbot.instance import BotInstance
+from bnetbot.util.ratelimit import RateLimitTable
+from concurrent.futures import ThreadPoolExecutor
+from helpers import wait_for
+import threading
+import time
+import unittest
+
+
+class TestCommandQueue(unittest.TestCase):
+    def setUp(self):
+        self.pool = ThreadPoolExecutor(4)
+        self.release = threading.Event()
+        self.lock = threading.Lock()
+        self.ran = []
+
+    def tearDown(self):
+        self.release.set()
+        self.pool.shutdown()
+
+    def run_command(self, user, value):
+        self.release.wait(5)
+        with self.lock:
+            self.ran.append((user, value))
+
+    def test_no_pool(self):
+        queue = CommandQueue(lambda *args: self.ran.append(args))
+        self.assertTrue(queue.submit("alice", 1))
+        self.assertEqual(self.ran, [(1,)])
+
+    def test_order_and_limits(self):
+        queue = CommandQueue(self.run_command, max_pending=5, max_per_user=3)
+        queue.pool = self.pool
+        for i in range(4):
+            self.assertEqual(queue.submit("alice", "alice", i), i < 3)
+        self.assertTrue(queue.submit("bob", "bob", 0))
+        self.assertTrue(queue.submit("carol", "carol", 0))
+        self.assertFalse(queue.submit("dave", "dave", 0))      # Instance limit
+        self.assertEqual(queue.pending(), 5)
+
+        self.release.set()
+        wait_for(lambda: queue.pending() == 0)
+        self.assertEqual([v for u, v in self.ran if u == "alice"], [0, 1, 2])
+        self.assertEqual(len(self.ran), 5)
+        self.assertTrue(queue.submit("dave", "dave", 0))
+
+    def test_clear(self):
+        queue = CommandQueue(self.run_command)
+        queue.pool = self.pool
+        queue.submit("alice", "alice", 0)
+        queue.submit("alice", "alice", 1)
+        time.sleep(0.05)
+        queue.clear()
+        self.assertEqual(queue.pending(), 0)
+        self.release.set()
+
+        time.sleep(0.1)
+        self.assertEqual(self.ran, [("alice", 0)])
+        self.assertEqual(queue.pending(), 0)
+
+        # A shut down pool drops new commands.
+        self.pool.shutdown()
+        self.assertFalse(queue.submit("alice", "alice", 2))
+        self.assertEqual(queue.pending(), 0)
+
+    def test_busy_reply(self):
+        inst = BotInstance("test", {"command_queue": {"max_per_user": 1, "overload": OVERLOAD_BUSY}})
+        inst.register_command("slow", None, lambda c: self.release.wait(5))
+        inst.command_queue.pool = self.pool
+        sent = []
+        inst.send = lambda message, target=None: sent.append((message, target))
+
+        user = CapiUser(1, "Alice")
+        self.assertTrue(inst.dispatch_command(inst.parse_command("!slow", SOURCE_PRIVATE), user))
+        with self.assertLogs("bnetbot.test", "DEBUG") as logs:
+            for i in range(20):
+                self.assertFalse(inst.dispatch_command(inst.parse_command("!slow", SOURCE_PRIVATE), user))
+
+        # Only the first dropped command is answered and warned about.
+        self.assertEqual(sent, [("I'm busy right now - try again in a moment.", "Alice")])
+        self.assertEqual([r.levelname for r in logs.records], ["WARNING"] + ["DEBUG"] * 19)
+        self.assertTrue(inst.command_queue.notify("alice", now=time.monotonic() + 30))
+
+        with self.assertRaises(ValueError):
+            CommandQueue.from_config(None, {"overload": "explode"})
+        with self.assertRaises(ValueError):
+            CommandQueue.from_config(None, {"busy_interval": -1})
+
+        # With no interval every dropped command is answered.
+        queue = CommandQueue.from_config(None, {"busy_interval": 0})
+        self.assertTrue(all(queue.notify("alice", now=0) for i in range(3)))
+
+    def test_flood_limit_before_queue(self):
+        # Commands over the flood limit are dropped before they can fill the user's place in the queue.
+        inst = BotInstance("test", {"command_queue": {"max_per_user": 1, "overload": OVERLOAD_BUSY},
+                                    "flood_limit": {"burst": 3, "rate": 0.001}})
+        inst.register_command("slow", None, lambda c: self.release.wait(5))
+        inst.command_queue.pool = self.pool
+        inst.send = lambda message, target=None: None
+
+        user = CapiUser(1, "Alice")
+        accepted = [inst.dispatch_command(inst.parse_command("!slow", SOURCE_PRIVATE), user) for i in range(20)]
+        self.assertEqual(accepted, [True] + [False] * 19)
+        self.assertEqual(inst.flood_limiter.hit_counts(), {("alice", "slow"): 17})
+        self.assertEqual(inst.command_queue.pending(), 1)
+
+    def test_database_lock(self):
+        # Commands that might change the database run one at a time, while cacheable ones don't wait for them.
+        inst = BotInstance("test", {"flood_limit": False})
+        inst.command_queue.pool = self.pool
+        inst.send = lambda message, target=None: None
+        running = []
+
+        def edit(c):
+            running.append(c.args[0])
+            self.release.wait(5)
+            running.remove(c.args[0])
+        inst.register_command("edit", None, edit)
+        inst.register_command("look", None, cacheable(60)(lambda c: self.ran.append(list(running))))
+
+        for name in ["Alice", "Bob"]:
+            inst.dispatch_command(inst.parse_command("!edit %s" % name, SOURCE_PRIVATE), CapiUser(1, name))
+        time.sleep(0.1)
+        self.assertEqual(len(running), 1)
+        inst.dispatch_command(inst.parse_command("!look", SOURCE_PRIVATE), CapiUser(1, "Carol"))
+        wait_for(lambda: self.ran)
+        self.assertEqual(self.ran, [running[:1]])
+
+        self.release.set()
+        wait_for(lambda: inst.command_queue.pending() == 0)
+        self.assertEqual(running, [])
+
+
+class TestFloodLimit(unittest.TestCase):
+    def test_table(self):
+        table = RateLimitTable(1.0, 2, size=3)
+        self.assertTrue(table.consume("a", now=0))
+        self.assertTrue(table.consume("a", now=0))
+        self.assertFalse(table.consume("a", now=0))
+        self.assertTrue(table.consume("a", now=1))
+        self.assertEqual(table.hit_counts(), {"a": 1})
+
+        # The least recently used bucket is dropped to make room.
+        for key in ["b", "c", "a", "d"]:
+            table.consume(key, now=1)
+        self.assertEqual(len(table), 3)
+        self.assertEqual(table.hit_counts(), {"a": 2})
+        self.assertTrue(table.consume("b", now=1))
+        self.assertEqual(table.hits, 2)
+
+    def test_limiter(self):
+        limiter = FloodLimiter.from_config({"burst": 1, "rate": 0.1, "commands": {"Ping": {"burst": 2}}})
+        self.assertTrue(limiter.allow("Alice", "whois", now=0))
+        self.assertFalse(limiter.allow("ALICE", "whois", now=1))
+        self.assertTrue(limiter.allow("Alice", "ping", now=1))
+        self.assertTrue(limiter.allow("Alice", "ping", now=1))
+        self.assertFalse(limiter.allow("Alice", "ping", now=1))
+        self.assertTrue(limiter.allow("Bob", "whois", now=1))
+        self.assertTrue(limiter.allow("Alice", "whois", now=11))
+        self.assertEqual(limiter.hit_counts(), {("alice", "whois"): 1, ("alice", "ping"): 1})
+        self.assertIsNone(FloodLimiter.from_config(False))
+
+    def test_instance(self):
+        inst = BotInstance("test", {"flood_limit": {"burst": 2, "rate": 0.001}})
+        ran = []
+        inst.register_command("ping", None, lambda c: ran.append(c.user.name if c.user else None))
+        inst.database.add(DatabaseItem("Admin", False, ["bypass.ratelimit"]))
+        sent = []
+        inst.send = lambda message, target=None: sent.append(message)
+
+        for name in ["Alice", "Admin"]:
+            for i in range(4):
+                inst.dispatch_command(inst.parse_command("!ping", SOURCE_PRIVATE), CapiUser(1, name))
+        for i in range(4):
+            inst.execute_command(inst.parse_command("/ping", SOURCE_LOCAL), "Alice")
+            inst.dispatch_command(inst.parse_command("!nothing", SOURCE_PUBLIC), CapiUser(1, "Alice"))
+
+        self.assertEqual(ran, [None, None] + ["Admin"] * 4 + [None] * 4)
+        self.assertEqual(sent, [["Unrecognized command."]] * 2)
+        self.assertEqual(inst.flood_limiter.hit_counts(), {("alice", "ping"): 2, ("alice", ""): 2})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+
+from bnetbot.aio import AsyncCapiClient
+from bnetbot.capi import CapiClient
+from bnetbot.emulator import CapiServer
+from helpers import wait_for
+import unittest
+
+
+class EmulatorTestCase(unittest.TestCase):
+    client_class = AsyncCapiClient
+
+    def setUp(self):
+        self.server = CapiServer(api_keys={"key": "TestBot"}, channel="Op Test", rate=0)
+        self.server.start()
+        self.server.populate(50)
+
+        self.client = self.client_class("key")
+        self.talk = []
+        self.snapshots = []
+        self.client.events['channel_snapshot'].register(lambda c, u, v: self.snapshots.append(len(u)))
+        self.client.events['user_talk'].register(lambda c, u, m: self.talk.append((u.name, m)))
+        self.assertTrue(self.client.connect(self.server.endpoint))
+        wait_for(lambda: self.snapshots)
+
+    def tearDown(self):
+        self.client.disconnect(True)
+        self.server.stop()
+
+    def test_join_channel(self):
+        self.assertEqual(self.client.channel, "Op Test")
+        self.assertEqual(self.client.username, "TestBot")
+        self.assertEqual(len(self.client.users), 51)
+        self.assertEqual(self.snapshots, [51])
+
+    def test_chat_events(self):
+        self.server.add_user("Alice")
+        self.server.say("Alice", "hello")
+        wait_for(lambda: self.talk)
+        self.assertEqual(self.talk, [("Alice", "hello")])
+
+    def test_kick(self):
+        request = self.client.ban("User7", True)
+        self.assertIsNotNone(request.result(5))
+        wait_for(lambda: self.client.get_user("User7") is None)
+
+    def test_rate_limit_retry(self):
+        self.server.rate, self.server.burst = 1000, 1
+        self.client.outbound.backoff = 0.05
+        # Reconnect so the new server limit applies to this connection.
+        self.client.disconnect(True)
+        self.assertTrue(self.client.connect(self.server.endpoint))
+        wait_for(lambda: len(self.snapshots) == 2)
+
+        requests = [self.client.chat("message %i" % i) for i in range(3)]
+        for request in requests:
+            self.assertIsNotNone(request.result(5))
+
+
+class ThreadedEmulatorTestCase(EmulatorTestCase):
+    client_class = CapiClient
+
+
+if __name__ == "__main__":
+    unittest.main()
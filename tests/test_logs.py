@@ -0,0 +1,59 @@
+
+from bnetbot.util.logs import *
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+
+def make_record(name, level=logging.DEBUG, msg="test"):
+    return logging.LogRecord(name, level, __file__, 1, msg, None, None)
+
+
+class TestSamplingFilter(unittest.TestCase):
+    def test_sampling(self):
+        sampler = SamplingFilter({"protocol": 5})
+        passed = [sampler.filter(make_record("bnetbot.Main.protocol")) for _ in range(20)]
+        self.assertEqual(passed.count(True), 4)
+
+    def test_other_records_pass(self):
+        sampler = SamplingFilter({"protocol": 5})
+        self.assertTrue(all(sampler.filter(make_record("bnetbot.Main")) for _ in range(10)))
+        self.assertTrue(all(sampler.filter(make_record("bnetbot.Main.protocol", logging.INFO)) for _ in range(10)))
+
+
+class TestDeferredQueueHandler(unittest.TestCase):
+    def test_mutable_args(self):
+        # Lists and dicts are merged into the message straight away, since they could change before it's written.
+        handler = DeferredQueueHandler(None)
+        args = ["a"]
+        record = handler.prepare(logging.LogRecord("bnetbot", logging.INFO, __file__, 1, "args: %s", (args,), None))
+        args.append("b")
+        self.assertEqual((record.getMessage(), record.args), ("args: ['a']", None))
+
+        record = handler.prepare(logging.LogRecord("bnetbot", logging.INFO, __file__, 1, "%s %i", ("a", 1), None))
+        self.assertEqual(record.args, ("a", 1))
+
+
+class TestInstanceFileHandler(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_file_per_instance(self):
+        handler = InstanceFileHandler(self.dir)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        for name in ["bnetbot.Main", "bnetbot.Main.protocol", "bnetbot.Other", "bnetbot"]:
+            handler.handle(make_record(name, msg=name))
+        handler.close()
+
+        with open(os.path.join(self.dir, "Main.log")) as fh:
+            self.assertEqual(fh.read().split(), ["bnetbot.Main", "bnetbot.Main.protocol"])
+        self.assertEqual(sorted(os.listdir(self.dir)), ["Main.log", "Other.log", "bnetbot.log"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+
+from bnetbot.monitor import ConnectionMonitor
+from datetime import datetime, timedelta
+from helpers import wait_for
+import logging
+import threading
+import unittest
+
+
+class FakeClient:
+    def __init__(self, connected=True, fail=0):
+        self.is_connected = connected
+        self.last_message = datetime.now() if connected else None
+        self.fail = fail
+        self.pings = 0
+        self.connects = 0
+        self.lock = threading.Lock()
+
+    def connected(self):
+        return self.is_connected
+
+    def connect(self):
+        with self.lock:
+            self.connects += 1
+            if self.connects <= self.fail:
+                return False
+            self.is_connected = True
+            self.last_message = datetime.now()
+            return True
+
+    def disconnect(self, force=False):
+        self.is_connected = False
+
+    def ping(self, payload=None):
+        self.pings += 1
+        self.last_message = datetime.now()
+
+    def expire_requests(self):
+        return []
+
+
+class FakeInstance:
+    def __init__(self, name, client):
+        self.name = name
+        self.client = client
+        self.log = logging.getLogger("bnetbot.test.%s" % name)
+
+
+class TestConnectionMonitor(unittest.TestCase):
+    def setUp(self):
+        self.monitor = ConnectionMonitor(keep_alive=0.05, workers=2, delay=0.01, max_delay=0.05)
+        self.monitor.start()
+
+    def tearDown(self):
+        self.monitor.stop()
+
+    def test_ping_when_idle(self):
+        client = FakeClient()
+        self.monitor.add(FakeInstance("Idle", client))
+        wait_for(lambda: client.pings >= 2)
+        self.assertEqual(client.connects, 0)
+
+    def test_reconnect_with_backoff(self):
+        client = FakeClient(connected=False, fail=2)
+        self.monitor.add(FakeInstance("Down", client))
+        wait_for(client.connected)
+        self.assertEqual(client.connects, 3)
+
+    def test_reconnect_when_silent(self):
+        client = FakeClient()
+        client.ping = lambda payload=None: None     # The server never answers
+        client.last_message = datetime.now() - timedelta(seconds=1)
+        self.monitor.add(FakeInstance("Silent", client))
+        wait_for(lambda: client.connects == 1)
+
+    def test_slow_reconnect_doesnt_block_checks(self):
+        slow = FakeClient(connected=False)
+        release = threading.Event()
+        connect = slow.connect
+        slow.connect = lambda: release.wait(5) and connect()
+
+        fast = FakeClient()
+        self.monitor.add(FakeInstance("Slow", slow))
+        self.monitor.add(FakeInstance("Fast", fast))
+        wait_for(lambda: fast.pings >= 2)
+        release.set()
+        wait_for(slow.connected)
+
+    def test_backoff_limits(self):
+        for attempts in range(1, 10):
+            wait = self.monitor.backoff(attempts)
+            limit = min(0.05, 0.01 * 2 ** (attempts - 1))
+            self.assertTrue(limit / 2 <= wait <= limit)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,48 @@
+
+from bnetbot.outbound import *
+from bnetbot.pending import RequestTable
+import unittest
+
+
+def queue_requests(queue, *commands):
+    requests = [RequestTable.create(command) for command in commands]
+    for request in requests:
+        queue.push(request)
+    return requests
+
+
+class TestOutboundQueue(unittest.TestCase):
+    def test_priority_lanes(self):
+        queue = OutboundQueue(rate=1, burst=10)
+        chat, ban, auth = queue_requests(queue, "Botapichat.SendMessageRequest", "Botapichat.BanUserRequest",
+                                         "Botapiauth.AuthenticateRequest")
+        self.assertEqual([queue.pop(0)[0] for _ in range(3)], [auth, ban, chat])
+        self.assertEqual(queue.pop(0), (None, None))
+
+    def test_rate_limit(self):
+        queue = OutboundQueue(rate=2, burst=1)
+        first, second = queue_requests(queue, "Botapichat.SendMessageRequest", "Botapichat.SendMessageRequest")
+        queue.bucket.updated = 0
+
+        self.assertIs(queue.pop(0)[0], first)
+        self.assertEqual(queue.pop(0), (None, 0.5))
+        self.assertIs(queue.pop(0.5)[0], second)
+
+    def test_retry_backoff(self):
+        queue = OutboundQueue(rate=100, burst=100, retries=1, backoff=2)
+        request, = queue_requests(queue, "Botapichat.SendMessageRequest")
+        queue.bucket.updated = 0
+
+        self.assertIs(queue.pop(0)[0], request)
+        self.assertTrue(queue.retry(request, 1))
+        self.assertEqual(queue.pop(1), (None, 2))
+        self.assertIs(queue.pop(3)[0], request)
+
+        # Out of retries
+        self.assertFalse(queue.retry(request, 4))
+        self.assertEqual(queue.stats()["retried"], 1)
+        self.assertEqual(queue.stats()["rate_limited"], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
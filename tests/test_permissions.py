@@ -1,5 +1,8 @@
 
 from bnetbot.database import *
+from bnetbot.permissions import PermissionMatcher
+import itertools
+import re
 import unittest
 
 
@@ -45,6 +48,80 @@ class TestPermissionAssignment(unittest.TestCase):
         user.permissions["exact.perm.node"] = False
         self.assertFalse(user.check_permission("exact.perm.node"))
 
+    def test_deny_overrides_allow(self):
+        user = DatabaseItem("TestUser", False)
+        user.permissions["commands.*"] = True
+        user.permissions["commands.admin.*"] = False
+
+        self.assertTrue(user.check_permission("commands.internal.ping"))
+        self.assertFalse(user.check_permission("commands.admin.perms"))
+
+    def test_changes_invalidate(self):
+        user = DatabaseItem("TestUser", False)
+        self.assertFalse(user.check_permission("exact.perm.node"))
+        user.permissions["exact.*"] = True
+        self.assertTrue(user.check_permission("exact.perm.node"))
+        del user.permissions["exact.*"]
+        self.assertFalse(user.check_permission("exact.perm.node"))
+        user.permissions = {"exact.perm.node": True}
+        self.assertTrue(user.check_permission("exact.perm.node"))
+
+
+class TestPermissionResolution(unittest.TestCase):
+    def setUp(self):
+        self.db = UserDatabase.load({
+            "groups": {
+                "Base": {"permissions": {"commands.internal.*": True}},
+                "Mod": {"permissions": {"commands.moderation.*": True}, "groups": ["Base"]}
+            },
+            "users": {
+                "Alice": {"permissions": {"commands.internal.time": False}, "groups": ["Mod"]}
+            }
+        })
+        self.alice = self.db.user("alice")
+
+    def test_inherited_permissions(self):
+        self.assertEqual(self.db.group("mod").closure(), (self.db.group("base"),))
+        self.assertEqual(self.alice.closure(), (self.db.group("mod"), self.db.group("base")))
+        self.assertEqual(sorted(self.alice.get_permissions()), ["commands.internal.*", "commands.moderation.*"])
+        self.assertTrue(self.alice.check_permission("commands.moderation.ban"))
+        self.assertFalse(self.alice.check_permission("commands.internal.time"))
+
+    def test_group_changes_reach_members(self):
+        self.assertFalse(self.alice.check_permission("commands.admin.perms"))
+        self.db.group("base").permissions["commands.admin.*"] = True
+        self.assertTrue(self.alice.check_permission("commands.admin.perms"))
+        self.assertIn("commands.admin.*", self.alice.get_permissions())
+
+        del self.alice.groups["mod"]
+        self.assertFalse(self.alice.check_permission("commands.admin.perms"))
+        self.assertEqual(self.alice.closure(), ())
+        self.assertEqual(len(self.db.group("mod").members), 0)
+
+    def test_cycles_rejected(self):
+        with self.assertRaises(ValueError):
+            self.db.group("base").groups["mod"] = self.db.group("mod")
+        with self.assertRaises(ValueError):
+            self.db.group("base").groups["base"] = self.db.group("base")
+
+        db = UserDatabase.load({"groups": {"A": {"groups": ["B"]}, "B": {"groups": ["A"]}}})
+        self.assertEqual(len(db.group("a").groups) + len(db.group("b").groups), 1)
+        self.assertFalse(db.group("a").check_permission("anything"))
+
+
+class TestPermissionMatcher(unittest.TestCase):
+    def test_same_as_regex(self):
+        # Every pattern must match exactly the nodes its regular expression would.
+        patterns = ["*", "a", "a.*", "*.b", "a.*.b", "a.*.*", "*.a.*", "a.b", "a*", "a.b*", "*a", "a.(b|c)"]
+        segments = ["a", "b", "c", "ab", ""]
+        nodes = ['.'.join(p) for n in range(1, 4) for p in itertools.product(segments, repeat=n)]
+
+        for pattern in patterns:
+            matcher = PermissionMatcher({pattern: True})
+            regex = re.compile(pattern.replace(".", "\\.").replace("*", ".*"))
+            for node in nodes:
+                self.assertEqual(matcher.check(node) is True, regex.fullmatch(node) is not None, (pattern, node))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,113 @@
+
+from bnetbot.bot import BnetBot
+from bnetbot.commands import SOURCE_LOCAL
+from bnetbot.database import DatabaseItem
+from bnetbot.util.persist import DeferredWriter, write_atomic
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+
+class TestWriteAtomic(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "config.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_replace(self):
+        write_atomic(self.path, "old")
+        os.chmod(self.path, 0o640)
+        write_atomic(self.path, "new")
+        with open(self.path, "r") as fh:
+            self.assertEqual(fh.read(), "new")
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o640)
+        self.assertEqual(os.listdir(self.directory), ["config.json"])
+
+    def test_failed_write_keeps_original(self):
+        write_atomic(self.path, "old")
+        with self.assertRaises(TypeError):
+            write_atomic(self.path, None)
+        with open(self.path, "r") as fh:
+            self.assertEqual(fh.read(), "old")
+        self.assertEqual(os.listdir(self.directory), ["config.json"])
+
+
+class TestDeferredWriter(unittest.TestCase):
+    def test_coalesce(self):
+        writes = []
+        done = threading.Event()
+
+        def write(items):
+            writes.append(items)
+            done.set()
+
+        writer = DeferredWriter(write, delay=0.1)
+        for i in range(10):
+            writer.mark_dirty(i)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(writes, [set(range(10))])
+        self.assertFalse(writer.dirty())
+        writer.stop()
+
+    def test_stop_flushes(self):
+        writes = []
+        writer = DeferredWriter(writes.append, delay=60)
+        writer.mark_dirty("a")
+        self.assertTrue(writer.stop())
+        self.assertEqual(writes, [{"a"}])
+        self.assertFalse(writer.stop())
+
+    def test_failed_write_is_kept(self):
+        def write(items):
+            raise OSError("disk full")
+
+        writer = DeferredWriter(write, delay=60)
+        writer.mark_dirty("a")
+        with self.assertRaises(OSError):
+            writer.flush()
+        self.assertTrue(writer.dirty())
+        writer.stop(False)
+
+
+class TestBotPersistence(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".json")
+        with os.fdopen(fd, "w") as fh:
+            json.dump({"save_delay": 60, "instances": {"Main": {"api_key": "key", "transport": "thread"}}}, fh)
+        self.bot = BnetBot(self.path)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_changes_are_deferred(self):
+        inst = self.bot.instances["main"]
+        inst.execute_command(inst.parse_command("/perms user Alice set commands.internal.*", SOURCE_LOCAL), "%root%")
+        self.assertTrue(self.bot.writer.dirty())
+        with open(self.path, "r") as fh:
+            self.assertNotIn("database", json.load(fh)["instances"]["Main"])
+
+        self.bot.stop(True)
+        with open(self.path, "r") as fh:
+            users = json.load(fh)["instances"]["Main"]["database"]["users"]
+        self.assertEqual(users["Alice"]["permissions"], {"commands.internal.*": True})
+
+    def test_save_waits_for_changes(self):
+        # The writer copies the database between changes, not while a command is halfway through one.
+        inst = self.bot.instances["main"]
+        saved = threading.Event()
+        with inst.database.lock:
+            thread = threading.Thread(target=lambda: (self.bot.save_config(), saved.set()))
+            thread.start()
+            self.assertFalse(saved.wait(0.1))
+            inst.database.add(DatabaseItem("Alice", False))
+        thread.join()
+        self.assertIn("Alice", inst.config["database"]["users"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+
+from bnetbot.commands import SOURCE_LOCAL, AdminCommands
+from bnetbot.instance import BotInstance
+from bnetbot.plugins import *
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import unittest
+
+
+DICE = """
+COMMANDS = [("roll", "commands.dice.roll", "roll", ["r"]), ("ping", "commands.dice.ping", "roll")]
+
+def roll(c):
+    c.respond("%s")
+"""
+
+
+class TestPlugins(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.write("dice", DICE % "4")
+        self.manager = PluginManager.from_config({"directories": [self.dir.name], "entry_points": False})
+
+        self.inst = BotInstance("test")
+        self.inst.register_command("ping", None, lambda c: c.respond("pong"))
+        self.inst.register_command("plugins", None, AdminCommands.plugins)
+        self.inst.plugins = self.manager
+        self.manager.attach(self.inst)
+
+    def tearDown(self):
+        self.manager.discover()     # Unloads the plugins
+        self.dir.cleanup()
+
+    def write(self, name, source):
+        with open(os.path.join(self.dir.name, name + ".py"), "w") as fh:
+            fh.write(source)
+
+    def run_command(self, text):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.inst.execute_command(self.inst.parse_command(text, SOURCE_LOCAL), "%root%")
+        return output.getvalue().strip()
+
+    def test_lazy_load(self):
+        plugin = self.manager.plugins["dice"]
+        self.assertFalse(plugin.loaded)
+        self.assertNotIn("bnetbot_plugins.dice", sys.modules)
+        self.assertIn("roll", self.inst.commands)
+        self.assertEqual(self.run_command("/ping"), "pong")         # Built in commands aren't replaced
+        self.assertFalse(plugin.loaded)
+
+        self.assertEqual(self.run_command("/r"), "4")
+        self.assertTrue(plugin.loaded)
+        self.assertEqual(self.run_command("/plugins"), "Plugins: dice (loaded)")
+
+    def test_reload(self):
+        self.assertEqual(self.run_command("/roll"), "4")
+        self.write("dice", DICE % "6")
+        self.write("coin", 'COMMANDS = [("flip", "commands.coin.flip", "flip")]\ndef flip(c):\n    c.respond("heads")\n')
+        self.assertEqual(self.run_command("/roll"), "4")
+
+        self.assertEqual(self.run_command("/plugins reload"), "Reloaded 2 plugin(s).")
+        self.assertEqual(self.run_command("/roll"), "6")
+        self.assertEqual(self.run_command("/flip"), "heads")
+
+        # A broken plugin keeps the version that was working.
+        self.write("dice", "COMMANDS = [")
+        with self.assertLogs("bnetbot.plugins", "WARNING"):
+            self.assertEqual(self.run_command("/plugins reload dice"), "Plugin 'dice' could not be reloaded, so the "
+                                                                      "old version is still in use - see the log for details.")
+        self.assertEqual(self.run_command("/r"), "6")
+        self.assertEqual(self.run_command("/ping"), "pong")
+        self.assertEqual(self.run_command("/plugins reload nope"), "Plugin 'nope' not found.")
+
+        # Reloading everything drops plugins that are removed.
+        os.remove(os.path.join(self.dir.name, "dice.py"))
+        self.assertEqual(self.run_command("/plugins reload"), "Reloaded 1 plugin(s).")
+        self.assertNotIn("roll", self.inst.commands)
+
+    def test_read_commands(self):
+        self.write("bad", 'COMMANDS = [("x", "y")]')
+        with self.assertRaises(ValueError):
+            read_commands(os.path.join(self.dir.name, "bad.py"))
+        for source in ['COMMANDS = [("x", "y", name)]', 'COMMANDS = 5', 'COMMANDS = [("x", "y", "z", 3)]',
+                       'COMMANDS = [("x", "y", "z", [None])]']:
+            self.write("bad", source)
+            with self.assertRaises(ValueError):
+                read_commands(os.path.join(self.dir.name, "bad.py"))
+
+        # A broken plugin is skipped without stopping the others from loading.
+        with self.assertLogs("bnetbot.plugins", "WARNING"):
+            self.assertEqual(sorted(self.manager.discover()), ["dice"])
+        self.assertEqual(read_commands(os.path.join(self.dir.name, "dice.py")),
+                         [("roll", "commands.dice.roll", "roll", ["r"]), ("ping", "commands.dice.ping", "roll", [])])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+
+from bnetbot.aio import AsyncCapiClient
+from bnetbot.capi import *
+from bnetbot.pending import *
+import json
+import unittest
+
+
+class TestRequestTable(unittest.TestCase):
+    def test_id_allocation(self):
+        table = RequestTable()
+        first, second = table.add("A"), table.add("B")
+        self.assertNotEqual(first.id, second.id)
+
+        # Answered IDs aren't reused straight away.
+        table.pop(first.id)
+        self.assertNotIn(table.add("C").id, [first.id, second.id])
+        self.assertEqual(len(table), 2)
+
+    def test_id_wraps_around_pending(self):
+        table = RequestTable()
+        table._next_id = MAX_REQUEST_ID
+        last = table.add("A")
+        self.assertEqual(last.id, MAX_REQUEST_ID)
+        self.assertEqual(table.add("B").id, 1)
+
+    def test_expire(self):
+        table = RequestTable(timeout=5)
+        old = table.add("Old")
+        answered = table.add("Answered")
+        table.pop(answered.id)
+
+        self.assertEqual(table.expire(old.deadline - 1), [])
+        self.assertEqual(table.expire(old.deadline + 1), [old])
+        self.assertEqual(len(table), 0)
+        self.assertIsNone(table.next_deadline())
+
+
+class TestClientRequests(unittest.TestCase):
+    def setUp(self):
+        self.client = CapiClient("key", request_timeout=0)
+        self.client._write = lambda message: None
+        self.errors = []
+        self.client.events['client_error'].register(lambda c, e: self.errors.append(e))
+
+    def test_response_resolves_request(self):
+        self.client._requests.timeout = 30
+        request = self.client.send("Botapichat.SendMessageRequest", {"message": "hi"})
+        self.client.flush_outbound()
+        response = {"command": "Botapichat.SendMessageResponse", "request_id": request.id, "payload": {}}
+        self.client._process_frame(1, json.dumps(response).encode('utf-8'))
+        self.assertEqual(request.result(0), response)
+
+    def test_timeout(self):
+        request = self.client.send("Botapichat.SendMessageRequest", {"message": "hi"})
+        self.client.flush_outbound()
+        self.client.expire_requests()
+
+        self.assertIsInstance(request.exception(0), CapiError)
+        self.assertEqual((request.exception(0).area, request.exception(0).code), (6, 5))
+        self.assertEqual(self.errors, [request.exception(0)])
+
+    def test_expiry_keeps_sender_timer(self):
+        # The sender's timer is only cancelled by the sender, so firing the expiry timer mustn't forget it.
+        client = AsyncCapiClient("key")
+        sender_timer = object()
+        client._sender_timer = sender_timer
+        client._expiry_timer = object()
+        client._on_expiry_timer()
+        self.assertIs(client._sender_timer, sender_timer)
+        self.assertIsNone(client._expiry_timer)
+
+
+if __name__ == "__main__":
+    unittest.main()
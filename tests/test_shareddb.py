@@ -0,0 +1,68 @@
+
+from bnetbot.database import DatabaseItem, UserDatabase
+from bnetbot.shareddb import OverlayUserDatabase, SharedDatabases
+import unittest
+
+
+class TestSharedDatabase(unittest.TestCase):
+    def setUp(self):
+        self.databases = SharedDatabases({
+            "main": {
+                "groups": {"Ops": {"permissions": {"commands.moderation.*": True}}},
+                "users": {"Alice": {"groups": ["Ops"]}, "Bob": {}}
+            }
+        })
+        self.first = UserDatabase.load({"shared": "main"}, self.databases)
+        self.second = UserDatabase.load({
+            "shared": "main",
+            "groups": {"Local": {"permissions": {"commands.internal.*": True}, "groups": ["Ops"]}},
+            "users": {"Bob": {"groups": ["Local"]}}
+        }, self.databases)
+
+    def test_items_shared(self):
+        self.assertIsInstance(self.first, OverlayUserDatabase)
+        self.assertIs(self.first.user("alice"), self.second.user("ALICE"))
+        self.assertIs(self.first.shared, self.databases.get("main"))
+
+        # Changes made through one instance are seen by the others.
+        self.first.user("alice").permissions["commands.admin.perms"] = True
+        self.assertTrue(self.second.user("alice").check_permission("commands.admin.perms"))
+        self.first.group("ops").permissions["commands.admin.kick"] = True
+        self.assertTrue(self.second.user("bob").check_permission("commands.admin.kick"))
+
+        carol = self.second.add(DatabaseItem("Carol", False))
+        self.assertIs(self.first.user("carol"), carol)
+        self.first.remove(carol)
+        self.assertIsNone(self.second.user("carol"))
+
+    def test_overlay(self):
+        bob = self.second.user("bob")
+        self.assertIsNot(bob, self.first.user("bob"))
+        self.assertTrue(bob.check_permission("commands.moderation.kick"))
+        self.assertTrue(bob.check_permission("commands.internal.ping"))
+        self.assertFalse(self.first.user("bob").check_permission("commands.internal.ping"))
+        self.assertIsNone(self.first.group("local"))
+
+        # Replacing an overlay item keeps it in the overlay.
+        self.second.add(DatabaseItem("Bob", False, ["commands.admin.*"]))
+        self.assertFalse(self.first.user("bob").check_permission("commands.admin.perms"))
+
+        self.assertEqual(self.first.to_config(), {"shared": "main"})
+        config = self.second.to_config()
+        self.assertEqual(sorted(config), ["groups", "shared", "users"])
+        self.assertEqual(list(config["users"]), ["Bob"])
+
+        names = [(is_group, name) for is_group, name, entry in self.second.entries()]
+        self.assertEqual(names, [(True, "Local"), (True, "Admin"), (True, "Moderator"), (True, "User"),
+                                 (True, "Ops"), (False, "Bob"), (False, "%root%"), (False, "Alice")])
+
+    def test_save(self):
+        self.first.user("alice").permissions["commands.admin.perms"] = True
+        config = self.databases.to_config()
+        self.assertEqual(list(config), ["main"])
+        self.assertTrue(config["main"]["users"]["Alice"]["permissions"]["commands.admin.perms"])
+        self.assertEqual(SharedDatabases().to_config(), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
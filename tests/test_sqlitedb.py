@@ -0,0 +1,75 @@
+
+from bnetbot.database import DatabaseItem, UserDatabase, change_count
+from bnetbot.sqlitedb import SqliteUserDatabase
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class TestSqliteUserDatabase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "users.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_default_groups(self):
+        db = UserDatabase.load({"sqlite": self.path})
+        self.assertIsInstance(db, SqliteUserDatabase)
+        self.assertEqual(db.to_config(), {"sqlite": self.path})
+        self.assertTrue(db.user("%ROOT%").check_permission("anything"))
+        self.assertEqual(db.group("moderator").group_list(), ["User"])
+
+    def test_migrate_from_json(self):
+        source = UserDatabase()
+        alice = source.add(DatabaseItem("Alice", False, ["commands.internal.ping"]))
+        alice.groups["moderator"] = source.group("moderator")
+        config = source.to_config()
+        config["sqlite"] = self.path
+
+        db = UserDatabase.load(config)
+        self.assertEqual(len(db), 2)
+        self.assertEqual(db._users, {})     # Nothing is loaded until it's looked up
+        changes = change_count()
+        user = db.user("ALICE")
+        self.assertEqual(change_count(), changes)   # Loading isn't a change, so cached command results are kept
+        self.assertIs(db.user("alice"), user)
+        self.assertTrue(user.check_permission("commands.moderation.kick"))
+        self.assertTrue(user.check_permission("commands.internal.ping"))
+        self.assertIsNone(db.user("Bob"))
+
+        # The JSON elements are only used for a new file.
+        config["users"] = {}
+        self.assertIsNotNone(UserDatabase.load(config).user("alice"))
+
+    def test_changes_persist(self):
+        db = SqliteUserDatabase.load({"sqlite": self.path})
+        db.add(DatabaseItem("Bob", False))
+        db.user("bob").permissions["commands.moderation.ban"] = True
+        db.remove(db.user("%root%"))
+        self.assertEqual(db.commit(), 1)
+        self.assertEqual(db.commit(), 0)
+        db.close()
+
+        db = SqliteUserDatabase.load({"sqlite": self.path})
+        self.assertIsNone(db.user("%root%"))
+        self.assertTrue(db.user("BOB").check_permission("commands.moderation.ban"))
+        with self.assertRaises(KeyError):
+            db.remove(DatabaseItem("Nobody", False))
+
+    def test_group_cycle(self):
+        db = SqliteUserDatabase(self.path)
+        with db._conn:
+            db._conn.execute("INSERT INTO items VALUES (1, 'a', 'A', '{\"groups\": [\"B\"]}')")
+            db._conn.execute("INSERT INTO items VALUES (1, 'b', 'B', '{\"groups\": [\"A\"]}')")
+
+        # The link that would complete the cycle is dropped.
+        a = db.group("a")
+        self.assertEqual(list(a.groups), [])
+        self.assertIs(db.group("b").groups["a"], a)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+
+from bnetbot.emulator import CapiServer
+from bnetbot.supervisor import MSG_SAVE, Supervisor, assign_instances
+from helpers import wait_for
+import json
+import os
+import tempfile
+import unittest
+
+
+class TestAssignInstances(unittest.TestCase):
+    def test_round_robin(self):
+        assignments = assign_instances(["Main", "alpha", "Beta", "gamma", "Delta"], 2)
+        self.assertEqual(assignments, {"alpha": 0, "beta": 1, "delta": 0, "gamma": 1, "main": 0})
+
+    def test_shared_database(self):
+        # Profiles sharing a database go to the same worker, in the place of the first of them.
+        assignments = assign_instances(["Main", "alpha", "Beta", "gamma"], 2, {"Main": "users", "alpha": "users"})
+        self.assertEqual(assignments, {"alpha": 0, "beta": 1, "gamma": 0, "main": 0})
+
+    def test_shared_database_saves(self):
+        fd, path = tempfile.mkstemp(suffix=".json")
+        with os.fdopen(fd, "w") as fh:
+            json.dump({"instances": {"One": {"database": {"shared": "users"}}, "Two": {"database": {"shared": "users"}},
+                                     "Three": {}}}, fh)
+        try:
+            supervisor = Supervisor(path, 4)
+        finally:
+            os.remove(path)
+        self.assertEqual([w.names for w in supervisor.workers], [["One", "Two"], ["Three"]])
+
+        # Only the worker that owns a shared database can save it.
+        class Connection:
+            def __init__(self, message):
+                self.message = message
+
+            def recv(self):
+                return self.message
+
+        for worker, name in [(supervisor.workers[1], "stale"), (supervisor.workers[0], "bob")]:
+            worker.connection = Connection((MSG_SAVE, {}, {"users": {"users": {name: {}}}}))
+            supervisor._receive(worker)
+        self.assertEqual(supervisor.config["databases"], {"users": {"users": {"bob": {}}}})
+
+
+class TestSupervisor(unittest.TestCase):
+    def setUp(self):
+        self.server = CapiServer(api_keys={"key1": "BotOne", "key2": "BotTwo"}, channel="Op Test", rate=0)
+        endpoint = self.server.start()
+
+        fd, self.config_path = tempfile.mkstemp(suffix=".json")
+        with os.fdopen(fd, "w") as fh:
+            json.dump({"keep_alive": 1, "instances": {
+                "One": {"api_key": "key1", "endpoint": endpoint, "log_level": "ERROR"},
+                "Two": {"api_key": "key2", "endpoint": endpoint, "log_level": "ERROR"}
+            }}, fh)
+
+        self.supervisor = Supervisor(self.config_path, 2, restart_delay=0.1)
+
+    def tearDown(self):
+        if self.supervisor.running:
+            self.supervisor.stop(True)
+        self.server.stop()
+        os.remove(self.config_path)
+
+    def bots_in_channel(self):
+        return sorted(c.user.name for c in self.server.channel.connections)
+
+    def test_workers(self):
+        self.supervisor.start()
+        self.assertEqual([w.names for w in self.supervisor.workers], [["One"], ["Two"]])
+        wait_for(lambda: self.bots_in_channel() == ["BotOne", "BotTwo"], 30)
+
+        # Console input goes to the worker running the profile.
+        talk = []
+        self.server.channel.message = self.wrap_message(talk)
+        self.assertTrue(self.supervisor.console("two", "hello"))
+        self.assertFalse(self.supervisor.console("three", "hello"))
+        wait_for(lambda: talk, 30)
+        self.assertEqual(talk, [("BotTwo", "hello")])
+
+        # Crashed workers are restarted.
+        worker = self.supervisor.owner("One")
+        old = worker.process
+        old.kill()
+        wait_for(lambda: worker.process is not old and worker.process.is_alive(), 30)
+        wait_for(lambda: len(self.server.channel.connections) == 2, 30)
+
+        # Config changes made by the workers are saved by the supervisor.
+        self.supervisor.stop(True)
+        with open(self.config_path, "r") as fh:
+            config = json.load(fh)
+        self.assertEqual(sorted(config["instances"]), ["One", "Two"])
+        self.assertIn("%root%", config["instances"]["One"]["database"]["users"])
+        self.assertEqual(config["instances"]["Two"]["api_key"], "key2")
+
+    def wrap_message(self, talk):
+        message = self.server.channel.message
+
+        def wrapped(user, text, mtype="Channel"):
+            talk.append((user.name, text))
+            return message(user, text, mtype)
+        return wrapped
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+
+from bnetbot.commands import SOURCE_LOCAL, SOURCE_PRIVATE
+from bnetbot.instance import BotInstance
+from bnetbot.util.text import *
+import contextlib
+import io
+import unittest
+
+
+class TestPacking(unittest.TestCase):
+    def test_split(self):
+        self.assertEqual(split_text("the quick brown fox", 10), ["the quick", "brown fox"])
+        self.assertEqual(split_text("abcdefghijkl mn", 5), ["abcde", "fghij", "kl mn"])
+        self.assertEqual(split_text("short", 10), ["short"])
+        self.assertEqual(split_text("", 10), [])
+
+        # Multi-byte characters count by their encoded size and are never cut in half.
+        pieces = split_text("é" * 7, 5)
+        self.assertEqual(pieces, ["éé", "éé", "éé", "é"])
+        self.assertTrue(all(byte_length(p) <= 5 for p in pieces))
+
+    def test_pack(self):
+        self.assertEqual(pack_lines(["one", "two", "three"], 20), ["one | two | three"])
+        self.assertEqual(pack_lines(["one", "two", "three"], 10), ["one | two", "three"])
+        self.assertEqual(pack_lines(["a\nb", "", "  "], 50), ["a | b"])
+        self.assertEqual(pack_lines(["x" * 8, "the end of it"], 10), ["xxxxxxxx", "the end of", "it"])
+
+        lines = ["line %i with some words" % i for i in range(40)]
+        messages = pack_lines(lines, 223)
+        self.assertEqual(len(messages), 5)
+        self.assertTrue(all(byte_length(m) <= 223 for m in messages))
+        self.assertEqual(LINE_SEPARATOR.join(messages).split(LINE_SEPARATOR), lines)
+
+    def test_respond(self):
+        inst = BotInstance("test", {"max_message_length": 20})
+        sent = []
+        inst.client.chat = lambda message, target=None: sent.append((message, target))
+        inst.register_command("lines", None, lambda c: c.respond("\n".join(["first", "second", "third"])))
+
+        cmd = inst.execute_command(inst.parse_command("!lines", SOURCE_PRIVATE), "%root%")
+        self.assertEqual(sent, [("first | second", "%root%"), ("third", "%root%")])
+        self.assertEqual(cmd.response, [])
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            inst.execute_command(inst.parse_command("/lines", SOURCE_LOCAL), "%root%")
+        self.assertEqual(output.getvalue(), "first\nsecond\nthird\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+
+from bnetbot.database import DatabaseItem, UserDatabase
+from bnetbot.sqlitedb import SqliteUserDatabase
+from bnetbot.transfer import *
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+
+def make_source():
+    db = UserDatabase()
+    ops = db.add(DatabaseItem("Ops", True, ["commands.moderation.*"]))
+    ops.groups["user"] = db.group("user")
+    for i in range(25):
+        user = db.add(DatabaseItem("User%i" % i, False))
+        user.groups["ops"] = ops
+        user.permissions["commands.moderation.ban"] = False
+    return db
+
+
+class TestTransfer(unittest.TestCase):
+    def test_round_trip(self):
+        for fmt in FORMATS:
+            source = make_source()
+            fh = io.StringIO(newline="")
+            self.assertEqual(export_file(source, fh, fmt), 30)
+
+            db = UserDatabase()
+            flushes = []
+            fh.seek(0)
+            self.assertEqual(import_file(db, fh, fmt, batch_size=10, flush=lambda: flushes.append(1)), (30, 0))
+            self.assertEqual(len(flushes), 3)
+            self.assertEqual(db.to_config(), source.to_config())
+
+            user = db.user("user7")
+            self.assertTrue(user.check_permission("commands.moderation.kick"))
+            self.assertTrue(user.check_permission("commands.internal.ping"))
+            self.assertFalse(user.check_permission("commands.moderation.ban"))
+
+    def test_invalid_lines(self):
+        lines = [
+            {"type": "user", "name": "Alice", "permissions": {"commands.internal.ping": True}},
+            {"type": "robot", "name": "Bob"},
+            {"type": "user", "name": "Carol", "permissions": {"commands.internal.ping": "yes"}},
+            {"type": "user", "name": "Dave", "added": "yesterday"},
+            {"type": "group", "name": "User", "groups": ["User"]}
+        ]
+        fh = io.StringIO("\n".join(json.dumps(line) for line in lines) + "\nnot json\n\n")
+        db = UserDatabase()
+        progress = []
+        with self.assertLogs("bnetbot", "WARNING"):
+            result = import_file(db, fh, progress=lambda n, s: progress.append((n, s)))
+        self.assertEqual(result, (1, 5))
+        self.assertEqual(progress, [(1, 5)])
+        self.assertTrue(db.user("alice").check_permission("commands.internal.ping"))
+        self.assertEqual(db.group("user").group_list(), [])
+
+    def test_csv_columns(self):
+        fh = io.StringIO("name,type,groups,permissions\nAlice,user,moderator missing,commands.* -commands.admin.*\n")
+        db = UserDatabase()
+        self.assertEqual(import_file(db, fh, FORMAT_CSV), (1, 0))
+        alice = db.user("alice")
+        self.assertEqual(alice.to_config()["groups"], ["Moderator", "missing"])
+        self.assertTrue(alice.check_permission("commands.internal.ping"))
+        self.assertFalse(alice.check_permission("commands.admin.perms"))
+
+
+class TestSqliteTransfer(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db = SqliteUserDatabase.load({"sqlite": os.path.join(self.directory, "users.db")})
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.directory)
+
+    def test_import_and_export(self):
+        fh = io.StringIO()
+        export_file(make_source(), fh)
+        fh.seek(0)
+
+        # Loaded groups are updated in place and loaded users are read again.
+        moderator = self.db.group("moderator")
+        old_root = self.db.user("%root%")
+        self.assertEqual(import_file(self.db, fh, batch_size=7), (30, 0))
+        self.assertEqual(len(self.db._users), 0)
+        self.assertIsNot(self.db.user("%root%"), old_root)
+        self.assertIs(self.db.group("moderator"), moderator)
+        self.assertEqual(len(self.db), 26)
+        self.assertTrue(self.db.user("user3").check_permission("commands.moderation.kick"))
+
+        out = io.StringIO()
+        self.assertEqual(export_file(self.db, out, batch_size=2), 30)
+        rows = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([row["type"] for row in rows], ["group"] * 4 + ["user"] * 26)
+
+    def test_cycle_skipped(self):
+        self.db.group("user")
+        fh = io.StringIO(json.dumps({"type": "group", "name": "User", "groups": ["Moderator"]}) + "\n")
+        with self.assertLogs("bnetbot", "WARNING"):
+            self.assertEqual(import_file(self.db, fh), (0, 1))
+        self.assertEqual(self.db.group("user").group_list(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,36 @@
+
+from bnetbot.util.ws import *
+import asyncio
+import unittest
+
+
+def read_message(raw, client=False):
+    loop = asyncio.new_event_loop()
+    try:
+        reader = asyncio.StreamReader(loop=loop)
+        reader.feed_data(raw)
+        reader.feed_eof()
+        return loop.run_until_complete(WebSocketStream(reader, None, client).recv())
+    finally:
+        loop.close()
+
+
+class TestFrameEncoding(unittest.TestCase):
+    def test_masked_round_trip(self):
+        for size in [0, 5, 125, 126, 65535, 65536]:
+            data = bytes(i % 251 for i in range(size))
+            self.assertEqual(read_message(encode_frame(OPCODE_BINARY, data, True)), (OPCODE_BINARY, data))
+
+    def test_fragmented_message(self):
+        first = bytearray(encode_frame(OPCODE_TEXT, "hello ", False))
+        first[0] &= 0x7F    # Clear FIN bit
+        second = encode_frame(OPCODE_CONT, "world", False)
+        self.assertEqual(read_message(bytes(first) + second), (OPCODE_TEXT, b"hello world"))
+
+    def test_accept_key(self):
+        # Example from RFC 6455 section 1.3
+        self.assertEqual(accept_key("dGhlIHNhbXBsZSBub25jZQ=="), "s3pPLMBiTxaQ9kYGzzhZRbK+xOo=")
+
+
+if __name__ == "__main__":
+    unittest.main()